@@ -0,0 +1,83 @@
+""" Checks that serialize reads back what it writes, then times loading a
+program file against lexing and parsing the source again.
+
+usage: python3 bench/binary.py [size]
+
+The check round-trips every generated shape, tokens and ast, through a
+mapped file, and an expression nested far deeper than recursion allows. The
+timing, the best of five runs, uses a mixed source of size characters
+(default 2000000); pickle, what the cache stores, is timed too.
+"""
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import parser as parse
+import serialize
+from generate import SHAPES, generate
+from lexer import tokenize
+
+
+def best(func, runs=5):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def check(path):
+    for shape in SHAPES:
+        tokens = tokenize(generate(shape, 100000))
+        program = parse.Parser(tokens).parse_program()
+        serialize.dump(program, path, tokens)
+        with serialize.load(path) as reader:
+            if reader.program() != program or reader.tokens() != list(tokens):
+                print(f"{shape}: the program file reads back differently")
+                sys.exit(1)
+    # compared as bytes, == on the nodes would recurse as deep as the tree
+    chain = parse.Literal(0)
+    for i in range(100000):
+        chain = parse.Binary('-', chain, parse.Literal(-i * 0.5 if i % 2 else i))
+    data = serialize.dumps(parse.Program([parse.Return(chain)]))
+    if serialize.dumps(serialize.loads(data).program()) != data:
+        print("a deep expression reads back differently")
+        sys.exit(1)
+    print(f"{', '.join(SHAPES)} and a deep expression read back the same")
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'program.hb')
+        check(path)
+        source = generate('mixed', size)
+        tokens = tokenize(source)
+        program = parse.Parser(tokens).parse_program()
+        serialize.dump(program, path, tokens)
+        pickled = pickle.dumps(program, pickle.HIGHEST_PROTOCOL)
+
+        def load():
+            with serialize.load(path) as reader:
+                reader.program()
+
+        def load_one():
+            with serialize.load(path) as reader:
+                reader.declaration(len(reader) // 2)
+
+        lex_parse = best(lambda: parse.Parser(tokenize(source)).parse_program())
+        loaded = best(load)
+        one = best(load_one)
+        unpickled = best(lambda: pickle.loads(pickled))
+        print(f"{len(source):,} characters, {os.path.getsize(path):,} bytes written (pickle "
+              f"{len(pickled):,} without the tokens): lex and parse {lex_parse:.2f} s, load {loaded:.2f} s "
+              f"({lex_parse / loaded:.1f}x), one declaration {one * 1000:.1f} ms, pickle {unpickled:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+""" Times handing ast nodes to a handler per node class: an isinstance chain,
+match on the class, and parser.NodeVisitor's dict keyed by type(node).
+
+usage: python3 bench/dispatch.py [size] [rounds]
+
+The nodes are those of a generated source of size characters (default
+500000), every one dispatched rounds times (default 5) to a handler that
+only returns, so what is timed is finding it. Then a whole tree is walked by
+NodeVisitor.visit, recursing through generic_visit, and by walk.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import parser as parse
+from generate import generate
+from lexer import tokenize
+from parser import (ArrayAccess, Assignment, Binary, Call, Compound, Declaration, ExprStmt, For, Function, If,
+                    Literal, Program, Return, Unary, Var, While)
+
+# in the order of the old pretty printer's chain
+CLASSES = [Program, Function, Declaration, Compound, If, While, For, Return, ExprStmt, Binary, Unary, Literal,
+           Var, Assignment, Call, ArrayAccess]
+
+
+def handle(node):
+    return node
+
+
+def by_isinstance(node):
+    if isinstance(node, Program):
+        return handle(node)
+    elif isinstance(node, Function):
+        return handle(node)
+    elif isinstance(node, Declaration):
+        return handle(node)
+    elif isinstance(node, Compound):
+        return handle(node)
+    elif isinstance(node, If):
+        return handle(node)
+    elif isinstance(node, While):
+        return handle(node)
+    elif isinstance(node, For):
+        return handle(node)
+    elif isinstance(node, Return):
+        return handle(node)
+    elif isinstance(node, ExprStmt):
+        return handle(node)
+    elif isinstance(node, Binary):
+        return handle(node)
+    elif isinstance(node, Unary):
+        return handle(node)
+    elif isinstance(node, Literal):
+        return handle(node)
+    elif isinstance(node, Var):
+        return handle(node)
+    elif isinstance(node, Assignment):
+        return handle(node)
+    elif isinstance(node, Call):
+        return handle(node)
+    elif isinstance(node, ArrayAccess):
+        return handle(node)
+    return None
+
+
+def by_match(node):
+    match node:
+        case Program():
+            return handle(node)
+        case Function():
+            return handle(node)
+        case Declaration():
+            return handle(node)
+        case Compound():
+            return handle(node)
+        case If():
+            return handle(node)
+        case While():
+            return handle(node)
+        case For():
+            return handle(node)
+        case Return():
+            return handle(node)
+        case ExprStmt():
+            return handle(node)
+        case Binary():
+            return handle(node)
+        case Unary():
+            return handle(node)
+        case Literal():
+            return handle(node)
+        case Var():
+            return handle(node)
+        case Assignment():
+            return handle(node)
+        case Call():
+            return handle(node)
+        case ArrayAccess():
+            return handle(node)
+    return None
+
+
+class Handlers(parse.NodeVisitor):
+    """ A visit_<Class> for each class, each only returning. """
+
+
+for cls in CLASSES:
+    setattr(Handlers, f"visit_{cls.__name__}", lambda self, node: handle(node))
+
+
+class Counter(parse.NodeVisitor):
+    def __init__(self):
+        self.count = 0
+
+    def visit_Node(self, node):
+        self.count += 1
+        self.generic_visit(node)
+
+
+class Walker(parse.NodeVisitor):
+    def __init__(self):
+        self.count = 0
+
+    def visit_Node(self, node):
+        self.count += 1
+
+
+class Nodes(parse.NodeVisitor):
+    def __init__(self):
+        self.nodes = []
+
+    def visit_Node(self, node):
+        self.nodes.append(node)
+
+
+def per_node(dispatch, nodes, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for node in nodes:
+            dispatch(node)
+    return (time.perf_counter() - start) / (rounds * len(nodes)) * 1e9
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    program = parse.Parser(tokenize(generate('mixed', size))).parse_program()
+    collect = Nodes()
+    collect.walk(program)
+    nodes = collect.nodes
+    print(f"{len(nodes):,} nodes, {rounds} rounds, ns per node:")
+    # the classes by how often they occur, the chain's cost depends on it
+    counts = {cls.__name__: sum(type(node) is cls for node in nodes) for cls in CLASSES}
+    print("  " + ", ".join(f"{name} {count}" for name, count in sorted(counts.items(), key=lambda item: -item[1])))
+    visitor = Handlers()
+    for name, dispatch in [('isinstance chain', by_isinstance), ('match on class', by_match),
+                           ('dict by type(node)', visitor.visit)]:
+        print(f"  {name:20} {per_node(dispatch, nodes, rounds):6.1f}")
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    counter, walker = Counter(), Walker()
+    start = time.perf_counter()
+    counter.visit(program)
+    middle = time.perf_counter()
+    walker.walk(program)
+    end = time.perf_counter()
+    if counter.count != walker.count or walker.count != parse.count_nodes(program):
+        print("visit and walk see different nodes")
+        sys.exit(1)
+    print(f"whole tree: visit {(middle - start) * 1000:.1f} ms, walk {(end - middle) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
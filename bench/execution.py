@@ -0,0 +1,221 @@
+""" Times --run (closures.py) against a naive tree walking interpreter.
+
+usage: python3 bench/execution.py [scale]
+
+Both run the same loop heavy programs and must print the same thing. The
+naive interpreter looks names up in a chain of dicts and dispatches on the
+node class every time it evaluates a node, the way a first interpreter
+over parser.py nodes would.
+"""
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import closures
+import parser as parse
+from lexer import tokenize
+from parser import (Function, Declaration, Compound, If, While, For, Return, ExprStmt,
+                    Binary, Unary, Literal, Var, Assignment, Call, ArrayAccess)
+
+PROGRAMS = {
+    'nested_loops': """
+int main() {
+    long total = 0;
+    for (long i = 0; i < SCALE; i++) {
+        for (long j = 0; j < 100; j++) {
+            total = total + i * j - j / 3;
+        }
+    }
+    printf("%ld\\n", total);
+    return 0;
+}
+""",
+    'fib': """
+long fib(long n) {
+    if (n < 2) return n;
+    return fib(n - 1) + fib(n - 2);
+}
+
+int main() {
+    printf("%ld\\n", fib(12 + SCALE / 40));
+    return 0;
+}
+""",
+    'bubble_sort': """
+int main() {
+    long n = SCALE * 2;
+    long a = malloc(n * 8);
+    for (long i = 0; i < n; i++) {
+        a[i] = i * 7919 - i * 7919 / 1009 * 1009;
+    }
+    for (long i = 0; i < n; i++) {
+        for (long j = 0; j < n - 1 - i; j++) {
+            if (a[j] > a[j + 1]) {
+                long t = a[j];
+                a[j] = a[j + 1];
+                a[j + 1] = t;
+            }
+        }
+    }
+    printf("%ld %ld %ld\\n", a[0], a[n / 2], a[n - 1]);
+    return 0;
+}
+""",
+    'collatz': """
+int main() {
+    long longest = 0;
+    for (long start = 1; start < SCALE * 10; start++) {
+        long x = start;
+        long steps = 0;
+        while (x > 1) {
+            if (x / 2 * 2 < x) x = 3 * x + 1;
+            else x = x / 2;
+            steps++;
+        }
+        if (steps > longest) longest = steps;
+    }
+    printf("%ld\\n", longest);
+    return 0;
+}
+""",
+}
+
+
+class Returned(Exception):
+    def __init__(self, value):
+        self.value = value
+
+
+class Naive:
+    """ Evaluates the ast directly, names in dicts, return as an exception. """
+    def __init__(self, program, out):
+        self.functions = {d.name: d for d in program.declarations if isinstance(d, Function)}
+        self.builtins = closures.Builtins(out)
+        self.globals = {}
+
+    def call(self, name, args):
+        if name not in self.functions:
+            return getattr(self.builtins, name)(*args)
+        fn = self.functions[name]
+        env = [self.globals, dict(zip([p for _, p in fn.params], args))]
+        try:
+            self.exec(fn.body, env)
+        except Returned as ret:
+            return ret.value
+        return 0
+
+    def lookup(self, env, name):
+        for scope in reversed(env):
+            if name in scope:
+                return scope
+        raise NameError(name)
+
+    def exec(self, node, env):
+        if isinstance(node, Compound):
+            env.append({})
+            try:
+                for stmt in node.stmts:
+                    self.exec(stmt, env)
+            finally:
+                env.pop()
+        elif isinstance(node, Declaration):
+            env[-1][node.name] = self.eval(node.initializer, env) if node.initializer is not None else 0
+        elif isinstance(node, ExprStmt):
+            if node.expr is not None:
+                self.eval(node.expr, env)
+        elif isinstance(node, Return):
+            raise Returned(self.eval(node.expr, env) if node.expr is not None else 0)
+        elif isinstance(node, If):
+            if self.eval(node.cond, env):
+                self.exec(node.then_branch, env)
+            elif node.else_branch is not None:
+                self.exec(node.else_branch, env)
+        elif isinstance(node, While):
+            while self.eval(node.cond, env):
+                self.exec(node.body, env)
+        elif isinstance(node, For):
+            env.append({})
+            try:
+                if isinstance(node.init, Declaration):
+                    self.exec(node.init, env)
+                elif node.init is not None:
+                    self.eval(node.init, env)
+                while node.cond is None or self.eval(node.cond, env):
+                    self.exec(node.body, env)
+                    if node.post is not None:
+                        self.eval(node.post, env)
+            finally:
+                env.pop()
+
+    def eval(self, node, env):
+        if isinstance(node, Literal):
+            return closures.constant(node)
+        if isinstance(node, Var):
+            return self.lookup(env, node.name)[node.name]
+        if isinstance(node, Binary):
+            if node.op == '&&':
+                return int(bool(self.eval(node.left, env)) and bool(self.eval(node.right, env)))
+            if node.op == '||':
+                return int(bool(self.eval(node.left, env)) or bool(self.eval(node.right, env)))
+            left, right = self.eval(node.left, env), self.eval(node.right, env)
+            if node.op == '+': return left + right
+            if node.op == '-': return left - right
+            if node.op == '*': return left * right
+            if node.op == '/': return closures.c_div(left, right)
+            if node.op == '<': return int(left < right)
+            if node.op == '>': return int(left > right)
+            if node.op == '<=': return int(left <= right)
+            if node.op == '>=': return int(left >= right)
+            raise ValueError(node.op)
+        if isinstance(node, Unary):
+            if node.op in ('++', '--'):
+                old = self.eval(node.operand, env)
+                new = old + (1 if node.op == '++' else -1)
+                self.assign(node.operand, new, env)
+                return new if node.prefix else old
+            value = self.eval(node.operand, env)
+            return {'-': -value, '+': value, '!': int(not value), '~': ~value}[node.op]
+        if isinstance(node, Assignment):
+            value = self.eval(node.value, env)
+            self.assign(node.target, value, env)
+            return value
+        if isinstance(node, Call):
+            return self.call(node.callee.name, [self.eval(arg, env) for arg in node.args])
+        if isinstance(node, ArrayAccess):
+            return self.eval(node.array, env)[self.eval(node.index, env)]
+        raise ValueError(type(node).__name__)
+
+    def assign(self, target, value, env):
+        if isinstance(target, Var):
+            self.lookup(env, target.name)[target.name] = value
+        else:
+            self.eval(target.array, env)[self.eval(target.index, env)] = value
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    # fib recurses through several python frames per call in both
+    sys.setrecursionlimit(100000)
+    print(f"{'program':<14}{'naive s':>10}{'closures s':>12}{'speedup':>10}")
+    for name, text in PROGRAMS.items():
+        ast = parse.Parser(tokenize(text.replace('SCALE', str(scale)))).parse_program()
+        naive_out, fast_out = io.StringIO(), io.StringIO()
+        naive = timed(lambda: Naive(ast, naive_out).call('main', []))
+        fast = timed(lambda: closures.Program(ast, fast_out).run())
+        if naive_out.getvalue() != fast_out.getvalue():
+            print(f"{name}: outputs differ, {naive_out.getvalue()!r} != {fast_out.getvalue()!r}")
+            sys.exit(1)
+        print(f"{name:<14}{naive:>10.3f}{fast:>12.3f}{naive / fast:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+""" Times the expression parser on long arithmetic chains.
+
+usage: python3 bench/expressions.py [terms] [expressions]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import parser as parse
+from lexer import tokenize
+
+
+def chain(rng, terms):
+    ops = ['+', '-', '*', '/', '<', '>', '&&', '||']
+    parts = [rng.choice(['a', 'b', 'count', str(rng.randint(0, 99))])]
+    for _ in range(terms - 1):
+        parts.append(rng.choice(ops))
+        parts.append(rng.choice(['a', 'b', 'count', str(rng.randint(0, 99)), '(a + 1)', '-b']))
+    return ' '.join(parts)
+
+
+def source(terms, expressions, seed=1):
+    rng = random.Random(seed)
+    body = ''.join(f"    x = {chain(rng, terms)};\n" for _ in range(expressions))
+    return f"int main() {{\n{body}    return x;\n}}\n"
+
+
+def count_calls(tokens):
+    """ Python function calls made while parsing, counted with a profile hook. """
+    calls = 0
+
+    def hook(frame, event, arg):
+        nonlocal calls
+        if event == 'call':
+            calls += 1
+
+    sys.setprofile(hook)
+    try:
+        parse.Parser(tokens).parse_program()
+    finally:
+        sys.setprofile(None)
+    return calls
+
+
+def main():
+    terms = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    expressions = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    tokens = tokenize(source(terms, expressions))
+
+    best = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        parse.Parser(tokens).parse_program()
+        best = min(best, time.perf_counter() - start)
+
+    calls = count_calls(tokens)
+    print(f"{expressions} expressions of {terms} terms, {len(tokens)} tokens")
+    print(f"parse: {best:.3f} s, {best / expressions * 1e6:.1f} us per expression")
+    print(f"calls: {calls / expressions:.0f} per expression")
+
+
+if __name__ == "__main__":
+    main()
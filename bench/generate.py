@@ -0,0 +1,149 @@
+""" Seeded generator of C triangle programs for the benchmarks.
+
+usage: python3 bench/generate.py [shape] [size] [seed] > out.ctri
+
+shapes: functions (many small functions), nesting (deeply nested blocks),
+expressions (long expressions), comments (heavy comments), mixed
+"""
+import random
+import sys
+
+SHAPES = ('functions', 'nesting', 'expressions', 'comments', 'mixed')
+
+TYPES = ['int', 'float', 'char', 'long', 'double']
+BINARY = ['+', '-', '*', '/', '<', '>', '<=', '>=', '&&', '||']
+WORDS = ['count', 'total', 'index', 'value', 'left', 'right', 'size', 'step']
+
+
+class Generator:
+    def __init__(self, shape, seed=1):
+        if shape not in SHAPES:
+            raise ValueError(f"unknown shape {shape!r}, expected one of {', '.join(SHAPES)}")
+        self.shape = shape
+        self.rng = random.Random(seed)
+        self.functions = 0
+        # how each shape leans, the rest of the generator is shared
+        self.terms = 40 if shape == 'expressions' else 6
+        self.depth = 40 if shape == 'nesting' else 3
+        self.statements = 2 if shape == 'functions' else 6
+        self.comment_rate = 0.8 if shape == 'comments' else 0.1
+        if shape == 'mixed':
+            self.terms, self.depth, self.statements, self.comment_rate = 12, 8, 4, 0.3
+
+    def name(self):
+        return self.rng.choice(WORDS) + str(self.rng.randint(0, 9))
+
+    def comment(self, pad):
+        rng = self.rng
+        if rng.random() >= self.comment_rate:
+            return ''
+        words = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        if rng.random() < 0.5:
+            return f"{pad}// {words}\n"
+        return f"{pad}/* {words}\n{pad}   {words} */\n"
+
+    def operand(self):
+        rng = self.rng
+        pick = rng.random()
+        if pick < 0.45:
+            return self.name()
+        if pick < 0.7:
+            return str(rng.randint(0, 1000))
+        if pick < 0.8:
+            return f"{rng.randint(0, 99)}.{rng.randint(0, 99)}"
+        if pick < 0.87:
+            return f"{self.name()}[{self.name()}]"
+        if pick < 0.94:
+            return f"f{rng.randint(0, max(self.functions - 1, 0))}({self.name()}, {rng.randint(0, 9)})"
+        return f"-{self.name()}"
+
+    def expression(self, terms=None):
+        rng = self.rng
+        terms = terms or rng.randint(1, self.terms)
+        parts = [self.operand()]
+        for _ in range(terms - 1):
+            parts.append(rng.choice(BINARY))
+            if rng.random() < 0.15:
+                parts.append(f"({self.operand()} {rng.choice(BINARY)} {self.operand()})")
+            else:
+                parts.append(self.operand())
+        return ' '.join(parts)
+
+    def simple(self, pad):
+        rng = self.rng
+        pick = rng.random()
+        if pick < 0.35:
+            return f"{pad}{rng.choice(TYPES)} {self.name()} = {self.expression()};\n"
+        if pick < 0.75:
+            return f"{pad}{self.name()} = {self.expression()};\n"
+        if pick < 0.9:
+            return f"{pad}{self.name()}++;\n"
+        return f"{pad}f{rng.randint(0, max(self.functions - 1, 0))}({self.expression(2)});\n"
+
+    def block(self, depth, pad):
+        rng = self.rng
+        out = []
+        nested = False
+        for _ in range(rng.randint(1, self.statements)):
+            out.append(self.comment(pad))
+            # deep nesting goes one block at a time, else it grows exponentially
+            if depth < self.depth and not (nested and self.shape == 'nesting') and rng.random() < (0.9 if self.shape == 'nesting' else 0.3):
+                nested = True
+                out.append(self.compound(depth + 1, pad))
+            else:
+                out.append(self.simple(pad))
+        return ''.join(out)
+
+    def compound(self, depth, pad):
+        rng = self.rng
+        inner = pad + '    '
+        body = self.block(depth, inner)
+        pick = rng.random()
+        if pick < 0.35:
+            text = f"{pad}if ({self.expression(3)}) {{\n{body}{pad}}}"
+            if rng.random() < 0.5:
+                # else blocks stay flat so nesting does not branch
+                text += f" else {{\n{self.block(self.depth, inner)}{pad}}}"
+            return text + "\n"
+        if pick < 0.65:
+            i = self.name()
+            return f"{pad}for (int {i} = 0; {i} < {self.operand()}; {i}++) {{\n{body}{pad}}}\n"
+        if pick < 0.85:
+            return f"{pad}while ({self.expression(3)}) {{\n{body}{pad}}}\n"
+        return f"{pad}{{\n{body}{pad}}}\n"
+
+    def function(self):
+        rng = self.rng
+        params = ', '.join(f"{rng.choice(TYPES)} {self.name()}" for _ in range(rng.randint(0, 4)))
+        name = f"f{self.functions}"
+        self.functions += 1
+        body = self.block(0, '    ')
+        return f"{self.comment('')}{rng.choice(TYPES)} {name}({params}) {{\n{body}    return {self.expression()};\n}}\n\n"
+
+    def program(self, size):
+        """ Source of at least size characters. """
+        out = []
+        length = 0
+        while length < size:
+            if self.rng.random() < 0.05:
+                text = f"{self.rng.choice(TYPES)} {self.name()} = {self.expression(2)};\n\n"
+            else:
+                text = self.function()
+            out.append(text)
+            length += len(text)
+        return ''.join(out)
+
+
+def generate(shape='mixed', size=100000, seed=1):
+    return Generator(shape, seed).program(size)
+
+
+def main():
+    shape = sys.argv[1] if len(sys.argv) > 1 else 'mixed'
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    sys.stdout.write(generate(shape, size, seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+""" Checks incremental.Document against lexing and parsing from scratch, then
+times an edit both ways.
+
+usage: python3 bench/incremental.py [size]
+
+The check makes random edits to generated sources, some that keep them
+valid (digits, whitespace and comments, declarations added and removed)
+and some that need not (quotes, comment starts, braces...), and after each
+one compares the document's tokens, program and error with tokenize and
+parse_program on the new source. The timing changes one digit in the
+middle of a generated source of size characters (default 2000000).
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import incremental
+import lexer
+import parser as parse
+from generate import generate
+
+FRAGMENTS = ['int x = 1;\n', 'long f(long a) { return a + 1; }\n', '}', '{', ';', '"', '/*', '*/', '1.5',
+             '.5', 'e', ' ', '\n', 'x', '(', ')', '//c\n', 'int', '1', '=', 'return 2;']
+DECLARATIONS = ['int g = 1;\n', 'long h(long a) { return a; }\n', '/* x */ ', '// c\n']
+
+
+def valid_edit(rng, document):
+    """ A new source, most likely still valid. """
+    source = document.source
+    match rng.randint(0, 3):
+        case 0:
+            at = rng.choice([m.start() for m in re.finditer(r'\d', source)])
+            return source[:at] + str(rng.randint(0, 9)) + source[at + 1:]
+        case 1:
+            at = document.tokens.starts[rng.choice(document.firsts)]
+            return source[:at] + rng.choice(DECLARATIONS) + source[at:]
+        case 2 if len(document.firsts) > 2:
+            d = rng.randrange(len(document.firsts) - 1)
+            start, end = document.firsts[d], document.firsts[d + 1]
+            return source[:document.tokens.starts[start]] + source[document.tokens.starts[end]:]
+    at = rng.choice([m.start() for m in re.finditer(' ', source)])
+    return source[:at] + rng.choice(['  ', '\n', ' /*y*/ ']) + source[at + 1:]
+
+
+def random_edit(rng, document):
+    source = document.source
+    start = rng.randint(0, len(source))
+    end = min(len(source), start + rng.choice([0, 0, 1, 3, 10]))
+    return source[:start] + ''.join(rng.choice(FRAGMENTS) for _ in range(rng.choice([0, 1, 1, 2]))) + source[end:]
+
+
+def parse_error(source):
+    """ The program of source and the message of its syntax error, one of them None. """
+    try:
+        return parse.Parser(lexer.tokenize(source)).parse_program(), None
+    except SyntaxError as error:
+        return None, str(error)
+
+
+def check(runs=200, seed=1):
+    rng = random.Random(seed)
+    edits = parsed = 0
+    for run in range(runs):
+        try:
+            document = incremental.Document(generate('mixed', rng.randint(200, 8000), seed=run))
+        except SyntaxError:
+            continue
+        edit = valid_edit if run % 2 else random_edit
+        for step in range(20):
+            source = edit(rng, document)
+            want, want_error = parse_error(source)
+            if edit is valid_edit and want_error is not None:
+                # valid_edit reads firsts, kept only while the source parses
+                continue
+            try:
+                document.update(source)
+                error = None
+            except SyntaxError as failed:
+                error = str(failed)
+            # an unchanged source is not parsed again, the program stays None
+            if document.program is None and error is None:
+                error = want_error
+            if list(document.tokens) != list(lexer.tokenize(source)):
+                print(f"run {run}, edit {step}: the tokens differ from tokenize")
+                sys.exit(1)
+            if error != want_error or want is not None and document.program != want:
+                print(f"run {run}, edit {step}: the program differs from parse_program ({error} / {want_error})")
+                sys.exit(1)
+            edits += 1
+            parsed += document.parsed if error is None else 0
+    print(f"{edits} edits of {runs} sources lex and parse the same, {parsed / edits:.1f} declarations parsed per edit")
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    check()
+    source = generate('mixed', size)
+    start = time.perf_counter()
+    document = incremental.Document(source)
+    middle = time.perf_counter()
+    at = source.index('1', len(source) // 2)
+    edited = source[:at] + '2' + source[at + 1:]
+    document.update(edited)
+    end = time.perf_counter()
+    if document.program != parse.Parser(lexer.tokenize(edited)).parse_program():
+        print("the edited source parses differently")
+        sys.exit(1)
+    print(f"{len(source):,} characters, {len(document.tokens):,} tokens: from scratch {middle - start:.2f} s, "
+          f"one edit {(end - middle) * 1000:.1f} ms ({document.lexed} tokens lexed, "
+          f"{document.parsed} declarations parsed), {(middle - start) / (end - middle):.0f}x")
+
+
+if __name__ == "__main__":
+    main()
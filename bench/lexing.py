@@ -0,0 +1,86 @@
+""" Checks lexer.tokenize_parallel and tokenize_bytes against tokenize, then
+times them.
+
+usage: python3 bench/lexing.py [size] [jobs]
+
+The check cuts random sources, full of strings, comments and quotes or
+comment starts that never close, at split_points into many pieces and
+compares the stitched tokens with the serial ones, lexes the ascii ones as
+bytes too, then does the same through the process pool. The timing lexes a
+generated source of size characters (default 8000000) on jobs processes
+(default one per core) and as bytes.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import lexer
+from generate import generate
+
+FRAGMENTS = ['int', ' x', '=', '1', '2.5', ';', '\n', '\n', ' ', '"', '"a\nb"', '/*', '*/', '//',
+             '/', '*', '"//"', '/* "\n */', 'while', '(', ')', '{', '}', 'é', '\t', 'a1', '.5', '++',
+             '\r\n', '\x1c', '\x0b', 'if_', 'int3']
+
+
+def random_source(rng):
+    return ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 400)))
+
+
+def stitched(source, count):
+    """ tokenize of source, lexed piece by piece in this process. """
+    bounds = [0] + lexer.split_points(source, count) + [len(source)]
+    return [list(zip(*lexer.lex_piece(source[start:end], start))) for start, end in zip(bounds, bounds[1:])]
+
+
+def check(runs=2000, seed=1):
+    rng = random.Random(seed)
+    for run in range(runs):
+        source = random_source(rng)
+        want = list(zip(*lexer.lex_arrays(source)))
+        got = [token for piece in stitched(source, rng.randint(2, 40)) for token in piece]
+        if got != want:
+            print(f"run {run}: pieces differ from the serial lexer on {source!r}")
+            sys.exit(1)
+        if source.isascii() and list(lexer.tokenize_bytes(source.encode())) != list(lexer.tokenize(source)):
+            print(f"run {run}: the bytes lexer differs from the serial lexer on {source!r}")
+            sys.exit(1)
+    # and through the pool, every source counts as large here
+    size, lexer.PARALLEL_SIZE = lexer.PARALLEL_SIZE, 0
+    try:
+        for run in range(20):
+            source = ''.join(random_source(rng) for _ in range(50))
+            if list(lexer.tokenize_parallel(source, 4)) != list(lexer.tokenize(source)):
+                print(f"pool run {run}: tokenize_parallel differs from tokenize")
+                sys.exit(1)
+    finally:
+        lexer.PARALLEL_SIZE = size
+    print(f"{runs} random sources and 20 through the pool lex the same in pieces and as bytes")
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 8000000
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+    check()
+    source = generate('mixed', size)
+    start = time.perf_counter()
+    serial = lexer.tokenize(source)
+    middle = time.perf_counter()
+    parallel = lexer.tokenize_parallel(source, jobs)
+    end = time.perf_counter()
+    data = source.encode()
+    start_bytes = time.perf_counter()
+    lexer.tokenize_bytes(data)
+    as_bytes = time.perf_counter() - start_bytes
+    if list(serial.kinds) != list(parallel.kinds) or list(serial.starts) != list(parallel.starts):
+        print("the generated source lexes differently in parallel")
+        sys.exit(1)
+    print(f"{len(source):,} characters, {len(serial):,} tokens: serial {middle - start:.2f} s, "
+          f"{jobs} processes {end - middle:.2f} s, {(middle - start) / (end - middle):.1f}x, "
+          f"as bytes {as_bytes:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+""" Times getting the declarations of a library with modules.load, from its
+precompiled module, against lexing and parsing the library.
+
+usage: python3 bench/modules.py [size] [rounds]
+
+The library is a generated source of size characters (default 1000000) in a
+temporary directory, with the module cache there too. The first load parses
+it and writes the module, the next rounds (default 20) only read the module;
+then the library is changed and the next load must see it.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import modules
+import parser as parse
+from generate import generate
+from lexer import tokenize
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as directory:
+        modules.MODULE_DIR = os.path.join(directory, 'modules')
+        path = os.path.join(directory, 'library.ctri')
+        source = generate('mixed', size)
+        with open(path, 'w') as file:
+            file.write(source)
+
+        start = time.perf_counter()
+        want = modules.interface(parse.Parser(tokenize(source)).parse_program())
+        parsed = time.perf_counter() - start
+        if modules.load(path) != want:
+            print("the first load differs from the interface of the source")
+            sys.exit(1)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            declarations = modules.load(path)
+        loaded = (time.perf_counter() - start) / rounds
+        if declarations != want:
+            print("the module differs from the interface of the source")
+            sys.exit(1)
+
+        with open(path, 'a') as file:
+            file.write('int added(int a) { return a; }\n')
+        if modules.load(path)[-1].name != 'added' or len(os.listdir(modules.MODULE_DIR)) != 1:
+            print("the module was not made again after the library changed")
+            sys.exit(1)
+    print(f"{len(source):,} characters, {len(want):,} declarations: parsed {parsed * 1000:.1f} ms, "
+          f"module {loaded * 1000:.2f} ms, {parsed / loaded:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
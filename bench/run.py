@@ -0,0 +1,180 @@
+""" Times lexing, parsing and printing on generated programs.
+
+usage: python3 bench/run.py [option...]
+
+      --shape NAME: only run this shape, can be given more than once
+      --size N: characters of source per shape (default 200000)
+      --seed N: generator seed (default 1)
+      --repeat N: timing runs per phase, the best one counts (default 5)
+      --tolerance F: allowed slowdown or memory growth (default 0.25)
+      --json: print the results as json
+      --update: store the results as the new baseline
+
+Exits with 1 when a phase is slower, or peaks higher, than the baseline
+allows. The baseline is bench/baseline.json, timings only compare on the
+machine that wrote it.
+"""
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+
+import parser as parse
+from generate import SHAPES, generate
+from lexer import EOF, get_tokens
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+
+def best_time(repeat, func, *args):
+    # like timeit, the collector stays off while timing
+    best = float('inf')
+    result = None
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func(*args)
+            best = min(best, time.perf_counter() - start)
+    finally:
+        if enabled:
+            gc.enable()
+    return best, result
+
+
+def peak(func, *args):
+    """ tracemalloc peak of one call, in bytes. """
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def parse_tokens(tokens):
+    return parse.Parser(tokens).parse_program()
+
+
+def measure(shape, size, seed, repeat):
+    source = generate(shape, size, seed)
+
+    lex_time, tokens = best_time(repeat, get_tokens, source)
+    tokens.append(EOF)
+    parse_time, ast = best_time(repeat, parse_tokens, tokens)
+    pretty_time, _ = best_time(repeat, parse.pretty, ast)
+    nodes = parse.count_nodes(ast)
+
+    return {
+        'bytes': len(source),
+        'tokens': len(tokens),
+        'nodes': nodes,
+        'lex_tokens_per_s': len(tokens) / lex_time,
+        'parse_nodes_per_s': nodes / parse_time,
+        'pretty_nodes_per_s': nodes / pretty_time,
+        'lex_peak': peak(get_tokens, source),
+        'parse_peak': peak(parse_tokens, tokens),
+        'pretty_peak': peak(parse.pretty, ast),
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """ Lines describing every metric that got worse than the baseline allows. """
+    found = []
+    for shape, metrics in results.items():
+        base = baseline.get(shape)
+        if base is None:
+            continue
+        for key, value in metrics.items():
+            if key not in base:
+                continue
+            if key.endswith('_per_s') and value < base[key] * (1 - tolerance):
+                found.append(f"{shape} {key}: {value:,.0f} < baseline {base[key]:,.0f}")
+            elif key.endswith('_peak') and value > base[key] * (1 + tolerance):
+                found.append(f"{shape} {key}: {value:,} > baseline {base[key]:,}")
+    return found
+
+
+def report(results):
+    print(f"{'shape':<12}{'tokens':>10}{'nodes':>10}{'lex tok/s':>14}{'parse node/s':>14}{'pretty node/s':>15}{'peak MB l/p/p':>20}")
+    for shape, m in results.items():
+        peaks = '/'.join(f"{m[key] / 1e6:.1f}" for key in ('lex_peak', 'parse_peak', 'pretty_peak'))
+        print(f"{shape:<12}{m['tokens']:>10,}{m['nodes']:>10,}{m['lex_tokens_per_s']:>14,.0f}"
+              f"{m['parse_nodes_per_s']:>14,.0f}{m['pretty_nodes_per_s']:>15,.0f}{peaks:>20}")
+
+
+def main():
+    shapes = []
+    size, seed, repeat, tolerance = 200000, 1, 5, 0.25
+    as_json = update = False
+    argv = sys.argv[1:]
+    i = 0
+    while i < len(argv):
+        match argv[i]:
+            case '--help' | '-h':
+                print(__doc__)
+                sys.exit(0)
+            case '--shape':
+                i += 1
+                shapes.append(argv[i])
+            case '--size':
+                i += 1
+                size = int(argv[i])
+            case '--seed':
+                i += 1
+                seed = int(argv[i])
+            case '--repeat':
+                i += 1
+                repeat = int(argv[i])
+            case '--tolerance':
+                i += 1
+                tolerance = float(argv[i])
+            case '--json':
+                as_json = True
+            case '--update':
+                update = True
+            case arg:
+                print(f"Error: unknown option {arg}")
+                sys.exit(1)
+        i += 1
+
+    # deep nesting recurses in the parser
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+    results = {shape: measure(shape, size, seed, repeat) for shape in shapes or SHAPES}
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+    if update:
+        with open(BASELINE, 'w') as file:
+            json.dump({'size': size, 'seed': seed, 'results': results}, file, indent=2)
+            file.write('\n')
+        print(f"baseline written to {BASELINE}")
+        return
+
+    try:
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        print("no baseline yet, run with --update to store one")
+        return
+    if (baseline['size'], baseline['seed']) != (size, seed):
+        print(f"baseline was taken with --size {baseline['size']} --seed {baseline['seed']}, not comparing")
+        return
+    found = regressions(results, baseline['results'], tolerance)
+    for line in found:
+        print(f"REGRESSION {line}")
+    if found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
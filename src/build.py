@@ -0,0 +1,332 @@
+""" Builds a project: the files given and everything they include, compiling
+only what changed since the last build.
+
+usage: python3 build.py [option...] file..
+
+  -I DIR: look for included files and libraries in DIR too (repeatable)
+  -B DIR: keep the outputs and the build database in DIR (default
+      hypotenuse-build)
+  -j N, --jobs N: compile up to N files at once (0, the default, for one per
+      core)
+  -O: run the optimization passes, as main.py -O
+  -a: write assembly (.s) instead of program files (.hb, main.py -o)
+  --force: compile every file again
+  -n, --dry-run: print what would be compiled and stop
+
+#include "file" is looked for next to the including file, then in the -I
+directories; #include <file> and using <library> (library.ctri) only in
+those, and next to the file for using. What is not found (stdio.h) is
+outside the project. A file is compiled again when its contents, those of
+anything it includes directly or not, the options or the compiler changed.
+Files are compiled after what they include, those that do not depend on
+each other at the same time. Files are named by their path from the
+directory that holds the build directory, in the database and below the
+build directory, so a build can be run from any directory.
+"""
+import hashlib
+import io
+import json
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, List, Set
+
+import cache
+import main as compiler
+from lexer import tokenize
+from modules import directives, locate
+
+BUILD_DIR = 'hypotenuse-build'
+DATABASE = 'build.json'
+# the database is dropped when its layout changes
+DATABASE_VERSION = 2
+
+@dataclass
+class Options:
+    files: List[str] = field(default_factory=list)
+    include_dirs: List[str] = field(default_factory=list)
+    build_dir: str = BUILD_DIR
+    jobs: int = os.cpu_count() or 1
+    optimize: bool = False
+    asm: bool = False
+    force: bool = False
+    dry_run: bool = False
+
+
+@dataclass
+class Unit:
+    """ One file of the project. """
+    path: str
+    hash: str
+    # (kind, name, quoted) of each #include and using, in order
+    directives: List[list]
+    deps: List[str] = field(default_factory=list)
+    # names nothing in the project provides
+    external: List[str] = field(default_factory=list)
+    key: str = ''
+
+
+def args(argv):
+    options = Options()
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+
+        def value():
+            nonlocal i
+            i += 1
+            if i >= len(argv):
+                print(f"Error: {arg} expects a value")
+                sys.exit(1)
+            return argv[i]
+
+        match arg:
+            case '--help' | '-h':
+                print(__doc__)
+                sys.exit(0)
+            case '-I':
+                options.include_dirs.append(value())
+            case '-B':
+                options.build_dir = value()
+            case '-j' | '--jobs':
+                options.jobs = compiler.jobs(value())
+            case '-O':
+                options.optimize = True
+            case '-a':
+                options.asm = True
+            case '--force':
+                options.force = True
+            case '-n' | '--dry-run':
+                options.dry_run = True
+            case _ if arg.startswith('-I'):
+                options.include_dirs.append(arg[2:])
+            case _ if arg.startswith('-j'):
+                options.jobs = compiler.jobs(arg[2:])
+            case _:
+                options.files.append(arg)
+        i += 1
+    return options
+
+
+def load_database(path):
+    try:
+        with open(path) as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if data.get('version') != DATABASE_VERSION:
+        return {}
+    return data.get('files', {})
+
+
+def save_database(path, entries):
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, 'w') as file:
+        json.dump({'version': DATABASE_VERSION, 'files': entries}, file, indent=2)
+        file.write('\n')
+    os.replace(temp, path)
+
+
+def build_root(options):
+    """ The directory file names are relative to, the one holding the build directory. """
+    return os.path.dirname(os.path.abspath(options.build_dir))
+
+
+def name_of(path, root):
+    return os.path.relpath(os.path.abspath(path), root)
+
+
+def scan(options, database, root):
+    """ Every file of the project by name, reached from options.files through
+    their directives. A file whose size and mtime are those in the database
+    is not read again.
+    """
+    units: Dict[str, Unit] = {}
+    work = [name_of(path, root) for path in options.files]
+    while work:
+        path = work.pop()
+        if path in units:
+            continue
+        source = os.path.join(root, path)
+        stat = os.stat(source)
+        entry = database.get(path)
+        if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            unit = Unit(path, entry['hash'], entry['directives'])
+        else:
+            with open(source, 'rb') as file:
+                data = file.read()
+            unit = Unit(path, hashlib.sha256(data).hexdigest(), directives(tokenize(data.decode())))
+        here = os.path.dirname(source)
+        for directive in unit.directives:
+            dep = locate(directive, here, options.include_dirs)
+            if dep is None:
+                unit.external.append(directive[1])
+                continue
+            dep = name_of(dep, root)
+            if dep not in unit.deps:
+                unit.deps.append(dep)
+                work.append(dep)
+        units[path] = unit
+    return units
+
+
+def reachable(units):
+    """ For each file, the files it includes directly or not. """
+    reach: Dict[str, Set[str]] = {}
+    for path in units:
+        seen = set()
+        work = list(units[path].deps)
+        while work:
+            dep = work.pop()
+            if dep not in seen:
+                seen.add(dep)
+                work += units[dep].deps
+        reach[path] = seen
+    return reach
+
+
+def settings(options):
+    """ What, besides the sources, the outputs depend on. """
+    return f"{cache.compiler_version()} optimize={options.optimize} asm={options.asm}"
+
+
+def output_path(options, path):
+    """ Where the output of the file named path goes, its name below the build directory. """
+    parts = [part if part != os.pardir else '__' for part in path.split(os.sep)]
+    return os.path.join(os.path.basename(os.path.abspath(options.build_dir)), *parts) + ('.s' if options.asm else '.hb')
+
+
+def compile_unit(path, output, optimize, asm, include_dirs=()):
+    """ Compiles one file to output, returns a diagnostic or None. Runs in a
+    worker process.
+    """
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    options = compiler.Options(files=[path], include_dirs=list(include_dirs), optimize=optimize, asm=asm,
+                               output=None if asm else output)
+    if asm:
+        with open(output, 'w') as out:
+            return compiler.compile_file(path, options, out)
+    return compiler.compile_file(path, options, io.StringIO())
+
+
+def build(options, out):
+    """ Brings the build directory up to date, returns how many files failed. """
+    os.makedirs(options.build_dir, exist_ok=True)
+    database_path = os.path.join(options.build_dir, DATABASE)
+    database = load_database(database_path)
+    root = build_root(options)
+    units = scan(options, database, root)
+    reach = reachable(units)
+    setting = settings(options)
+    for path, unit in units.items():
+        digest = hashlib.sha256(setting.encode())
+        digest.update(f"{path} {unit.hash} {' '.join(sorted(unit.external))}\n".encode())
+        for dep in sorted(reach[path]):
+            digest.update(f"{dep} {units[dep].hash} {' '.join(sorted(units[dep].external))}\n".encode())
+        unit.key = digest.hexdigest()
+
+    def entry(unit, key):
+        stat = os.stat(os.path.join(root, unit.path))
+        return {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': unit.hash,
+                'directives': unit.directives, 'key': key, 'output': output_path(options, unit.path)}
+
+    stale = []
+    entries = {}
+    for path, unit in units.items():
+        old = database.get(path)
+        if (not options.force and old is not None and old['key'] == unit.key
+                and os.path.exists(os.path.join(root, output_path(options, path)))):
+            entries[path] = entry(unit, unit.key)
+        else:
+            stale.append(path)
+            # the key is set once it compiles, one that fails is tried again next time
+            entries[path] = entry(unit, '')
+    if options.dry_run:
+        for path in stale:
+            out.write(f"would compile {path}\n")
+        return 0
+    # outputs of files no longer in the project, and of the other kind (.s
+    # or .hb) when -a changed since the last build
+    for path, old in database.items():
+        output = os.path.join(root, old['output'])
+        if (path not in units or old['output'] != output_path(options, path)) and os.path.exists(output):
+            os.remove(output)
+
+    pending = set(stale)
+    done: Set[str] = set()
+    failed: Set[str] = set()
+
+    def ready(path):
+        # a dependency in a cycle with path is compiled alongside it
+        return all(dep in done or dep not in pending or path in reach[dep] for dep in units[path].deps)
+
+    def blocked(path):
+        return any(dep in failed and path not in reach[dep] for dep in reach[path])
+
+    def finish(path, error):
+        pending.discard(path)
+        if error is None:
+            out.write(f"compiled {path}\n")
+            entries[path]['key'] = units[path].key
+            done.add(path)
+        else:
+            out.write(f"{path}: {error}\n")
+            failed.add(path)
+
+    def runnable():
+        for path in sorted(pending):
+            if blocked(path):
+                out.write(f"skipped {path}, what it includes failed\n")
+                pending.discard(path)
+                failed.add(path)
+        return [path for path in sorted(pending) if ready(path)]
+
+    try:
+        if options.jobs > 1 and len(stale) > 1:
+            with ProcessPoolExecutor(min(options.jobs, len(stale))) as pool:
+                running = {}
+                while pending or running:
+                    for path in runnable():
+                        if path not in running.values():
+                            future = pool.submit(compile_unit, os.path.join(root, path),
+                                                 os.path.join(root, output_path(options, path)),
+                                                 options.optimize, options.asm, options.include_dirs)
+                            running[future] = path
+                    if not running:
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        finish(running.pop(future), future.result())
+        else:
+            while pending:
+                paths = runnable()
+                if not paths:
+                    break
+                for path in paths:
+                    finish(path, compile_unit(os.path.join(root, path), os.path.join(root, output_path(options, path)),
+                                              options.optimize, options.asm, options.include_dirs))
+    finally:
+        save_database(database_path, entries)
+    out.write(f"{len(done)} compiled, {len(units) - len(stale)} up to date, {len(failed)} failed\n")
+    return len(failed)
+
+
+def run(argv, out):
+    options = args(argv)
+    if not options.files:
+        print("Usage: build.py [option...] file..")
+        return 1
+    for path in options.files:
+        if not os.path.isfile(path):
+            print(f"Error: file not found {path}")
+            return 1
+    return 1 if build(options, out) else 0
+
+
+def main():
+    sys.exit(run(sys.argv[1:], sys.stdout))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import pickle
+
+VERSION = "0.1"
+
+# cache entries live here, the least recently used ones go once it is too big
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "hypotenuse")
+CACHE_LIMIT = int(os.environ.get("HYPOTENUSE_CACHE_LIMIT", 256 * 1024 * 1024))
+# a running total of the entries' sizes, every store adds to it so the
+# directory is only listed (evict) once it passes the limit. concurrent
+# stores can lose an addition, evict writes the true total back
+SIZE_FILE = "size"
+
+_version = None
+
+
+def compiler_version():
+    """ VERSION plus a digest of the compiler sources, editing them drops old entries. """
+    global _version
+    if _version is None:
+        digest = hashlib.sha256(VERSION.encode())
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(here)):
+            if name.endswith(".py"):
+                with open(os.path.join(here, name), "rb") as file:
+                    digest.update(file.read())
+        _version = digest.hexdigest()
+    return _version
+
+
+def key(content):
+    """ Digest of the compiler and a source, a str or its utf-8 bytes. """
+    digest = hashlib.sha256(compiler_version().encode())
+    digest.update(content.encode() if type(content) is str else content)
+    return digest.hexdigest()
+
+
+def path(content):
+    return os.path.join(CACHE_DIR, key(content) + ".pickle")
+
+
+def load(content):
+    """ Returns (tokens, ast) cached for this source, or None. """
+    entry = path(content)
+    try:
+        with open(entry, "rb") as file:
+            tokens, ast = pickle.load(file)
+    except Exception:
+        # a truncated entry, or one whose classes moved, is a miss
+        return None
+    # mtime is the last use, that is what eviction goes by
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+    return tokens, ast
+
+
+def store(content, tokens, ast):
+    """ Saves the tokens and ast of a source, then trims the cache. """
+    entry = path(content)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        data = pickle.dumps((tokens, ast), pickle.HIGHEST_PROTOCOL)
+    except (OSError, RecursionError, pickle.PicklingError):
+        return
+    # written under a temporary name so a reader never sees half a file
+    temp = f"{entry}.{os.getpid()}.tmp"
+    try:
+        with open(temp, "wb") as file:
+            file.write(data)
+        os.replace(temp, entry)
+    except OSError:
+        return
+    total = read_size()
+    if total is None or total + len(data) > CACHE_LIMIT:
+        # down to three quarters, so the stores after this one have room
+        evict(CACHE_LIMIT * 3 // 4)
+    else:
+        write_size(total + len(data))
+
+
+def read_size():
+    try:
+        with open(os.path.join(CACHE_DIR, SIZE_FILE)) as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_size(total):
+    entry = os.path.join(CACHE_DIR, SIZE_FILE)
+    temp = f"{entry}.{os.getpid()}.tmp"
+    try:
+        with open(temp, "w") as file:
+            file.write(str(total))
+        os.replace(temp, entry)
+    except OSError:
+        pass
+
+
+def evict(limit=None):
+    """ Removes least recently used entries until the cache fits in limit bytes. """
+    limit = CACHE_LIMIT if limit is None else limit
+    entries = []
+    total = 0
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        if not name.endswith(".pickle"):
+            continue
+        try:
+            stat = os.stat(os.path.join(CACHE_DIR, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+        total += stat.st_size
+    entries.sort()
+    for _, size, name in entries:
+        if total <= limit:
+            break
+        try:
+            os.remove(os.path.join(CACHE_DIR, name))
+        except OSError:
+            continue
+        total -= size
+    write_size(total)
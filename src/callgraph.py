@@ -0,0 +1,222 @@
+from typing import Dict, Set
+
+from ir import Block, Instr
+from loops import Names, find_loops
+from ssa import phis
+
+# the call graph of a module and the passes built on it, over the ir in ssa
+# form. a function is recursive when it can reach itself through calls, a
+# leaf when it calls nothing. small functions that are not recursive are
+# inlined into their callers, callees first so what gets copied is already
+# inlined itself, and with a program's main the functions it can no longer
+# reach are dropped.
+
+# largest callee, in instructions, inlined by default, and how much larger one
+# called from inside a loop may be
+INLINE_SIZE = 32
+LOOP_FACTOR = 2
+# callers are not grown past this by inlining
+MAX_SIZE = 2000
+
+
+class CallGraph:
+    def __init__(self, module):
+        self.functions = {fn.name: fn for fn in module.functions}
+        # caller -> callee -> number of call sites, callees not defined in
+        # the module (printf...) included
+        self.calls: Dict[str, Dict[str, int]] = {name: {} for name in self.functions}
+        for fn in module.functions:
+            sites = self.calls[fn.name]
+            for block in fn.blocks:
+                for instr in block.instrs:
+                    if instr.op == 'call':
+                        sites[instr.label] = sites.get(instr.label, 0) + 1
+        self.components = self.strongly_connected()
+        self.recursive: Set[str] = set()
+        for component in self.components:
+            if len(component) > 1 or component[0] in self.calls[component[0]]:
+                self.recursive.update(component)
+
+    def callees(self, name):
+        """ Functions of the module name calls. """
+        return [callee for callee in self.calls[name] if callee in self.functions]
+
+    def leaves(self):
+        return [name for name, sites in self.calls.items() if not sites]
+
+    def reachable(self, root='main'):
+        seen = {root}
+        work = [root]
+        while work:
+            for callee in self.callees(work.pop()):
+                if callee not in seen:
+                    seen.add(callee)
+                    work.append(callee)
+        return seen
+
+    def strongly_connected(self):
+        """ The strongly connected components (Tarjan), callees before their callers. """
+        index, low = {}, {}
+        stack, on_stack = [], set()
+        components = []
+        for root in self.functions:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.callees(root)))]
+            while work:
+                name, callees = work[-1]
+                for callee in callees:
+                    if callee not in index:
+                        index[callee] = low[callee] = len(index)
+                        stack.append(callee)
+                        on_stack.add(callee)
+                        work.append((callee, iter(self.callees(callee))))
+                        break
+                    if callee in on_stack:
+                        low[name] = min(low[name], index[callee])
+                else:
+                    work.pop()
+                    if work:
+                        caller = work[-1][0]
+                        low[caller] = min(low[caller], low[name])
+                    if low[name] == index[name]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == name:
+                                break
+                        components.append(component)
+        return components
+
+
+def inlinable(callee):
+    """ True when callee can be copied into a call: its entry is not a loop
+    header (the params are read there) and it returns somewhere. """
+    entry = callee.blocks[0].label
+    if any(entry in block.successors() for block in callee.blocks):
+        return False
+    return any(block.instrs and block.instrs[-1].op == 'ret' for block in callee.blocks)
+
+
+def inline_call(fn, at, index, callee, prefix, names):
+    """ Replaces the call at instruction index of block number at of fn by a
+    copy of callee. The copy's blocks are labelled prefix.label, its named
+    values prefix.name and its temporaries get fresh ones.
+    """
+    block = fn.blocks[at]
+    call = block.instrs[index]
+    after = Block(f"after.{prefix}", block.instrs[index + 1:])
+    block.instrs = block.instrs[:index]
+    # the successors' phis now come from the block after the call
+    blocks = fn.block_map()
+    for target in after.successors():
+        for phi in phis(blocks[target]):
+            phi.targets = [after.label if pred == block.label else pred for pred in phi.targets]
+
+    renamed = {}
+
+    def rename(value):
+        if type(value) is not str:
+            return value
+        new = renamed.get(value)
+        if new is None:
+            new = renamed[value] = names.temp() if value.startswith('%') else f"{prefix}.{value}"
+        return new
+
+    copies = []
+    returns = []
+    for original in callee.blocks:
+        copy = Block(f"{prefix}.{original.label}")
+        for instr in original.instrs:
+            match instr.op:
+                case 'param':
+                    position = instr.args[0]
+                    value = call.args[position] if position < len(call.args) else 0
+                    copy.instrs.append(Instr('copy', rename(instr.dest), [value]))
+                case 'ret':
+                    returns.append((rename(instr.args[0]) if instr.args else 0, copy.label))
+                    copy.instrs.append(Instr('jmp', targets=[after.label]))
+                case _:
+                    # a phi's label is the variable it merges, a call's or an addr's is global
+                    label = rename(instr.label) if instr.op == 'phi' else instr.label
+                    copy.instrs.append(Instr(instr.op, rename(instr.dest), [rename(arg) for arg in instr.args],
+                                             label, [f"{prefix}.{target}" for target in instr.targets]))
+        copies.append(copy)
+    block.instrs.append(Instr('jmp', targets=[copies[0].label]))
+
+    if call.dest is not None:
+        if len(returns) == 1:
+            after.instrs.insert(0, Instr('copy', call.dest, [returns[0][0]]))
+        else:
+            values, preds = zip(*returns)
+            after.instrs.insert(0, Instr('phi', call.dest, list(values), label=call.dest, targets=list(preds)))
+    fn.blocks[at + 1:at + 1] = copies + [after]
+
+
+def inline(module, size=INLINE_SIZE):
+    """ Inlines the calls to small functions that are not recursive, returns the count. """
+    graph = CallGraph(module)
+    functions = graph.functions
+    count = 0
+    for component in graph.components:
+        for name in component:
+            fn = functions[name]
+            names = Names(fn)
+            sites = 0
+            changed = True
+            while changed:
+                changed = False
+                in_loops = set()
+                for loop in find_loops(fn):
+                    in_loops |= loop.blocks
+                for at, block in enumerate(fn.blocks):
+                    for index, instr in enumerate(block.instrs):
+                        if instr.op != 'call' or instr.label not in functions or instr.label in graph.recursive:
+                            continue
+                        callee = functions[instr.label]
+                        limit = size * LOOP_FACTOR if block.label in in_loops else size
+                        callee_size = callee.instr_count()
+                        if callee_size > limit or fn.instr_count() + callee_size > MAX_SIZE or not inlinable(callee):
+                            continue
+                        sites += 1
+                        inline_call(fn, at, index, callee, f"{callee.name}.{sites}", names)
+                        count += 1
+                        changed = True
+                        break
+                    if changed:
+                        break
+    return count
+
+
+def remove_dead(module, root='main'):
+    """ Drops the functions root can not reach, when the module defines root.
+    Only for a module that is the whole program: codegen makes every
+    function .globl, so in a file linked with others any of them may be
+    called from outside (there is no static to say otherwise).
+    """
+    graph = CallGraph(module)
+    if root not in graph.functions:
+        return 0
+    reachable = graph.reachable(root)
+    before = len(module.functions)
+    module.functions = [fn for fn in module.functions if fn.name in reachable]
+    return before - len(module.functions)
+
+
+def optimize(module, size=INLINE_SIZE, whole_program=False):
+    """ Inlines (size 0 turns it off) and, for a whole program, drops dead
+    functions, returns the module and counts for stats.
+    """
+    graph = CallGraph(module)
+    counts = {'functions': len(graph.functions), 'recursive_functions': len(graph.recursive),
+              'leaf_functions': len(graph.leaves()), 'calls_inlined': 0, 'functions_removed': 0}
+    if size > 0:
+        counts['calls_inlined'] = inline(module, size)
+    if whole_program:
+        counts['functions_removed'] = remove_dead(module)
+    return module, counts
@@ -0,0 +1,117 @@
+""" Sends a command line to the compile server (server.py) and prints its reply.
+
+usage: python3 client.py [option...] [file..]
+
+The options are main.py's. With no server listening the command runs here,
+like python3 main.py would. This file only imports what python starts with,
+so it costs no more than the interpreter itself.
+"""
+import os
+import socket
+import stat
+import struct
+import sys
+
+# requests and replies are frames: a tag byte, a 4 byte big endian length and
+# that many bytes. the request is b'r' with the working directory and the
+# arguments joined by NULs. the reply is b'o' (stdout) and b'e' (stderr)
+# frames as the output is made, then b'x' with the exit status
+HEADER = struct.Struct('>cI')
+# pid, uid and gid of the peer, as SO_PEERCRED gives them
+CREDENTIALS = struct.Struct('3i')
+
+
+def socket_path():
+    path = os.environ.get('HYPOTENUSE_SOCKET')
+    if path:
+        return path
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp', f"hypotenuse-{os.getuid()}.sock")
+
+
+def send_frame(sock, tag, payload):
+    sock.sendall(HEADER.pack(tag, len(payload)) + payload)
+
+
+def read_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("the server closed the connection")
+        data += chunk
+    return bytes(data)
+
+
+def read_frame(sock):
+    tag, size = HEADER.unpack(read_exactly(sock, HEADER.size))
+    return tag, read_exactly(sock, size)
+
+
+def owned(path):
+    """ Whether path is a socket of this user. Anybody can make the one in
+    /tmp first, what it says is only trusted when it is ours.
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+
+def connect(path):
+    """ A socket connected to the server, None when none of this user listens on path. """
+    if not owned(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        if hasattr(socket, 'SO_PEERCRED'):
+            # the path could have been swapped since it was looked at
+            _, uid, _ = CREDENTIALS.unpack(sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, CREDENTIALS.size))
+            if uid != os.getuid():
+                sock.close()
+                return None
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def forward(argv, path=None):
+    """ Runs argv on the server, returns its exit status or None without a
+    server. --watch runs here, it would keep the server from anyone else.
+    """
+    if '--watch' in argv:
+        return None
+    sock = connect(path or socket_path())
+    if sock is None:
+        return None
+    with sock:
+        send_frame(sock, b'r', '\0'.join([os.getcwd()] + argv).encode())
+        while True:
+            tag, payload = read_frame(sock)
+            if tag == b'o':
+                sys.stdout.buffer.write(payload)
+                sys.stdout.flush()
+            elif tag == b'e':
+                sys.stderr.buffer.write(payload)
+                sys.stderr.flush()
+            elif tag == b'x':
+                return int(payload)
+
+
+def main():
+    try:
+        status = forward(sys.argv[1:])
+    except ConnectionError as error:
+        print(f"Error: {error}", file=sys.stderr)
+        sys.exit(1)
+    if status is None:
+        # the slow way, what the server would have saved
+        import main as compiler
+        status = compiler.run(sys.argv[1:], sys.stdout)
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+import codecs
+import re
+import sys
+
+import structure
+from parser import (Function, Declaration, Compound, If, While, For, Return, ExprStmt,
+                    Binary, Unary, Literal, Var, Assignment, Call, ArrayAccess)
+
+# runs a program by turning each Function into nested python closures, once.
+#
+# names are bound by structure.resolve first: locals take the slot of their
+# symbol in the frame list of their function (slot 0 holds the return value,
+# so symbol.index + 1), globals theirs in the globals list, callees the
+# Compiled object of their function. a closure
+# for an expression takes the frame and gives the value, one for a statement
+# takes the frame and gives True once a return ran.
+#
+# values are python ints and floats, ints are not cut to 64 bits. memory is
+# words: malloc(n) gives a list of n // 8 zeros, so a[i] indexes the same
+# element the assembly backend would.
+
+
+class RunError(Exception):
+    pass
+
+
+def c_div(a, b):
+    # bools from comparisons count as ints
+    if type(a) is float or type(b) is float:
+        return a / b
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def c_mod(a, b):
+    return a - b * c_div(a, b)
+
+
+# ops on two closures, and on a closure and a constant, the common case of
+# i < 10 or n - 1 that saves a call per evaluation
+BINARY = {
+    '+': (lambda l, r: lambda f: l(f) + r(f), lambda l, c: lambda f: l(f) + c),
+    '-': (lambda l, r: lambda f: l(f) - r(f), lambda l, c: lambda f: l(f) - c),
+    '*': (lambda l, r: lambda f: l(f) * r(f), lambda l, c: lambda f: l(f) * c),
+    '/': (lambda l, r: lambda f: c_div(l(f), r(f)), lambda l, c: lambda f: c_div(l(f), c)),
+    '%': (lambda l, r: lambda f: c_mod(l(f), r(f)), lambda l, c: lambda f: c_mod(l(f), c)),
+    '<': (lambda l, r: lambda f: l(f) < r(f), lambda l, c: lambda f: l(f) < c),
+    '>': (lambda l, r: lambda f: l(f) > r(f), lambda l, c: lambda f: l(f) > c),
+    '<=': (lambda l, r: lambda f: l(f) <= r(f), lambda l, c: lambda f: l(f) <= c),
+    '>=': (lambda l, r: lambda f: l(f) >= r(f), lambda l, c: lambda f: l(f) >= c),
+    '==': (lambda l, r: lambda f: l(f) == r(f), lambda l, c: lambda f: l(f) == c),
+    '!=': (lambda l, r: lambda f: l(f) != r(f), lambda l, c: lambda f: l(f) != c),
+    '&': (lambda l, r: lambda f: l(f) & r(f), lambda l, c: lambda f: l(f) & c),
+    '|': (lambda l, r: lambda f: l(f) | r(f), lambda l, c: lambda f: l(f) | c),
+    '^': (lambda l, r: lambda f: l(f) ^ r(f), lambda l, c: lambda f: l(f) ^ c),
+    '<<': (lambda l, r: lambda f: l(f) << r(f), lambda l, c: lambda f: l(f) << c),
+    '>>': (lambda l, r: lambda f: l(f) >> r(f), lambda l, c: lambda f: l(f) >> c),
+    '&&': (lambda l, r: lambda f: bool(l(f) and r(f)), None),
+    '||': (lambda l, r: lambda f: bool(l(f) or r(f)), None),
+}
+
+# the same with a local on the left, i < n reads the slot straight away
+BINARY_SLOT = {
+    '+': (lambda i, r: lambda f: f[i] + r(f), lambda i, c: lambda f: f[i] + c),
+    '-': (lambda i, r: lambda f: f[i] - r(f), lambda i, c: lambda f: f[i] - c),
+    '*': (lambda i, r: lambda f: f[i] * r(f), lambda i, c: lambda f: f[i] * c),
+    '<': (lambda i, r: lambda f: f[i] < r(f), lambda i, c: lambda f: f[i] < c),
+    '>': (lambda i, r: lambda f: f[i] > r(f), lambda i, c: lambda f: f[i] > c),
+    '<=': (lambda i, r: lambda f: f[i] <= r(f), lambda i, c: lambda f: f[i] <= c),
+    '>=': (lambda i, r: lambda f: f[i] >= r(f), lambda i, c: lambda f: f[i] >= c),
+}
+
+UNARY = {
+    '-': lambda e: lambda f: -e(f),
+    '+': lambda e: e,
+    '!': lambda e: lambda f: not e(f),
+    '~': lambda e: lambda f: ~e(f),
+}
+
+
+def printf_format(fmt):
+    # python % knows the conversions but not the C length modifiers
+    return re.sub(r'%([-+ #0]*\d*(?:\.\d+)?)(?:hh|h|ll|l|z|j|t)?([diouxXeEfgGcs%])', r'%\1\2', fmt)
+
+
+class Builtins:
+    """ The C library functions a program may call, writing to out. """
+    NAMES = ('printf', 'puts', 'putchar', 'malloc', 'calloc', 'free')
+
+    def __init__(self, out):
+        self.out = out
+
+    def printf(self, fmt, *args):
+        text = printf_format(fmt) % args
+        self.out.write(text)
+        return len(text)
+
+    def puts(self, text):
+        self.out.write(text + "\n")
+        return 0
+
+    def putchar(self, char):
+        self.out.write(chr(char))
+        return char
+
+    def malloc(self, size):
+        return [0] * (size // 8)
+
+    def calloc(self, count, size):
+        return [0] * (count * size // 8)
+
+    def free(self, pointer):
+        return 0
+
+
+class Compiled:
+    """ A translated function, call(*args) runs it. """
+    __slots__ = ('name', 'call')
+
+    def __init__(self, name):
+        self.name = name
+        self.call = None
+
+
+class FunctionTranslator:
+    def __init__(self, program, function):
+        self.program = program
+        self.function = function
+
+    def local(self, var):
+        """ Frame slot of a param or local, None for a global. """
+        symbol = var.binding
+        # slot 0 is the return value
+        return symbol.index + 1 if symbol.kind in ('param', 'local') else None
+
+    def translate(self):
+        fn = self.function
+        body = self.statement(fn.body)
+        size = len(fn.frame.symbols) + 1
+        count = len(fn.frame.params)
+        name = fn.name
+
+        def call(*args):
+            if len(args) != count:
+                raise RunError(f"{name} takes {count} arguments, got {len(args)}")
+            frame = [0] * size
+            frame[1:count + 1] = args
+            body(frame)
+            return frame[0]
+        return call
+
+    # statements
+    def block(self, stmts):
+        parts = [self.statement(stmt) for stmt in stmts]
+        if not parts:
+            return lambda f: False
+        if len(parts) == 1:
+            return parts[0]
+        if len(parts) == 2:
+            first, second = parts
+            return lambda f: first(f) or second(f)
+
+        def run(f):
+            for part in parts:
+                if part(f):
+                    return True
+            return False
+        return run
+
+    def statement(self, node):
+        match node:
+            case Compound():
+                return self.block(node.stmts)
+            case Declaration():
+                value = self.expression(node.initializer) if node.initializer is not None else None
+                slot = node.binding.index + 1
+                if value is None:
+                    def run(f):
+                        f[slot] = 0
+                        return False
+                    return run
+                def run(f):
+                    f[slot] = value(f)
+                    return False
+                return run
+            case ExprStmt():
+                if node.expr is None:
+                    return lambda f: False
+                expr = self.expression(node.expr)
+                def run(f):
+                    expr(f)
+                    return False
+                return run
+            case Return():
+                if node.expr is None:
+                    return lambda f: True
+                expr = self.expression(node.expr)
+                def run(f):
+                    f[0] = expr(f)
+                    return True
+                return run
+            case If():
+                cond = self.expression(node.cond)
+                then = self.statement(node.then_branch)
+                if node.else_branch is None:
+                    return lambda f: then(f) if cond(f) else False
+                other = self.statement(node.else_branch)
+                return lambda f: then(f) if cond(f) else other(f)
+            case While():
+                cond = self.expression(node.cond)
+                body = self.statement(node.body)
+                def run(f):
+                    while cond(f):
+                        if body(f):
+                            return True
+                    return False
+                return run
+            case For():
+                if isinstance(node.init, Declaration):
+                    init = self.statement(node.init)
+                elif node.init is not None:
+                    init = self.statement(ExprStmt(expr=node.init))
+                else:
+                    init = lambda f: False
+                cond = self.expression(node.cond) if node.cond is not None else (lambda f: True)
+                post = self.expression(node.post) if node.post is not None else (lambda f: None)
+                body = self.statement(node.body)
+                def run(f):
+                    init(f)
+                    while cond(f):
+                        if body(f):
+                            return True
+                        post(f)
+                    return False
+                return run
+        raise RunError(f"cannot run statement {type(node).__name__}")
+
+    # expressions
+    def expression(self, node):
+        match node:
+            case Literal():
+                value = constant(node)
+                return lambda f: value
+            case Var():
+                slot = self.local(node)
+                if slot is not None:
+                    return lambda f: f[slot]
+                if node.binding.kind == 'global':
+                    store, index = self.program.global_slot(node.binding)
+                    return lambda f: store[index]
+                raise RunError(f"{self.function.name}: function {node.name} used as a value")
+            case Binary(op='?:'):
+                cond = self.expression(node.left)
+                then = self.expression(node.right.left)
+                other = self.expression(node.right.right)
+                return lambda f: then(f) if cond(f) else other(f)
+            case Binary():
+                if node.op not in BINARY:
+                    raise RunError(f"operator {node.op} is not supported")
+                general, with_constant = BINARY[node.op]
+                right_constant = isinstance(node.right, Literal) and with_constant is not None
+                slot = self.local(node.left) if isinstance(node.left, Var) else None
+                if slot is not None and node.op in BINARY_SLOT:
+                    general, with_constant = BINARY_SLOT[node.op]
+                    if right_constant:
+                        return with_constant(slot, constant(node.right))
+                    return general(slot, self.expression(node.right))
+                left = self.expression(node.left)
+                if right_constant:
+                    return with_constant(left, constant(node.right))
+                return general(left, self.expression(node.right))
+            case Unary(op='++' | '--'):
+                return self.step(node)
+            case Unary():
+                return UNARY[node.op](self.expression(node.operand))
+            case Assignment():
+                return self.assignment(node.target, self.expression(node.value))
+            case Call():
+                return self.call(node)
+            case ArrayAccess():
+                array = self.expression(node.array)
+                index = self.expression(node.index)
+                return lambda f: array(f)[index(f)]
+        raise RunError(f"cannot run expression {type(node).__name__}")
+
+    def assignment(self, target, value):
+        match target:
+            case Var():
+                slot = self.local(target)
+                if slot is not None:
+                    def assign(f):
+                        f[slot] = result = value(f)
+                        return result
+                    return assign
+                if target.binding.kind == 'global':
+                    store, index = self.program.global_slot(target.binding)
+                    def assign(f):
+                        store[index] = result = value(f)
+                        return result
+                    return assign
+                raise RunError(f"{self.function.name}: cannot assign to function {target.name}")
+            case ArrayAccess():
+                array = self.expression(target.array)
+                index = self.expression(target.index)
+                def assign(f):
+                    array(f)[index(f)] = result = value(f)
+                    return result
+                return assign
+        raise RunError(f"cannot assign to {type(target).__name__}")
+
+    def step(self, node):
+        delta = 1 if node.op == '++' else -1
+        target = node.operand
+        slot = self.local(target) if isinstance(target, Var) else None
+        if slot is not None:
+            if node.prefix:
+                def run(f):
+                    f[slot] = value = f[slot] + delta
+                    return value
+            else:
+                def run(f):
+                    value = f[slot]
+                    f[slot] = value + delta
+                    return value
+            return run
+        if isinstance(target, Var) and target.binding.kind == 'global':
+            store, index = self.program.global_slot(target.binding)
+            def run(f):
+                old = store[index]
+                store[index] = new = old + delta
+                return new if node.prefix else old
+            return run
+        if isinstance(target, ArrayAccess):
+            # the array and index are evaluated once, like C does
+            array = self.expression(target.array)
+            index = self.expression(target.index)
+            def run(f):
+                items, at = array(f), index(f)
+                old = items[at]
+                items[at] = new = old + delta
+                return new if node.prefix else old
+            return run
+        raise RunError(f"cannot apply {node.op} to {type(target).__name__}")
+
+    def call(self, node):
+        if not isinstance(node.callee, Var):
+            raise RunError("only named functions can be called")
+        name = node.callee.name
+        args = [self.expression(arg) for arg in node.args]
+        target = self.program.functions.get(name)
+        if target is None:
+            if name not in Builtins.NAMES:
+                raise RunError(f"call to undefined function {name}")
+            builtin = getattr(self.program.builtins, name)
+            return lambda f: builtin(*[arg(f) for arg in args])
+        # target.call is looked up when called, functions defined later are not translated yet
+        match args:
+            case []:
+                return lambda f: target.call()
+            case [a]:
+                return lambda f: target.call(a(f))
+            case [a, b]:
+                return lambda f: target.call(a(f), b(f))
+            case [a, b, c]:
+                return lambda f: target.call(a(f), b(f), c(f))
+        return lambda f: target.call(*[arg(f) for arg in args])
+
+
+def constant(node):
+    value = node.value
+    if type(value) is str:
+        if value.startswith("'"):
+            return ord(codecs.decode(value[1:-1], 'unicode_escape'))
+        return codecs.decode(value[1:-1], 'unicode_escape')
+    return value
+
+
+class Program:
+    """ A translated Program, run() calls its main. """
+    def __init__(self, ast, out=None):
+        self.builtins = Builtins(out if out is not None else sys.stdout)
+        self.functions = {}
+        self.globals = []
+        # indexes of globals only declared extern, defined in a file that is not linked in
+        self.undefined = set()
+        initializers = []
+        structure.resolve(ast)
+        for decl in ast.declarations:
+            if isinstance(decl, Function):
+                self.functions[decl.name] = Compiled(decl.name)
+            elif isinstance(decl, Declaration) and decl.binding.kind == 'global':
+                if decl.binding.index == len(self.globals):
+                    self.globals.append(0)
+                    if decl.var_type.endswith('(extern)'):
+                        self.undefined.add(decl.binding.index)
+                if not decl.var_type.endswith('(extern)'):
+                    self.undefined.discard(decl.binding.index)
+                if decl.initializer is not None:
+                    initializers.append((decl.name, decl.binding.index, decl.initializer))
+        for decl in ast.declarations:
+            if isinstance(decl, Function):
+                self.functions[decl.name].call = FunctionTranslator(self, decl).translate()
+        # global initializers run once, in order, before main, each as the
+        # body of a function of its own that has no locals
+        for name, index, init in initializers:
+            value = FunctionTranslator(self, Function('int', name, [], Compound([]))).expression(init)
+            self.globals[index] = value([0])
+
+    def global_slot(self, binding):
+        """ The store and index of a global. """
+        if binding.index in self.undefined:
+            raise RunError(f"{binding.name} is extern and not defined here")
+        return self.globals, binding.index
+
+    def run(self, entry='main', *args):
+        function = self.functions.get(entry)
+        if function is None:
+            raise RunError(f"no function {entry} to run")
+        # every C call is a handful of python calls deep
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 100000))
+        try:
+            result = function.call(*args)
+            # comparisons give python bools, C callers expect 0 or 1
+            return int(result) if type(result) is bool else result
+        except (ArithmeticError, IndexError, TypeError, RecursionError) as error:
+            raise RunError(f"{type(error).__name__}: {error}") from error
+        finally:
+            sys.setrecursionlimit(limit)
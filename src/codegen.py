@@ -0,0 +1,416 @@
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Optional
+
+import ssa
+from ir import liveness
+
+# x86-64 assembly (gnu as, intel syntax, system v calls) from the ir.
+#
+# values live in registers picked by linear scan: the live range of every value
+# is flattened to one interval over the instruction order, intervals are handed
+# registers in order of their start and the one ending last goes to the stack
+# when there are none left. rax, rcx, rdx, r10 and r11 are never handed out,
+# the instructions use them as scratch (division, shifts, returns, spills)
+
+ARG_REGS = ['rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9']
+# kept across calls, a function saves the ones it uses
+CALLEE_SAVED = ['rbx', 'r12', 'r13', 'r14', 'r15']
+# clobbered by calls, only for values that are not live across one
+CALLER_SAVED = ['rsi', 'rdi', 'r8', 'r9']
+
+BINARY = {'add': 'add', 'sub': 'sub', 'and': 'and', 'or': 'or', 'xor': 'xor'}
+SHIFTS = {'shl': 'sal', 'shr': 'sar'}
+COMPARES = {'lt': 'l', 'gt': 'g', 'le': 'le', 'ge': 'ge', 'eq': 'e', 'ne': 'ne'}
+NEGATED = {'l': 'ge', 'g': 'le', 'le': 'g', 'ge': 'l', 'e': 'ne', 'ne': 'e'}
+
+
+@dataclass(slots=True)
+class Interval:
+    value: str
+    start: int
+    end: int
+    crosses_call: bool = False
+    reg: Optional[str] = None
+    slot: Optional[int] = None
+
+
+def intervals(fn):
+    """ One Interval per value, instructions are numbered 0, 2, 4... in block order. """
+    live_in, live_out = liveness(fn)
+    ranges = {}
+    calls = []
+
+    def cover(value, pos):
+        span = ranges.get(value)
+        if span is None:
+            ranges[value] = [pos, pos]
+        elif pos < span[0]:
+            span[0] = pos
+        elif pos > span[1]:
+            span[1] = pos
+
+    # the params are moved into place all at once, so they all overlap
+    params = sum(instr.op == 'param' for instr in fn.blocks[0].instrs)
+    pos = 0
+    for block in fn.blocks:
+        first = pos
+        for instr in block.instrs:
+            for value in instr.uses():
+                cover(value, pos)
+            if instr.dest is not None:
+                cover(instr.dest, pos)
+            if instr.op == 'param':
+                cover(instr.dest, 0)
+                cover(instr.dest, 2 * params - 2)
+            if instr.op == 'call':
+                calls.append(pos)
+            pos += 2
+        for value in live_in[block.label]:
+            cover(value, first)
+        for value in live_out[block.label]:
+            cover(value, pos - 2)
+
+    result = {}
+    for value, (start, end) in ranges.items():
+        # a call strictly inside the interval clobbers the caller saved registers
+        index = bisect_right(calls, start)
+        crosses = index < len(calls) and calls[index] < end
+        result[value] = Interval(value, start, end, crosses)
+    return result
+
+
+def allocate(ranges):
+    """ Linear scan, gives every Interval a reg or a stack slot, returns the slot count. """
+    active = []
+    free = set(CALLER_SAVED + CALLEE_SAVED)
+    slots = 0
+    for interval in sorted(ranges.values(), key=lambda interval: (interval.start, interval.end)):
+        still = []
+        for old in active:
+            if old.end < interval.start:
+                free.add(old.reg)
+            else:
+                still.append(old)
+        active = still
+        pool = CALLEE_SAVED if interval.crosses_call else CALLER_SAVED + CALLEE_SAVED
+        reg = next((reg for reg in pool if reg in free), None)
+        if reg is not None:
+            interval.reg = reg
+            free.discard(reg)
+            active.append(interval)
+            continue
+        # no register left, whichever of the candidates ends last is spilled
+        victim = max((old for old in active if old.reg in pool), key=lambda old: old.end, default=None)
+        if victim is not None and victim.end > interval.end:
+            interval.reg, victim.reg = victim.reg, None
+            victim.slot = slots
+            active.remove(victim)
+            active.append(interval)
+        else:
+            interval.slot = slots
+        slots += 1
+    return slots
+
+
+def is_memory(operand):
+    return operand.endswith(']')
+
+
+def fits_imm32(value):
+    return -2**31 <= value < 2**31
+
+
+class FunctionGen:
+    """ Assembly of one IRFunction. """
+    def __init__(self, fn, module, strings):
+        self.fn = fn
+        self.defined = {other.name for other in module.functions}
+        self.strings = strings
+        self.lines = []
+        self.ranges = intervals(fn)
+        slots = allocate(self.ranges)
+        used = {interval.reg for interval in self.ranges.values()}
+        self.saved = [reg for reg in CALLEE_SAVED if reg in used]
+        # rsp stays 16 byte aligned between instructions, calls rely on it
+        self.frame = 8 * slots
+        if (8 * len(self.saved) + self.frame) % 16:
+            self.frame += 8
+
+    # operands
+    def loc(self, value):
+        interval = self.ranges[value]
+        if interval.reg is not None:
+            return interval.reg
+        return f"qword ptr [rbp - {8 * len(self.saved) + 8 * (interval.slot + 1)}]"
+
+    def operand(self, value, scratch='r10'):
+        """ value as a source operand, constants that do not fit 32 bits go through scratch. """
+        if type(value) is int:
+            if fits_imm32(value):
+                return str(value)
+            self.line(f"mov {scratch}, {value}")
+            return scratch
+        return self.loc(value)
+
+    def label(self, name):
+        return f".L{self.fn.name}_{name}"
+
+    def line(self, text):
+        self.lines.append(f"    {text}")
+
+    def move(self, dest, value):
+        source = self.operand(value, 'r11')
+        if dest == source:
+            return
+        if is_memory(dest) and is_memory(source):
+            self.line(f"mov r11, {source}")
+            source = 'r11'
+        self.line(f"mov {dest}, {source}")
+
+    def into(self, reg, value):
+        """ Loads value into a register. """
+        if type(value) is int:
+            self.line(f"mov {reg}, {value}")
+        elif self.loc(value) != reg:
+            self.line(f"mov {reg}, {self.loc(value)}")
+
+    # function
+    def generate(self):
+        fn = self.fn
+        self.lines += [f"    .globl {fn.name}", f"    .type {fn.name}, @function", f"{fn.name}:"]
+        self.line("push rbp")
+        self.line("mov rbp, rsp")
+        for reg in self.saved:
+            self.line(f"push {reg}")
+        if self.frame:
+            self.line(f"sub rsp, {self.frame}")
+
+        blocks = fn.blocks
+        pos = 0
+        for index, block in enumerate(blocks):
+            following = blocks[index + 1].label if index + 1 < len(blocks) else None
+            if index:
+                self.lines.append(f"{self.label(block.label)}:")
+            instrs = block.instrs
+            i = 0
+            while i < len(instrs):
+                instr = instrs[i]
+                if instr.op == 'param':
+                    # every param at once, they arrive in registers the
+                    # allocator may have handed to other params
+                    params = []
+                    while i < len(instrs) and instrs[i].op == 'param':
+                        params.append(instrs[i])
+                        i += 1
+                        pos += 2
+                    self.params(params)
+                    continue
+                nxt = instrs[i + 1] if i + 1 < len(instrs) else None
+                if (instr.op in COMPARES and nxt is not None and nxt.op == 'br' and nxt.args[0] == instr.dest
+                        and self.ranges[instr.dest].end == pos + 2):
+                    # a compare only feeding the branch after it becomes cmp and jcc
+                    self.compare(instr.args)
+                    self.branch(COMPARES[instr.op], nxt.targets, following)
+                    i += 2
+                    pos += 4
+                    continue
+                self.instr(instr, following, index == len(blocks) - 1)
+                i += 1
+                pos += 2
+
+        self.lines.append(f"{self.label('ret')}:")
+        if self.saved:
+            self.line(f"lea rsp, [rbp - {8 * len(self.saved)}]")
+            for reg in reversed(self.saved):
+                self.line(f"pop {reg}")
+        elif self.frame:
+            self.line("mov rsp, rbp")
+        self.line("pop rbp")
+        self.line("ret")
+        self.lines.append(f"    .size {fn.name}, .-{fn.name}")
+        return self.lines
+
+    def params(self, params):
+        register = [param for param in params if param.args[0] < len(ARG_REGS)]
+        # pushing them all first and popping into place never overwrites one still to be read
+        for param in register:
+            self.line(f"push {ARG_REGS[param.args[0]]}")
+        for param in reversed(register):
+            self.line(f"pop {self.loc(param.dest)}")
+        for param in params[len(register):]:
+            # the seventh on are on the stack above the return address
+            self.line(f"mov r11, qword ptr [rbp + {16 + 8 * (param.args[0] - len(ARG_REGS))}]")
+            self.line(f"mov {self.loc(param.dest)}, r11")
+
+    def compare(self, args):
+        left, right = args
+        if type(left) is str and not is_memory(self.loc(left)):
+            self.line(f"cmp {self.loc(left)}, {self.operand(right)}")
+            return
+        self.into('r11', left)
+        self.line(f"cmp r11, {self.operand(right)}")
+
+    def branch(self, cond, targets, following):
+        true, false = targets
+        if true == following:
+            self.line(f"j{NEGATED[cond]} {self.label(false)}")
+            return
+        self.line(f"j{cond} {self.label(true)}")
+        if false != following:
+            self.line(f"jmp {self.label(false)}")
+
+    def instr(self, instr, following, last):
+        op, args = instr.op, instr.args
+        dest = self.loc(instr.dest) if instr.dest is not None else None
+        if op in ('const', 'copy'):
+            self.move(dest, args[0])
+        elif op in BINARY:
+            right = self.operand(args[1])
+            if not is_memory(dest) and dest != right:
+                self.into(dest, args[0])
+                self.line(f"{BINARY[op]} {dest}, {right}")
+            else:
+                self.into('r11', args[0])
+                self.line(f"{BINARY[op]} r11, {right}")
+                self.line(f"mov {dest}, r11")
+        elif op == 'mul':
+            right = self.operand(args[1])
+            self.into('r11', args[0])
+            if right.lstrip('-').isdigit():
+                self.line(f"imul r11, r11, {right}")
+            else:
+                self.line(f"imul r11, {right}")
+            self.line(f"mov {dest}, r11")
+        elif op in ('div', 'mod'):
+            self.into('rax', args[0])
+            right = args[1]
+            if type(right) is int:
+                self.line(f"mov r10, {right}")
+                divisor = 'r10'
+            else:
+                divisor = self.loc(right)
+            self.line("cqo")
+            self.line(f"idiv {divisor}")
+            self.line(f"mov {dest}, {'rax' if op == 'div' else 'rdx'}")
+        elif op in SHIFTS:
+            right = args[1]
+            if type(right) is int:
+                count = str(right & 63)
+            else:
+                self.line(f"mov rcx, {self.loc(right)}")
+                count = 'cl'
+            self.into('r11', args[0])
+            self.line(f"{SHIFTS[op]} r11, {count}")
+            self.line(f"mov {dest}, r11")
+        elif op in COMPARES:
+            self.compare(args)
+            self.line(f"set{COMPARES[op]} al")
+            self.line("movzx eax, al")
+            self.line(f"mov {dest}, rax")
+        elif op in ('neg', 'bnot'):
+            self.into('r11', args[0])
+            self.line(f"{'neg' if op == 'neg' else 'not'} r11")
+            self.line(f"mov {dest}, r11")
+        elif op == 'not':
+            self.into('r11', args[0])
+            self.line("test r11, r11")
+            self.line("sete al")
+            self.line("movzx eax, al")
+            self.line(f"mov {dest}, rax")
+        elif op == 'load':
+            self.into('r11', args[0])
+            self.line("mov r11, qword ptr [r11]")
+            self.line(f"mov {dest}, r11")
+        elif op == 'store':
+            self.into('r11', args[0])
+            value = self.operand(args[1])
+            if is_memory(value):
+                self.line(f"mov r10, {value}")
+                value = 'r10'
+            self.line(f"mov qword ptr [r11], {value}")
+        elif op in ('addr', 'str'):
+            name = instr.label if op == 'addr' else self.string(instr.label)
+            if is_memory(dest):
+                self.line(f"lea r11, [rip + {name}]")
+                self.line(f"mov {dest}, r11")
+            else:
+                self.line(f"lea {dest}, [rip + {name}]")
+        elif op == 'call':
+            self.call(instr, dest)
+        elif op == 'jmp':
+            if instr.targets[0] != following:
+                self.line(f"jmp {self.label(instr.targets[0])}")
+        elif op == 'br':
+            cond = args[0]
+            if type(cond) is int:
+                target = instr.targets[0] if cond else instr.targets[1]
+                if target != following:
+                    self.line(f"jmp {self.label(target)}")
+                return
+            where = self.loc(cond)
+            if is_memory(where):
+                self.line(f"cmp {where}, 0")
+            else:
+                self.line(f"test {where}, {where}")
+            self.branch('ne', instr.targets, following)
+        elif op == 'ret':
+            if args:
+                self.into('rax', args[0])
+            if not last:
+                self.line(f"jmp {self.label('ret')}")
+        else:
+            raise ValueError(f"no code for ir op {op}")
+
+    def call(self, instr, dest):
+        args = instr.args
+        stack = args[len(ARG_REGS):]
+        registers = args[:len(ARG_REGS)]
+        pad = 8 if len(stack) % 2 else 0
+        if pad:
+            self.line("sub rsp, 8")
+        for value in reversed(stack):
+            self.line(f"push {self.operand(value)}")
+        sources = {self.loc(value) for value in registers if type(value) is str}
+        if sources.isdisjoint(ARG_REGS):
+            for reg, value in zip(ARG_REGS, registers):
+                self.into(reg, value)
+        else:
+            # through the stack, so no argument is overwritten before it is read
+            for value in registers:
+                self.line(f"push {self.operand(value)}")
+            for reg in reversed(ARG_REGS[:len(registers)]):
+                self.line(f"pop {reg}")
+        # variadic callees read the number of vector registers used from al
+        self.line("xor eax, eax")
+        name = instr.label
+        self.line(f"call {name}" if name in self.defined else f"call {name}@PLT")
+        if stack or pad:
+            self.line(f"add rsp, {8 * len(stack) + pad}")
+        if dest is not None:
+            self.line(f"mov {dest}, rax")
+
+    def string(self, literal):
+        label = self.strings.get(literal)
+        if label is None:
+            label = self.strings[literal] = f".LC{len(self.strings)}"
+        return label
+
+
+def generate(module):
+    """ Assembly text of a whole ir.Module, ssa form or not. """
+    ssa.destruct(module)
+    strings = {}
+    lines = ["    .intel_syntax noprefix", "    .text"]
+    for fn in module.functions:
+        lines += FunctionGen(fn, module, strings).generate()
+    if module.globals:
+        lines.append("    .data")
+        for name, value in module.globals.items():
+            lines += [f"    .globl {name}", "    .align 8", f"{name}:", f"    .quad {value}"]
+    if strings:
+        lines.append("    .section .rodata")
+        for literal, label in strings.items():
+            lines += [f"{label}:", f"    .string {literal}"]
+    lines.append('    .section .note.GNU-stack,"",@progbits')
+    return "\n".join(lines) + "\n"
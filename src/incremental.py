@@ -0,0 +1,211 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from typing import Optional
+
+from lexer import KindIds, Keywords, Master, TokenArray, tokenize
+from parser import Parser, Program
+
+# lexing and parsing again after an edit, only as far as the edit reaches.
+#
+# lexing is a scan from a position with nothing carried over but the
+# position, so from the end of the last token the edit can not reach, the
+# source is lexed again until a token starts where an old one did past the
+# edit: from there the old tokens are the new ones, shifted. a token can
+# depend on text well past its end (1.5555e is INT DOT UNKNOWN..., as the
+# float pattern reads the digits before failing), but only strings and
+# comments look past a newline, so tokens ending before the line of the edit
+# can not be reached.
+#
+# parsing is the same one level up, parse_external keeps nothing between
+# declarations. the declaration the first new token falls in is parsed
+# again, and the ones after it until one starts at an old declaration's
+# first token, past the new tokens; the old nodes from there on are kept.
+#
+# a string or comment opener that is never closed is lexed as UNKNOWN '"' or
+# DIVIDE, MULTIPLY... and an edit after it can close it, changing tokens
+# before the edit. with one before the edit everything is lexed again.
+
+
+@dataclass(slots=True)
+class Edit:
+    """ source[start:end] replaced by text. """
+    start: int
+    end: int
+    text: str
+
+
+def diff(old, new) -> Optional[Edit]:
+    """ The one Edit that turns old into new, spanning everything that changed. """
+    if old == new:
+        return None
+    # binary searches over slice compares, done in C, for the common ends
+    low, high = 0, min(len(old), len(new))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[:middle] == new[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    prefix = low
+    low, high = 0, min(len(old), len(new)) - prefix
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[len(old) - middle:] == new[len(new) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return Edit(prefix, len(old) - low, new[prefix:len(new) - low])
+
+
+class Feed:
+    """ The tokens of a TokenArray from an index on, for a Parser; index is
+    that of the last token handed out, the parser's lookahead. """
+    def __init__(self, tokens, start):
+        self.tokens = tokens
+        self.index = start - 1
+        self.line_col = tokens.line_col
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.index += 1
+        if self.index >= len(self.tokens):
+            raise StopIteration
+        return self.tokens[self.index]
+
+
+def unclosed(tokens, first, last):
+    """ Offsets of the string and comment openers that are never closed, among
+    the tokens first to last. """
+    quote, divide = KindIds['UNKNOWN'], KindIds['DIVIDE']
+    source = tokens.source
+    openers = []
+    for i in range(first, last):
+        kind = tokens.kinds[i]
+        start = tokens.starts[i]
+        if kind == quote and source[start] == '"' or kind == divide and source[start + 1:start + 2] == '*':
+            openers.append(start)
+    return openers
+
+
+class Document:
+    """ A source with its tokens and Program, kept up to date through edits.
+
+    tokens and program are replaced, not changed, by an edit: the old ones
+    stay valid for whoever holds them. The nodes of declarations the edit
+    does not reach are shared between the old and the new program.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.openers = unclosed(self.tokens, 0, len(self.tokens))
+        # index in tokens of the first token of each declaration
+        self.firsts = []
+        self.program = None
+        # tokens lexed and declarations parsed by the last update
+        self.lexed = len(self.tokens)
+        self.parsed = 0
+        self.parse()
+
+    def update(self, source):
+        """ Brings the document to a new source, returns the Edit or None. """
+        edit = diff(self.source, source)
+        if edit is not None:
+            self.apply(edit)
+        return edit
+
+    def apply(self, edit):
+        old = self.source
+        self.source = old[:edit.start] + edit.text + old[edit.end:]
+        if self.openers and self.openers[0] < edit.start or self.program is None:
+            # see the top of the file, or the last parse failed
+            self.tokens = tokenize(self.source)
+            self.openers = unclosed(self.tokens, 0, len(self.tokens))
+            self.lexed = len(self.tokens)
+            self.program = None
+            self.parse()
+            return
+        first, after, count = self.relex(edit)
+        self.parse(first, after, count)
+
+    def relex(self, edit):
+        """ Lexes the tokens the edit reaches again. Returns the index of the
+        first new token, of the first old one kept and the number of new ones.
+        """
+        old = self.tokens
+        source = self.source
+        delta = len(edit.text) - (edit.end - edit.start)
+        edited_end = edit.start + len(edit.text)
+        first = bisect_left(old.ends, old.source.rfind('\n', 0, edit.start) + 1)
+        pos = old.ends[first - 1] if first > 0 else 0
+        last = len(old) - 1
+        kinds, starts, ends = array('H'), array('I'), array('I')
+        ids = KindIds
+        keywords = Keywords
+        for match in Master.finditer(source, pos):
+            kind = match.lastgroup
+            if kind == 'WHITESPACE':
+                continue
+            start, end = match.span()
+            if start >= edited_end:
+                # an old token starting here lexes as it did, and so does the rest
+                at = bisect_left(old.starts, start - delta, first, last)
+                if old.starts[at] == start - delta:
+                    last = at
+                    break
+            if kind == 'WORD':
+                kind = keywords.get(match.group(), 'IDENTIFIER')
+            kinds.append(ids[kind])
+            starts.append(start)
+            ends.append(end)
+        # else the old EOF, shifted, ends the new tokens
+        tokens = TokenArray(source)
+        tokens.kinds = old.kinds[:first] + kinds + old.kinds[last:]
+        if delta:
+            tokens.starts = old.starts[:first] + starts + array('I', [start + delta for start in old.starts[last:]])
+            tokens.ends = old.ends[:first] + ends + array('I', [end + delta for end in old.ends[last:]])
+        else:
+            tokens.starts = old.starts[:first] + starts + old.starts[last:]
+            tokens.ends = old.ends[:first] + ends + old.ends[last:]
+        self.tokens = tokens
+        self.lexed = len(kinds)
+        at = bisect_left(self.openers, old.starts[first])
+        self.openers = (self.openers[:at] + unclosed(tokens, first, first + len(kinds))
+                        + [offset + delta for offset in self.openers[at:] if offset >= old.starts[last]])
+        return first, last, len(kinds)
+
+    def parse(self, first=0, after=None, count=None):
+        """ Parses the declarations from the one token first falls in, until
+        one starts at the old token after, count new tokens having replaced
+        those before it. With first 0 and no after, the whole source.
+        """
+        old = self.program.declarations if self.program is not None else []
+        firsts = self.firsts if self.program is not None else []
+        shift = count - (after - first) if after is not None else 0
+        # the declaration of the token before first as well, one that ends
+        # just before the edit may take what follows it now
+        d = max(bisect_right(firsts, max(first - 1, 0)) - 1, 0)
+        start = firsts[d] if d < len(firsts) else 0
+        feed = Feed(self.tokens, start)
+        parser = Parser(feed)
+        decls, starts = [], []
+        keep = len(old)
+        try:
+            while parser.peek()[0] != 'EOF':
+                at = feed.index
+                if after is not None and at >= first + count:
+                    e = bisect_left(firsts, at - shift, d)
+                    if e < len(firsts) and firsts[e] == at - shift:
+                        keep = e
+                        break
+                starts.append(at)
+                decls.append(parser.parse_external())
+        except SyntaxError:
+            # parsed in full by the next update
+            self.program = None
+            raise
+        self.parsed = len(decls)
+        self.program = Program(old[:d] + decls + old[keep:])
+        self.firsts = firsts[:d] + starts + [index + shift for index in firsts[keep:]]
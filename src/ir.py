@@ -0,0 +1,494 @@
+import codecs
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import structure
+
+from parser import (Program, Function, Declaration, Compound, If, While, For, Return,
+                    ExprStmt, Binary, Unary, Literal, Var, Assignment, Call, ArrayAccess)
+
+# three address code in basic blocks, what the backends work from.
+#
+# every value is a 64 bit integer. operands are value names (str, locals keep
+# their source name, temporaries are %1, %2...) or int constants. globals and
+# string literals are only reached through an address ('addr', 'str').
+#
+#   const   dest = args[0]
+#   copy    dest = args[0]
+#   add sub mul div mod and or xor shl shr
+#   lt gt le ge eq ne                     dest = args[0] op args[1]
+#   neg not bnot                          dest = op args[0]
+#   load    dest = *args[0]
+#   store   *args[0] = args[1]
+#   addr    dest = &label                 (a global)
+#   str     dest = &label                 (label is the literal, quotes included)
+#   param   dest = parameter args[0]
+#   call    dest = label(args...)         (dest may be None)
+#   jmp     goto targets[0]
+#   br      if args[0] goto targets[0] else targets[1]
+#   ret     return args[0], or nothing when args is empty
+#   phi     dest = args[i] when coming from block targets[i], only in ssa form
+#           (see ssa.py), label is the variable it merges
+
+# values are 8 bytes wide, a[i] is the word at a + 8 * i
+WORD = 8
+
+BINARY_OPS = {
+    '+': 'add', '-': 'sub', '*': 'mul', '/': 'div', '%': 'mod',
+    '&': 'and', '|': 'or', '^': 'xor', '<<': 'shl', '>>': 'shr',
+    '<': 'lt', '>': 'gt', '<=': 'le', '>=': 'ge', '==': 'eq', '!=': 'ne',
+}
+
+UNARY_OPS = {'-': 'neg', '!': 'not', '~': 'bnot'}
+
+TERMINATORS = ('jmp', 'br', 'ret')
+
+# ops that do more than compute their dest, they are never removed
+SIDE_EFFECTS = ('store', 'call', 'param') + TERMINATORS
+
+NOT_SUPPORTED_TYPES = ('float', 'double')
+
+
+class LoweringError(Exception):
+    pass
+
+
+@dataclass(slots=True)
+class Instr:
+    op: str
+    dest: Optional[str] = None
+    args: List[Any] = field(default_factory=list)
+    label: Optional[str] = None
+    targets: List[str] = field(default_factory=list)
+
+    def uses(self):
+        return [arg for arg in self.args if type(arg) is str]
+
+    def __str__(self):
+        args = ', '.join(str(arg) for arg in self.args)
+        if self.op == 'phi':
+            args = ', '.join(f"[{arg}, {target}]" for arg, target in zip(self.args, self.targets))
+        elif self.label is not None:
+            args = f"{self.label}({args})" if self.op == 'call' else f"{self.label}{', ' if args else ''}{args}"
+        elif self.targets:
+            args = ', '.join([args] + self.targets) if args else ', '.join(self.targets)
+        text = f"{self.op} {args}".rstrip()
+        return f"{self.dest} = {text}" if self.dest is not None else text
+
+
+@dataclass(slots=True)
+class Block:
+    label: str
+    instrs: List[Instr] = field(default_factory=list)
+
+    @property
+    def terminated(self):
+        return bool(self.instrs) and self.instrs[-1].op in TERMINATORS
+
+    def successors(self):
+        return self.instrs[-1].targets if self.terminated else []
+
+
+@dataclass(slots=True)
+class IRFunction:
+    name: str
+    params: List[str]
+    blocks: List[Block]
+
+    def instr_count(self):
+        return sum(len(block.instrs) for block in self.blocks)
+
+    def block_map(self) -> Dict[str, Block]:
+        return {block.label: block for block in self.blocks}
+
+    def predecessors(self) -> Dict[str, List[str]]:
+        preds = {block.label: [] for block in self.blocks}
+        for block in self.blocks:
+            for target in block.successors():
+                preds[target].append(block.label)
+        return preds
+
+
+@dataclass(slots=True)
+class Module:
+    functions: List[IRFunction] = field(default_factory=list)
+    # global name -> initial value
+    globals: Dict[str, int] = field(default_factory=dict)
+    # names declared as functions (defined here or prototypes)
+    externs: List[str] = field(default_factory=list)
+
+    def instr_count(self):
+        return sum(fn.instr_count() for fn in self.functions)
+
+
+def constant_value(node):
+    """ Value of a constant initializer, globals can only start from these. """
+    if isinstance(node, Literal) and type(node.value) is int:
+        return node.value
+    if isinstance(node, Unary) and node.prefix and node.op in ('-', '+') and isinstance(node.operand, Literal) and type(node.operand.value) is int:
+        return -node.operand.value if node.op == '-' else node.operand.value
+    raise LoweringError(f"global initializer must be an integer constant, got {type(node).__name__}")
+
+
+def char_value(lexeme):
+    """ Code of a char literal, C escapes included. """
+    text = codecs.decode(lexeme[1:-1], 'unicode_escape')
+    if len(text) != 1:
+        raise LoweringError(f"char literal {lexeme} is not one character")
+    return ord(text)
+
+
+def check_type(var_type, name):
+    if var_type.split(' ')[0] in NOT_SUPPORTED_TYPES:
+        raise LoweringError(f"{name}: type {var_type} is not supported, every value is a 64 bit integer")
+
+
+class FunctionLowering:
+    """ Turns one Function into an IRFunction. """
+    def __init__(self, function, module):
+        self.function = function
+        self.functions = set(module.externs)
+        self.temps = 0
+        self.labels = 0
+        self.blocks = []
+        # (continue label, break label) of the loops we are in
+        self.loops = []
+        self.block = self.new_block('entry')
+
+    # helpers
+    def temp(self):
+        self.temps += 1
+        return f"%{self.temps}"
+
+    def new_block(self, hint):
+        self.labels += 1
+        block = Block(label=f"{hint}{self.labels}" if hint != 'entry' else 'entry')
+        self.blocks.append(block)
+        return block
+
+    def emit(self, op, dest=None, args=(), label=None, targets=()):
+        if self.block.terminated:
+            # code after a return or a jump, it gets a block nothing jumps to
+            self.block = self.new_block('dead')
+        self.block.instrs.append(Instr(op=op, dest=dest, args=list(args), label=label, targets=list(targets)))
+        return dest
+
+    def jump(self, block):
+        if not self.block.terminated:
+            self.emit('jmp', targets=[block.label])
+
+    def local(self, var):
+        """ Value name of a param or local, None for a global. """
+        symbol = var.binding
+        return symbol.unique if symbol.kind in ('param', 'local') else None
+
+    # entry point
+    def lower(self):
+        fn = self.function
+        check_type(fn.ret_type, fn.name)
+        params = []
+        for index, symbol in enumerate(fn.frame.params):
+            check_type(symbol.type, symbol.name)
+            value = symbol.unique
+            params.append(value)
+            self.emit('param', value, [index])
+        self.statement(fn.body)
+        if not self.block.terminated:
+            self.emit('ret', args=[0])
+        return IRFunction(name=fn.name, params=params, blocks=prune(self.blocks))
+
+    # statements
+    def statement(self, node):
+        match node:
+            case Compound():
+                for stmt in node.stmts:
+                    self.statement(stmt)
+            case Declaration():
+                check_type(node.var_type, node.name)
+                value = self.operand(node.initializer) if node.initializer is not None else 0
+                self.emit('copy', node.binding.unique, [value])
+            case ExprStmt():
+                if node.expr is not None:
+                    self.operand(node.expr)
+            case Return():
+                self.emit('ret', args=[self.operand(node.expr)] if node.expr is not None else [])
+            case If():
+                then_block = self.new_block('then')
+                else_block = self.new_block('else') if node.else_branch is not None else None
+                end_block = self.new_block('endif')
+                self.condition(node.cond, then_block, else_block or end_block)
+                self.block = then_block
+                self.statement(node.then_branch)
+                self.jump(end_block)
+                if node.else_branch is not None:
+                    self.block = else_block
+                    self.statement(node.else_branch)
+                    self.jump(end_block)
+                self.block = end_block
+            case While():
+                cond_block = self.new_block('while')
+                body_block = self.new_block('body')
+                end_block = self.new_block('endwhile')
+                self.jump(cond_block)
+                self.block = cond_block
+                self.condition(node.cond, body_block, end_block)
+                self.block = body_block
+                self.loops.append((cond_block, end_block))
+                self.statement(node.body)
+                self.loops.pop()
+                self.jump(cond_block)
+                self.block = end_block
+            case For():
+                if isinstance(node.init, Declaration):
+                    self.statement(node.init)
+                elif node.init is not None:
+                    self.operand(node.init)
+                cond_block = self.new_block('for')
+                body_block = self.new_block('body')
+                post_block = self.new_block('post')
+                end_block = self.new_block('endfor')
+                self.jump(cond_block)
+                self.block = cond_block
+                if node.cond is not None:
+                    self.condition(node.cond, body_block, end_block)
+                else:
+                    self.jump(body_block)
+                self.block = body_block
+                self.loops.append((post_block, end_block))
+                self.statement(node.body)
+                self.loops.pop()
+                self.jump(post_block)
+                self.block = post_block
+                if node.post is not None:
+                    self.operand(node.post)
+                self.jump(cond_block)
+                self.block = end_block
+            case Function():
+                raise LoweringError(f"nested function {node.name} is not supported")
+            case _:
+                raise LoweringError(f"cannot lower statement {type(node).__name__}")
+
+    def condition(self, node, true_block, false_block):
+        """ Branches on node, && and || jump straight to the targets. """
+        if isinstance(node, Binary) and node.op in ('&&', '||'):
+            middle = self.new_block('cond')
+            if node.op == '&&':
+                self.condition(node.left, middle, false_block)
+            else:
+                self.condition(node.left, true_block, middle)
+            self.block = middle
+            self.condition(node.right, true_block, false_block)
+            return
+        if isinstance(node, Unary) and node.prefix and node.op == '!':
+            self.condition(node.operand, false_block, true_block)
+            return
+        value = self.operand(node)
+        self.emit('br', args=[value], targets=[true_block.label, false_block.label])
+
+    # expressions, each gives back an operand
+    def operand(self, node):
+        match node:
+            case Literal():
+                if type(node.value) is int:
+                    return node.value
+                if type(node.value) is str and node.value.startswith('"'):
+                    return self.emit('str', self.temp(), label=node.value)
+                if type(node.value) is str and node.value.startswith("'"):
+                    return char_value(node.value)
+                raise LoweringError(f"literal {node.value!r} is not supported, every value is a 64 bit integer")
+            case Var():
+                value = self.local(node)
+                if value is not None:
+                    return value
+                if node.binding.kind == 'global':
+                    address = self.emit('addr', self.temp(), label=node.name)
+                    return self.emit('load', self.temp(), [address])
+                raise LoweringError(f"{self.function.name}: function {node.name} used as a value")
+            case Binary(op='&&' | '||'):
+                return self.boolean(node)
+            case Binary(op='?:'):
+                result = self.temp()
+                then_block = self.new_block('then')
+                else_block = self.new_block('else')
+                end_block = self.new_block('endif')
+                self.condition(node.left, then_block, else_block)
+                self.block = then_block
+                self.emit('copy', result, [self.operand(node.right.left)])
+                self.jump(end_block)
+                self.block = else_block
+                self.emit('copy', result, [self.operand(node.right.right)])
+                self.jump(end_block)
+                self.block = end_block
+                return result
+            case Binary():
+                op = BINARY_OPS.get(node.op)
+                if op is None:
+                    raise LoweringError(f"operator {node.op} is not supported")
+                left = self.operand(node.left)
+                right = self.operand(node.right)
+                return self.emit(op, self.temp(), [left, right])
+            case Unary(op='++' | '--'):
+                return self.step(node)
+            case Unary(op='+'):
+                return self.operand(node.operand)
+            case Unary():
+                value = self.operand(node.operand)
+                return self.emit(UNARY_OPS[node.op], self.temp(), [value])
+            case Assignment():
+                value = self.operand(node.value)
+                self.assign(node.target, value)
+                return value
+            case Call():
+                if not isinstance(node.callee, Var):
+                    raise LoweringError("only named functions can be called")
+                args = [self.operand(arg) for arg in node.args]
+                return self.emit('call', self.temp(), args, label=node.callee.name)
+            case ArrayAccess():
+                address = self.element(node)
+                return self.emit('load', self.temp(), [address])
+        raise LoweringError(f"cannot lower expression {type(node).__name__}")
+
+    def boolean(self, node):
+        """ && or || as a value, 0 or 1. """
+        result = self.temp()
+        true_block = self.new_block('true')
+        false_block = self.new_block('false')
+        end_block = self.new_block('endbool')
+        self.condition(node, true_block, false_block)
+        self.block = true_block
+        self.emit('copy', result, [1])
+        self.jump(end_block)
+        self.block = false_block
+        self.emit('copy', result, [0])
+        self.jump(end_block)
+        self.block = end_block
+        return result
+
+    def element(self, node):
+        """ Address of an ArrayAccess. """
+        base = self.operand(node.array)
+        index = self.operand(node.index)
+        if type(index) is int:
+            offset = index * WORD
+        else:
+            offset = self.emit('mul', self.temp(), [index, WORD])
+        return self.emit('add', self.temp(), [base, offset])
+
+    def assign(self, target, value):
+        match target:
+            case Var():
+                local = self.local(target)
+                if local is not None:
+                    self.emit('copy', local, [value])
+                elif target.binding.kind == 'global':
+                    address = self.emit('addr', self.temp(), label=target.name)
+                    self.emit('store', args=[address, value])
+                else:
+                    raise LoweringError(f"{self.function.name}: cannot assign to function {target.name}")
+            case ArrayAccess():
+                self.emit('store', args=[self.element(target), value])
+            case _:
+                raise LoweringError(f"cannot assign to {type(target).__name__}")
+
+    def step(self, node):
+        """ ++ and --, prefix gives the new value, postfix the old one. """
+        op = 'add' if node.op == '++' else 'sub'
+        target = node.operand
+        if isinstance(target, Var) and self.local(target) is not None:
+            local = self.local(target)
+            old = local
+            if not node.prefix:
+                old = self.emit('copy', self.temp(), [local])
+            self.emit(op, local, [local, 1])
+            return local if node.prefix else old
+        # the address is worked out once, a[f()]++ calls f once
+        match target:
+            case Var() if target.binding.kind == 'global':
+                address = self.emit('addr', self.temp(), label=target.name)
+            case Var():
+                raise LoweringError(f"{self.function.name}: cannot assign to function {target.name}")
+            case ArrayAccess():
+                address = self.element(target)
+            case _:
+                raise LoweringError(f"cannot assign to {type(target).__name__}")
+        old = self.emit('load', self.temp(), [address])
+        new = self.emit(op, self.temp(), [old, 1])
+        self.emit('store', args=[address, new])
+        return new if node.prefix else old
+
+
+def prune(blocks):
+    """ Drops blocks that can not be reached from the entry. """
+    by_label = {block.label: block for block in blocks}
+    seen = set()
+    stack = [blocks[0].label]
+    while stack:
+        label = stack.pop()
+        if label in seen:
+            continue
+        seen.add(label)
+        stack.extend(by_label[label].successors())
+    return [block for block in blocks if block.label in seen]
+
+
+def liveness(fn):
+    """ Values live on entry to and exit from each block, by label. """
+    uses, defs = {}, {}
+    for block in fn.blocks:
+        use, define = set(), set()
+        for instr in block.instrs:
+            use.update(value for value in instr.uses() if value not in define)
+            if instr.dest is not None:
+                define.add(instr.dest)
+        uses[block.label], defs[block.label] = use, define
+    live_in = {block.label: set() for block in fn.blocks}
+    live_out = {block.label: set() for block in fn.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(fn.blocks):
+            label = block.label
+            out = set()
+            for succ in block.successors():
+                out |= live_in[succ]
+            new_in = uses[label] | (out - defs[label])
+            if out != live_out[label] or new_in != live_in[label]:
+                live_out[label], live_in[label] = out, new_in
+                changed = True
+    return live_in, live_out
+
+
+def lower(program: Program) -> Module:
+    """ Lowers every function of a Program, globals and prototypes are collected first. """
+    structure.resolve(program)
+    module = Module()
+    for decl in program.declarations:
+        if isinstance(decl, Function):
+            module.externs.append(decl.name)
+        elif isinstance(decl, Declaration):
+            if decl.var_type.endswith('(func prototype)'):
+                module.externs.append(decl.name)
+            else:
+                check_type(decl.var_type, decl.name)
+                # an extern global is stored by the file that defines it
+                if not decl.var_type.endswith('(extern)'):
+                    module.globals[decl.name] = constant_value(decl.initializer) if decl.initializer is not None else 0
+    for decl in program.declarations:
+        if isinstance(decl, Function):
+            module.functions.append(FunctionLowering(decl, module).lower())
+    return module
+
+
+def write(module, out):
+    """ Writes the text form of a Module, one instruction per line. """
+    for name, value in module.globals.items():
+        out.write(f"global {name} = {value}\n")
+    if module.globals:
+        out.write("\n")
+    for fn in module.functions:
+        out.write(f"function {fn.name}({', '.join(fn.params)})\n")
+        for block in fn.blocks:
+            out.write(f"{block.label}:\n")
+            for instr in block.instrs:
+                out.write(f"    {instr}\n")
+        out.write("\n")
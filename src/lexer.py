@@ -1,4 +1,13 @@
+import os
 import re
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+# kind, lexeme, offset in the source (get_tokens leaves the offset out)
+Token = Tuple[str, str, int]
+EOF = ('EOF', 'EOF')
 
 #order matters, there might be errors if certain elements are not in the right order
 
@@ -7,49 +16,17 @@
     ('COMMENT_MULTI', re.compile(r'/\*.*?\*/', re.DOTALL)),
     ('COMMENT_LINE', re.compile(r'//[^\n]*')),
 
-    #KEYWORDS
-    ('IF', re.compile(r'\bif\b')),
-    ('ELSE', re.compile(r'\belse\b')),
-    ('WHILE', re.compile(r'\bwhile\b')),
-    ('FOR', re.compile(r'\bfor\b')),
-    ('RETURN', re.compile(r'\breturn\b')),
-    ('BREAK', re.compile(r'\bbreak\b')),
-    ('CONTINUE', re.compile(r'\bcontinue\b')),
-    ('SWITCH', re.compile(r'\bswitch\b')),
-    ('CASE', re.compile(r'\bcase\b')),
-    ('DEFAULT', re.compile(r'\bdefault\b')),
-    ('DO', re.compile(r'\bdo\b')),
-    ('GOTO', re.compile(r'\bgoto\b')),
+    # DIRECTIVES, a line from # on (#include <stdio.h>) and using <library>.
+    # the parser skips them like comments, build.py reads them. a library
+    # name holds no quote or comment start, split_points need not know it
+    ('DIRECTIVE', re.compile(r'#[^\n]*|using[ \t]*<[\w.-]+(?:/[\w.-]+)*>')),
 
-    
-    ('INT', re.compile(r'\bint\b')),
-    ('CHAR', re.compile(r'\bchar\b')),
-    ('VOID', re.compile(r'\bvoid\b')),
-    ('FLOAT', re.compile(r'\bfloat\b')),
-    ('DOUBLE', re.compile(r'\bdouble\b')),
-    ('SHORT', re.compile(r'\bshort\b')),
-    ('LONG', re.compile(r'\blong\b')),
-    ('SIGNED', re.compile(r'\bsigned\b')),
-    ('UNSIGNED', re.compile(r'\bunsigned\b')),
-    ('STRUCT', re.compile(r'\bstruct\b')),
-    ('UNION', re.compile(r'\bunion\b')),
-    ('ENUM', re.compile(r'\benum\b')),
-    ('TYPEDEF', re.compile(r'\btypedef\b')),
-    ('CONST', re.compile(r'\bconst\b')),
-    ('VOLATILE', re.compile(r'\bvolatile\b')),
-    ('STATIC', re.compile(r'\bstatic\b')),
-    ('EXTERN', re.compile(r'\bextern\b')),
-    ('INLINE', re.compile(r'\binline\b')),
-    ('REGISTER', re.compile(r'\bregister\b')),
-    ('AUTO', re.compile(r'\bauto\b')),
-    ('SIZEOF', re.compile(r'\bsizeof\b')),
-    ('RESTRICT', re.compile(r'\brestrict\b')),    
-    ('BOOLEAN', re.compile(r'\b_Bool\b')),
+    #KEYWORDS are not listed here, see Keywords below
 
     #DATA TYPES
     ('STRING_LITERAL', re.compile(r'"[^"]*"')),
-    ('FLOAT_LITERAL', re.compile(r'\b\d+.\d+\b')),
-    ('INT_LITERAL', re.compile(r'\b\d+\b')),
+    ('FLOAT_LITERAL', re.compile(r'\d+\.\d+\b')),
+    ('INT_LITERAL', re.compile(r'\d+\b')),
 
     
     #OPERATORS AND DELIMITERS AND SYMBOLS
@@ -80,6 +57,9 @@
     ('RBRACE', re.compile(r'}')),
 
     #IDENTIFIERS
+    # WORD is an identifier that ends on a word boundary, it is looked up in
+    # Keywords. An identifier running into a non ascii letter is never a keyword.
+    ('WORD', re.compile(r'[A-Za-z_][A-Za-z0-9_]*\b')),
     ('IDENTIFIER', re.compile(r'[A-Za-z_][A-Za-z0-9_]*')),
 
     #OTHERS
@@ -87,6 +67,77 @@
     ('UNKNOWN', re.compile(r'.'))
 ]
 
+Keywords = {
+    'if': 'IF',
+    'else': 'ELSE',
+    'while': 'WHILE',
+    'for': 'FOR',
+    'return': 'RETURN',
+    'break': 'BREAK',
+    'continue': 'CONTINUE',
+    'switch': 'SWITCH',
+    'case': 'CASE',
+    'default': 'DEFAULT',
+    'do': 'DO',
+    'goto': 'GOTO',
+
+    'int': 'INT',
+    'char': 'CHAR',
+    'void': 'VOID',
+    'float': 'FLOAT',
+    'double': 'DOUBLE',
+    'short': 'SHORT',
+    'long': 'LONG',
+    'signed': 'SIGNED',
+    'unsigned': 'UNSIGNED',
+    'struct': 'STRUCT',
+    'union': 'UNION',
+    'enum': 'ENUM',
+    'typedef': 'TYPEDEF',
+    'const': 'CONST',
+    'volatile': 'VOLATILE',
+    'static': 'STATIC',
+    'extern': 'EXTERN',
+    'inline': 'INLINE',
+    'register': 'REGISTER',
+    'auto': 'AUTO',
+    'sizeof': 'SIZEOF',
+    'restrict': 'RESTRICT',
+    '_Bool': 'BOOLEAN',
+}
+
+# every entry of Tokens as one alternation. re tries alternatives left to right,
+# so the first one that matches wins, exactly like looping over Tokens.
+# WHITESPACE and UNKNOWN together match any character, so the matches of
+# Master.finditer are back to back and cover the whole source.
+Master = re.compile('|'.join(
+    f'(?P<{name}>(?s:{pattern.pattern}))' if pattern.flags & re.DOTALL else f'(?P<{name}>{pattern.pattern})'
+    for name, pattern in Tokens
+))
+
+# the same over bytes, for ascii sources (see tokenize_bytes). on str \s also
+# takes the ascii separators \x1c-\x1f, bytes need them spelled out
+BytesMaster = re.compile(Master.pattern.replace(r'\s', r'[\s\x1c-\x1f]').encode(), Master.flags & ~re.UNICODE)
+BytesKeywords = {word.encode(): kind for word, kind in Keywords.items()}
+AsciiRun = re.compile(rb'[\x00-\x7f]*')
+
+
+def is_ascii(data):
+    # one match over the whole run is quicker than searching for the odd byte
+    return AsciiRun.match(data).end() == len(data)
+
+
+# small ids for every kind a token can have, used by TokenArray
+Kinds = [name for name, _ in Tokens if name not in ('WORD', 'WHITESPACE')] + list(Keywords.values()) + ['EOF']
+KindIds = {name: i for i, name in enumerate(Kinds)}
+
+# kinds that always have the same text, their lexemes are never sliced
+Lexemes = {'EOF': 'EOF'}
+for name, pattern in Tokens:
+    if re.fullmatch(r'(?:\\\W|[^\\.^$*+?{\[|()])+', pattern.pattern):
+        Lexemes[name] = re.sub(r'\\(\W)', r'\1', pattern.pattern)
+Lexemes.update((kind, word) for word, kind in Keywords.items())
+
 def lex_expression(self):
     start = self.pos
     paren = 0
@@ -138,19 +189,261 @@ def func_call(self, token):
 
 
 def get_tokens(string):
-    var = string
     tokens = []
-    
-    while var:
-        for token in Tokens:
-            match = token[1].match(var)
-            if match:
-                lexeme = match.group(0)
-                if token[0] != 'WHITESPACE':
-                    tokens.append((token[0], lexeme))
-                var = var[len(lexeme):]
-                break
-        else:
-            tokens.append(('UNKNOWN', var[0]))
-            var = var[1:]
+    append = tokens.append
+    keywords = Keywords
+
+    # walks the source once, by index, instead of slicing off every lexeme
+    for match in Master.finditer(string):
+        kind = match.lastgroup
+        if kind == 'WHITESPACE':
+            continue
+        lexeme = match.group()
+        if kind == 'WORD':
+            kind = keywords.get(lexeme, 'IDENTIFIER')
+        append((kind, lexeme))
+    return tokens
+
+
+class TokenArray:
+    """ Tokens of one source kept as kind ids and offsets, lexemes are sliced on demand. """
+    def __init__(self, source):
+        self.source = source
+        self.kinds = array('H')
+        self.starts = array('I')
+        self.ends = array('I')
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def kind(self, i):
+        return Kinds[self.kinds[i]]
+
+    def lexeme(self, i):
+        kind = Kinds[self.kinds[i]]
+        text = Lexemes.get(kind)
+        if text is None:
+            text = self.source[self.starts[i]:self.ends[i]]
+            if kind == 'IDENTIFIER':
+                text = sys.intern(text)
+        return text
+
+    def __getitem__(self, i):
+        return (self.kind(i), self.lexeme(i), self.starts[i])
+
+    def __iter__(self):
+        source = self.source
+        intern = sys.intern
+        lexemes = Lexemes
+        for kid, start, end in zip(self.kinds, self.starts, self.ends):
+            kind = Kinds[kid]
+            text = lexemes.get(kind)
+            if text is None:
+                text = source[start:end]
+                if kind == 'IDENTIFIER':
+                    text = intern(text)
+            yield (kind, text, start)
+
+    def line_col(self, offset):
+        """ 1 based line and column of an offset, worked out from the source. """
+        line_start = self.source.rfind('\n', 0, offset) + 1
+        return self.source.count('\n', 0, offset) + 1, offset - line_start + 1
+
+
+class MappedTokens(TokenArray):
+    """ A TokenArray over the bytes of an ascii source, a bytes or an mmap.
+    Lexemes are decoded when asked for, so kinds with a fixed text never are.
+    Pickles as a TokenArray of the decoded source.
+    """
+    def lexeme(self, i):
+        kind = Kinds[self.kinds[i]]
+        text = Lexemes.get(kind)
+        if text is None:
+            text = self.source[self.starts[i]:self.ends[i]].decode('ascii')
+            if kind == 'IDENTIFIER':
+                text = sys.intern(text)
+        return text
+
+    def __iter__(self):
+        source = self.source
+        intern = sys.intern
+        lexemes = Lexemes
+        for kid, start, end in zip(self.kinds, self.starts, self.ends):
+            kind = Kinds[kid]
+            text = lexemes.get(kind)
+            if text is None:
+                text = source[start:end].decode('ascii')
+                if kind == 'IDENTIFIER':
+                    text = intern(text)
+            yield (kind, text, start)
+
+    def line_col(self, offset):
+        line_start = self.source.rfind(b'\n', 0, offset) + 1
+        return self.source[:offset].count(b'\n') + 1, offset - line_start + 1
+
+    def __reduce__(self):
+        return unmapped, (self.source[:].decode('ascii'), self.kinds, self.starts, self.ends)
+
+
+def unmapped(source, kinds, starts, ends):
+    tokens = TokenArray(source)
+    tokens.kinds, tokens.starts, tokens.ends = kinds, starts, ends
+    return tokens
+
+
+def tokenize_bytes(data):
+    """ tokenize over an ascii source given as bytes, the same tokens without
+    decoding it. Sources that are not ascii (see is_ascii) are for tokenize,
+    after decoding: offsets there count characters, not bytes.
+    """
+    tokens = MappedTokens(data)
+    kinds = tokens.kinds.append
+    starts = tokens.starts.append
+    ends = tokens.ends.append
+    ids = KindIds
+    keywords = BytesKeywords
+
+    for match in BytesMaster.finditer(data):
+        kind = match.lastgroup
+        if kind == 'WHITESPACE':
+            continue
+        if kind == 'WORD':
+            kind = keywords.get(match.group(), 'IDENTIFIER')
+        start, end = match.span()
+        kinds(ids[kind])
+        starts(start)
+        ends(end)
+    kinds(ids['EOF'])
+    starts(len(data))
+    ends(len(data))
     return tokens
+
+
+def lex_arrays(string):
+    """ Kind ids, starts and ends of the tokens of a source, without EOF. """
+    kinds, starts, ends = array('H'), array('I'), array('I')
+    add_kind, add_start, add_end = kinds.append, starts.append, ends.append
+    ids = KindIds
+    keywords = Keywords
+
+    for match in Master.finditer(string):
+        kind = match.lastgroup
+        if kind == 'WHITESPACE':
+            continue
+        if kind == 'WORD':
+            kind = keywords.get(match.group(), 'IDENTIFIER')
+        start, end = match.span()
+        add_kind(ids[kind])
+        add_start(start)
+        add_end(end)
+    return kinds, starts, ends
+
+
+def tokenize(string):
+    """ Lexes a source into a TokenArray, ending with EOF. """
+    tokens = TokenArray(string)
+    tokens.kinds, tokens.starts, tokens.ends = lex_arrays(string)
+    tokens.kinds.append(KindIds['EOF'])
+    tokens.starts.append(len(string))
+    tokens.ends.append(len(string))
+    return tokens
+
+
+# the tokens that can hold a newline or hide one from the lexer. a newline
+# outside them ends every token before it (only these and whitespace cross
+# one), and no pattern looks behind its start, so the source can be cut
+# just after it and each piece lexed on its own. a quote or /* that is never
+# closed matches nothing here, as in Master
+Spans = re.compile(r'/\*.*?\*/|//[^\n]*|#[^\n]*|"[^"]*"', re.DOTALL)
+
+# sources smaller than this are lexed in one piece, a process costs more
+PARALLEL_SIZE = 1 << 20
+
+
+def split_points(string, count):
+    """ Up to count - 1 offsets, in order, where string can be cut between tokens. """
+    points = []
+    spans = Spans.finditer(string)
+    span = next(spans, None)
+    for i in range(1, count):
+        # the first newline from the i-th part of the source on that no span covers
+        at = string.find('\n', max(len(string) * i // count, points[-1] if points else 0))
+        while at != -1 and span is not None and span.start() <= at:
+            if at < span.end():
+                at = string.find('\n', span.end())
+            else:
+                span = next(spans, None)
+        if at == -1:
+            break
+        points.append(at + 1)
+    return points
+
+
+def lex_piece(piece, base):
+    """ lex_arrays of a piece of a source that starts at offset base. """
+    kinds, starts, ends = lex_arrays(piece)
+    if base:
+        starts = array('I', [start + base for start in starts])
+        ends = array('I', [end + base for end in ends])
+    return kinds, starts, ends
+
+
+def tokenize_parallel(string, jobs=None):
+    """ tokenize, with the source cut at split_points and the pieces lexed in
+    a pool of jobs processes (one per core by default). Gives the same
+    TokenArray as tokenize.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if jobs < 2 or len(string) < PARALLEL_SIZE:
+        return tokenize(string)
+    # a few pieces per process evens out how long each takes
+    bounds = [0] + split_points(string, jobs * 4) + [len(string)]
+    pieces = [string[start:end] for start, end in zip(bounds, bounds[1:])]
+    tokens = TokenArray(string)
+    with ProcessPoolExecutor(jobs) as pool:
+        for kinds, starts, ends in pool.map(lex_piece, pieces, bounds):
+            tokens.kinds.extend(kinds)
+            tokens.starts.extend(starts)
+            tokens.ends.extend(ends)
+    tokens.kinds.append(KindIds['EOF'])
+    tokens.starts.append(len(string))
+    tokens.ends.append(len(string))
+    return tokens
+
+
+def stream_tokens(file, chunk_size=1 << 16):
+    """ Yields the tokens of a file object chunk by chunk, ending with EOF. """
+    keywords = Keywords
+    buf = ''
+    base = 0
+    done = False
+
+    while not done:
+        chunk = file.read(chunk_size)
+        done = not chunk
+        buf += chunk
+        pos = 0
+        # only lines that are complete can be lexed, no pattern but comments and
+        # strings goes past a newline. comments and strings that are not closed
+        # yet show up as DIVIDE '/*' and UNKNOWN '"'
+        limit = len(buf) if done else buf.rfind('\n')
+        for match in Master.finditer(buf):
+            kind = match.lastgroup
+            end = match.end()
+            if not done:
+                if end > limit:
+                    break
+                if kind == 'DIVIDE' and buf[end] == '*':
+                    break
+                if kind == 'UNKNOWN' and match.group() == '"':
+                    break
+            pos = end
+            if kind == 'WHITESPACE':
+                continue
+            lexeme = match.group()
+            if kind == 'WORD':
+                kind = keywords.get(lexeme, 'IDENTIFIER')
+            yield (kind, lexeme, base + match.start())
+        buf = buf[pos:]
+        base += pos
+    yield ('EOF', 'EOF', base)
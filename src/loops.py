@@ -0,0 +1,346 @@
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional, Set
+
+from ir import Block, Instr
+from ssa import COMMUTATIVE, dominators, fold, phis, replace_values
+
+# loop passes over the ir in ssa form. loops are the natural loops of the
+# control flow graph: a back edge goes from a block to one that dominates it
+# (the header), the loop is every block that reaches the back edge without
+# passing the header. every pass below wants a preheader, the one block
+# outside the loop that jumps to its header, and makes one when needed
+
+# pure ops that can be computed once before the loop, division is left in
+# place as it traps when the loop would not have run it
+HOISTABLE = ('copy', 'add', 'sub', 'mul', 'and', 'or', 'xor', 'shl', 'shr',
+             'lt', 'gt', 'le', 'ge', 'eq', 'ne', 'neg', 'not', 'bnot', 'addr', 'str')
+
+# full unrolling limits, in iterations and in instructions after unrolling
+UNROLL_TRIPS = 8
+UNROLL_SIZE = 96
+
+
+@dataclass(slots=True)
+class Loop:
+    header: str
+    blocks: Set[str]
+    latches: List[str] = field(default_factory=list)
+    preheader: Optional[str] = None
+
+
+def dominates(idom, a, b):
+    while b != a:
+        if idom[b] == b:
+            return False
+        b = idom[b]
+    return True
+
+
+def find_loops(fn):
+    """ The natural loops of fn, innermost (smallest) first. """
+    idom = dominators(fn)
+    preds = fn.predecessors()
+    loops = {}
+    for block in fn.blocks:
+        if block.label not in idom:
+            continue
+        for header in block.successors():
+            if not dominates(idom, header, block.label):
+                continue
+            loop = loops.setdefault(header, Loop(header, {header}))
+            loop.latches.append(block.label)
+            work = [block.label]
+            while work:
+                label = work.pop()
+                if label not in loop.blocks:
+                    loop.blocks.add(label)
+                    work.extend(preds[label])
+    return sorted(loops.values(), key=lambda loop: len(loop.blocks))
+
+
+class Names:
+    """ Fresh temporaries after the ones lowering handed out. """
+    def __init__(self, fn):
+        numbers = [int(match.group(1)) for block in fn.blocks for instr in block.instrs
+                   if instr.dest is not None for match in [re.match(r'%(\d+)', instr.dest)] if match]
+        self.count = max(numbers, default=0)
+
+    def temp(self):
+        self.count += 1
+        return f"%{self.count}"
+
+
+def preheader(fn, loop, names):
+    """ Label of the block that enters the loop, made when there is none. """
+    blocks = fn.block_map()
+    header = blocks[loop.header]
+    outside = [pred for pred in fn.predecessors()[loop.header] if pred not in loop.blocks]
+    if len(outside) == 1 and blocks[outside[0]].successors() == [loop.header]:
+        loop.preheader = outside[0]
+        return loop.preheader
+    pre = Block(f"pre.{loop.header}", [Instr('jmp', targets=[loop.header])])
+    for label in outside:
+        terminator = blocks[label].instrs[-1]
+        terminator.targets = [pre.label if target == loop.header else target for target in terminator.targets]
+    # the header phis get one entry from the preheader, which merges the outside ones
+    merged = []
+    for phi in phis(header):
+        entries = [(arg, target) for arg, target in zip(phi.args, phi.targets) if target not in outside]
+        incoming = [(arg, target) for arg, target in zip(phi.args, phi.targets) if target in outside]
+        if len(incoming) == 1:
+            value = incoming[0][0]
+        else:
+            value = names.temp()
+            merged.append(Instr('phi', value, [arg for arg, _ in incoming], label=phi.label, targets=[target for _, target in incoming]))
+        phi.args = [arg for arg, _ in entries] + [value]
+        phi.targets = [target for _, target in entries] + [pre.label]
+    pre.instrs[0:0] = merged
+    fn.blocks.insert(fn.blocks.index(header), pre)
+    loop.preheader = pre.label
+    return pre.label
+
+
+def defined_in(fn, loop):
+    return {instr.dest for block in fn.blocks if block.label in loop.blocks
+            for instr in block.instrs if instr.dest is not None}
+
+
+def licm(fn, loop):
+    """ Moves instructions whose operands do not change in the loop to the preheader. """
+    inside = defined_in(fn, loop)
+    invariant = set()
+    hoisted = []
+    changed = True
+    while changed:
+        changed = False
+        for block in fn.blocks:
+            if block.label not in loop.blocks:
+                continue
+            kept = []
+            for instr in block.instrs:
+                if instr.op in HOISTABLE and all(type(arg) is int or arg not in inside or arg in invariant for arg in instr.args):
+                    # found in dependency order, so they can be appended as they come
+                    invariant.add(instr.dest)
+                    hoisted.append(instr)
+                    changed = True
+                else:
+                    kept.append(instr)
+            block.instrs = kept
+    pre = fn.block_map()[loop.preheader]
+    pre.instrs[-1:-1] = hoisted
+    return len(hoisted)
+
+
+def induction_variables(fn, loop):
+    """ Header phis stepping by a constant each time round: phi value -> (initial value, step). """
+    if len(loop.latches) != 1:
+        return {}
+    header = fn.block_map()[loop.header]
+    defs = {instr.dest: instr for block in fn.blocks if block.label in loop.blocks for instr in block.instrs}
+    result = {}
+    for phi in phis(header):
+        if len(phi.args) != 2 or set(phi.targets) != {loop.preheader, loop.latches[0]}:
+            continue
+        init = phi.args[phi.targets.index(loop.preheader)]
+        step = defs.get(phi.args[phi.targets.index(loop.latches[0])])
+        if step is None or step.op not in ('add', 'sub') or len(step.args) != 2:
+            continue
+        left, right = step.args
+        if step.op == 'add' and left == phi.dest and type(right) is int:
+            result[phi.dest] = (init, right)
+        elif step.op == 'add' and right == phi.dest and type(left) is int:
+            result[phi.dest] = (init, left)
+        elif step.op == 'sub' and left == phi.dest and type(right) is int:
+            result[phi.dest] = (init, -right)
+    return result
+
+
+def strength_reduce(fn, loop, names):
+    """ i * k and then base + i * k of an induction variable i become variables of their own.
+
+    a new variable starts at the value the expression has on entry and steps
+    by what the expression changes by each time round, so the multiply (and
+    the add of an array access) turn into one add at the end of the loop.
+    """
+    ivs = induction_variables(fn, loop)
+    if not ivs:
+        return 0
+    blocks = fn.block_map()
+    header, latch, pre = blocks[loop.header], blocks[loop.latches[0]], blocks[loop.preheader]
+    inside = defined_in(fn, loop)
+    created = set()
+    mapping = {}
+    new_phis, new_steps = [], []
+
+    def invariant(value):
+        return type(value) is int or value not in inside
+
+    def compute(op, args):
+        # the start value, folded when it is known now
+        if all(type(arg) is int for arg in args):
+            value = fold(op, args)
+            if value is not None:
+                return value
+        if (op in ('add', 'sub') and args[1] == 0) or (op == 'mul' and args[1] == 1):
+            return args[0]
+        if (op == 'add' and args[0] == 0) or (op == 'mul' and args[0] == 1):
+            return args[1]
+        dest = names.temp()
+        pre.instrs.insert(len(pre.instrs) - 1, Instr(op, dest, list(args)))
+        return dest
+
+    for block in fn.blocks:
+        if block.label not in loop.blocks:
+            continue
+        kept = []
+        for instr in block.instrs:
+            instr.args = [mapping.get(arg, arg) for arg in instr.args]
+            args = instr.args
+            new = None
+            if instr.op in ('mul', 'shl') and len(args) == 2:
+                if instr.op == 'mul' and args[1] in ivs and type(args[0]) is int:
+                    args = [args[1], args[0]]
+                if args[0] in ivs and type(args[1]) is int:
+                    factor = args[1] if instr.op == 'mul' else 1 << (args[1] & 63)
+                    init, step = ivs[args[0]]
+                    new = (compute('mul', [init, factor]), step * factor)
+            elif instr.op in ('add', 'sub') and len(args) == 2:
+                if instr.op in COMMUTATIVE and args[1] in created and invariant(args[0]):
+                    args = [args[1], args[0]]
+                if args[0] in created and invariant(args[1]):
+                    init, step = ivs[args[0]]
+                    new = (compute(instr.op, [init, args[1]]), step)
+            if new is None:
+                kept.append(instr)
+                continue
+            init, step = new
+            value, after = names.temp(), names.temp()
+            new_phis.append(Instr('phi', value, [init, after], label=value, targets=[loop.preheader, latch.label]))
+            new_steps.append(Instr('add', after, [value, step]))
+            ivs[value] = new
+            created.add(value)
+            mapping[instr.dest] = value
+        block.instrs = kept
+    header.instrs[0:0] = new_phis
+    latch.instrs[-1:-1] = new_steps
+    replace_values(fn, mapping)
+    return len(new_phis)
+
+
+def trip_count(fn, loop, ivs):
+    """ Times the body of a loop with a constant bound runs, None when not known or too many. """
+    header = fn.block_map()[loop.header]
+    branch = header.instrs[-1]
+    if branch.op != 'br' or branch.targets[0] not in loop.blocks or branch.targets[1] in loop.blocks:
+        return None
+    test = next((instr for instr in header.instrs if instr.dest == branch.args[0]), None)
+    if test is None or test.op not in ('lt', 'gt', 'le', 'ge', 'eq', 'ne'):
+        return None
+    left, right = test.args
+    if left in ivs and type(right) is int:
+        iv, bound, swap = left, right, False
+    elif right in ivs and type(left) is int:
+        iv, bound, swap = right, left, True
+    else:
+        return None
+    value, step = ivs[iv]
+    if type(value) is not int or step == 0:
+        return None
+    trips = 0
+    while True:
+        args = [bound, value] if swap else [value, bound]
+        if not fold(test.op, args):
+            return trips
+        trips += 1
+        value += step
+        if trips > UNROLL_TRIPS:
+            return None
+
+
+def unroll(fn, loop):
+    """ Fully unrolls a loop that is one straight run of blocks and a known trip count. """
+    blocks = fn.block_map()
+    header = blocks[loop.header]
+    ivs = induction_variables(fn, loop)
+    trips = trip_count(fn, loop, ivs)
+    if trips is None:
+        return False
+    # the blocks from the header round to the latch, each jumping to the next
+    chain = []
+    label = header.instrs[-1].targets[0]
+    while label != loop.header:
+        block = blocks[label]
+        if block.instrs[-1].op != 'jmp' or label in chain:
+            return False
+        chain.append(label)
+        label = block.instrs[-1].targets[0]
+    if len(chain) + 1 != len(loop.blocks) or chain[-1] != loop.latches[0]:
+        return False
+    merges = phis(header)
+    body = [instr for label in chain for instr in blocks[label].instrs[:-1]]
+    test = header.instrs[len(merges):-1]
+    if (trips + 1) * len(test) + trips * len(body) > UNROLL_SIZE:
+        return False
+
+    exit_label = header.instrs[-1].targets[1]
+    unrolled = Block(f"unrolled.{loop.header}")
+    previous = {}
+    for trip in range(trips + 1):
+        # a phi is its value on entry the first time, then what the latch left
+        env = {}
+        for phi in merges:
+            if trip == 0:
+                env[phi.dest] = phi.args[phi.targets.index(loop.preheader)]
+            else:
+                value = phi.args[phi.targets.index(loop.latches[0])]
+                env[phi.dest] = previous.get(value, value)
+        # the test runs once more than the body, its value is not needed
+        for instr in test + (body if trip < trips else []):
+            args = [env.get(arg, arg) for arg in instr.args]
+            dest = None
+            if instr.dest is not None:
+                dest = env[instr.dest] = f"{instr.dest}.{trip}"
+            unrolled.instrs.append(Instr(instr.op, dest, args, instr.label, list(instr.targets)))
+        previous = env
+    unrolled.instrs.append(Instr('jmp', targets=[exit_label]))
+
+    pre = blocks[loop.preheader]
+    pre.instrs[-1].targets = [unrolled.label if target == loop.header else target for target in pre.instrs[-1].targets]
+    for phi in phis(blocks[exit_label]):
+        phi.targets = [unrolled.label if target == loop.header else target for target in phi.targets]
+    fn.blocks[fn.blocks.index(header)] = unrolled
+    fn.blocks = [block for block in fn.blocks if block.label not in loop.blocks]
+    # only header values are used past the loop, they leave with their last values
+    replace_values(fn, {instr.dest: previous[instr.dest] for instr in merges + test if instr.dest is not None})
+    return True
+
+
+def optimize(module, licm_on=True, strength=True, unrolling=False):
+    """ Runs the loop passes that are on, returns the module and counts for stats. """
+    counts = {'loops': 0, 'licm_hoisted': 0, 'strength_reduced': 0, 'loops_unrolled': 0}
+    for fn in module.functions:
+        names = Names(fn)
+        # each pass changes the blocks, so the loops are found again for the next
+        for loop in find_loops(fn):
+            counts['loops'] += 1
+            preheader(fn, loop, names)
+        if licm_on:
+            for loop in find_loops(fn):
+                preheader(fn, loop, names)
+                counts['licm_hoisted'] += licm(fn, loop)
+        if strength:
+            for loop in find_loops(fn):
+                preheader(fn, loop, names)
+                counts['strength_reduced'] += strength_reduce(fn, loop, names)
+        if unrolling:
+            # one at a time, the loops around an unrolled one change shape
+            while True:
+                for loop in find_loops(fn):
+                    preheader(fn, loop, names)
+                    if unroll(fn, loop):
+                        counts['loops_unrolled'] += 1
+                        break
+                else:
+                    break
+    return module, counts
@@ -1,73 +1,573 @@
+import glob
+import io
+import mmap
+import os
+import pickle
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from itertools import repeat
+from typing import List, Optional
+
+import cache
+import callgraph
+import closures
+import codegen
+import incremental
+import ir
+import loops
+import modules
+import ssa
+import structure
+import optimize
+import serialize
+import stats as instrument
 import parser as parse
-from lexer import get_tokens
+from lexer import get_tokens, is_ascii, stream_tokens, tokenize, tokenize_bytes, tokenize_parallel
+
+# seconds between two looks at the files under --watch
+WATCH_INTERVAL = 0.25
 
 help_options = """
       usage: python3 main.py [file..] or
       python3 main.py [option...] [file..]
       
       --help, -h: displays this help message
-      -o: output to file
+      -o FILE: write the tokens and ast (after -O) to FILE in a binary
+          format instead of printing them, the file can be compiled in place
+          of the source it came from; with -a or --emit-ir, write the
+          assembly or the ir to FILE (not with --run)
       -t: print tokens
-      -a: show asm 
+      -O: run the optimization passes on the ast before printing it
+      --stream: lex and parse the file as it is read
+      --no-cache: do not read or write the token and ast cache
+      -I DIR: look for the libraries of #include and using <library> in DIR
+          too, after the directory of the file (repeatable)
+      --mmap: map ascii files into memory and lex their bytes, lexemes are
+          only decoded when needed (files that are not ascii are read as text)
+      -a: print x86-64 assembly (gnu as, intel syntax) instead of the ast
+          (-a, --emit-ir and --run see the functions and globals of the
+          libraries a file uses, read from their precompiled declarations)
+      --emit-ir: print the ssa ir instead of the ast (optimized with -O)
+      --run: run the program's main instead of printing the ast, exits
+          non-zero when main returns non-zero
+      --no-licm: with -O, leave loop invariant code in the loops
+      --no-strength-reduce: with -O, keep multiplies by induction variables
+      --unroll: with -O, fully unroll loops of up to 8 known iterations
+      --inline-size N: with -O, inline functions of up to N ir instructions
+          (twice that when called from a loop), 0 turns inlining off
+      --whole-program: with -O, the file is all of the program, functions
+          main can not reach are dropped (otherwise every function is kept
+          for the files it is linked with)
+      -j N, --jobs N: compile N files at once (0 for one per core)
+      --lex-jobs N: lex each file of over 1 MB in N processes, cut at
+          newlines between tokens (0 for one per core)
+      --watch: compile the files again each time one is saved, until ctrl-c;
+          only the tokens and declarations an edit reaches are lexed and
+          parsed again
+      --stats: print time, memory peak and counts of each phase to stderr
+          (memory is traced with tracemalloc, which slows every phase down)
+      --stats-json FILE: write the same numbers as json to FILE
+      --profile PHASE: write a cProfile of one phase (read, cache, lex, parse,
+          import, optimize, lower, codegen, translate, run, print) to <file>.<phase>.prof in the current directory
+
+      every run pays for starting python and importing the compiler, to pay
+      it once start python3 server.py and compile with python3 client.py
+      [option...] [file..], which takes the same options
+
+      files that #include or use (using <library>) others are built together,
+      only what changed since the last build, with python3 build.py
       """
 
-def args():
+@dataclass
+class Options:
+    files: List[str] = field(default_factory=list)
+    output: Optional[str] = None
+    include_dirs: List[str] = field(default_factory=list)
+    jobs: int = 1
+    lex_jobs: int = 1
+    use_cache: bool = True
+    tokens_only: bool = False
+    stream: bool = False
+    mmap: bool = False
+    watch: bool = False
+    stats: bool = False
+    stats_json: Optional[str] = None
+    profile: Optional[str] = None
+    optimize: bool = False
+    asm: bool = False
+    emit_ir: bool = False
+    run: bool = False
+    licm: bool = True
+    strength_reduce: bool = True
+    unroll: bool = False
+    inline_size: int = callgraph.INLINE_SIZE
+    whole_program: bool = False
+
+
+def args(argv):
     """ Command line argument parser. """
-    match sys.argv[1]:
-        case '--help':
-            print(help_options)
-        case '-h':
-            print(help_options)
-        case '-o':
-            pass
-        case '-t':
-            try:
-                with open(sys.argv[2], "r") as file:
-                    content = file.read()
-                tokens = get_tokens(content)
-            except FileNotFoundError:
-                print(f"Error: file not found {sys.argv[1]}")
-                sys.exit(1)
-            print(tokens)
-            sys.exit(0)
+    options = Options()
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        match arg:
+            case '--help' | '-h':
+                print(help_options)
+                sys.exit(0)
+            case '-o':
+                i += 1
+                if i >= len(argv):
+                    print("Error: -o expects a file name")
+                    sys.exit(1)
+                options.output = argv[i]
+            case '-I':
+                i += 1
+                if i >= len(argv):
+                    print("Error: -I expects a directory")
+                    sys.exit(1)
+                options.include_dirs.append(argv[i])
+            case '-a':
+                options.asm = True
+            case '--emit-ir':
+                options.emit_ir = True
+            case '--run':
+                options.run = True
+            case '--no-licm':
+                options.licm = False
+            case '--no-strength-reduce':
+                options.strength_reduce = False
+            case '--unroll':
+                options.unroll = True
+            case '--whole-program':
+                options.whole_program = True
+            case '--inline-size':
+                i += 1
+                options.inline_size = size(argv[i] if i < len(argv) else '')
+            case '-t':
+                options.tokens_only = True
+            case '-O':
+                options.optimize = True
+            case '--stream':
+                options.stream = True
+            case '--no-cache':
+                options.use_cache = False
+            case '--mmap':
+                options.mmap = True
+            case '--watch':
+                options.watch = True
+            case '--stats':
+                options.stats = True
+            case '--stats-json':
+                i += 1
+                if i >= len(argv):
+                    print("Error: --stats-json expects a file name")
+                    sys.exit(1)
+                options.stats_json = argv[i]
+            case '--profile':
+                i += 1
+                if i >= len(argv):
+                    print(f"Error: --profile expects one of {', '.join(instrument.PHASES)}")
+                    sys.exit(1)
+                options.profile = argv[i]
+                if options.profile not in instrument.PHASES:
+                    print(f"Error: --profile expects one of {', '.join(instrument.PHASES)}")
+                    sys.exit(1)
+            case '-j' | '--jobs':
+                i += 1
+                options.jobs = jobs(argv[i] if i < len(argv) else '')
+            case '--lex-jobs':
+                i += 1
+                options.lex_jobs = jobs(argv[i] if i < len(argv) else '', arg)
+            case _ if arg.startswith('-I'):
+                options.include_dirs.append(arg[2:])
+            case _ if arg.startswith('-j'):
+                options.jobs = jobs(arg[2:])
+            case _:
+                # globs are expanded here so they work without a shell too
+                matches = sorted(glob.glob(arg, recursive=True)) if glob.has_magic(arg) else []
+                options.files.extend(matches or [arg])
+        i += 1
+    if options.run and options.output is not None:
+        print("Error: -o can not be used with --run, which writes nothing")
+        sys.exit(1)
+    return options
 
 
-def main():
-    if 2 < len(sys.argv) <= 3:
-        args()
-    elif len(sys.argv) < 3:
-        #Catch errors with try and except
-        try:
-            with open(sys.argv[1], "r") as file:
-                content = file.read()
+def size(value):
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        print(f"Error: --inline-size expects a number, got {value!r}")
+        sys.exit(1)
+
+
+def jobs(value, option='-j'):
+    try:
+        count = int(value)
+    except ValueError:
+        print(f"Error: {option} expects a number, got {value!r}")
+        sys.exit(1)
+    # -j 0 uses every core
+    return count if count > 0 else os.cpu_count() or 1
+
+
+def read_source(path, mapped=False):
+    """ The text of a file. With mapped, an ascii file comes back mapped
+    into memory instead, for compile_source to lex as bytes.
+    """
+    if mapped:
+        with open(path, "rb") as file:
+            # an empty file can not be mapped
+            if os.fstat(file.fileno()).st_size:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                if is_ascii(data):
+                    return data
+                data.close()
+    with open(path, "r") as file:
+        return file.read()
+
+
+def compile_source(content, use_cache=True, stats=None, lex_jobs=1):
+    """ Tokens and ast of a source, from the cache when it was seen before.
+
+    content is a str, or the bytes of an ascii source (read_source), those
+    are lexed without decoding them. Pass a stats.Stats to have each phase
+    timed and measured, and lex_jobs above 1 to lex a large str source in
+    that many processes.
+    """
+    if use_cache:
+        with instrument.measure(stats, 'cache'):
+            entry = cache.load(content)
+        if entry is not None:
+            return entry
+    with instrument.measure(stats, 'lex'):
+        if type(content) is not str:
+            tokens = tokenize_bytes(content)
+        elif lex_jobs > 1:
+            tokens = tokenize_parallel(content, lex_jobs)
+        else:
+            tokens = tokenize(content)
+    with instrument.measure(stats, 'parse'):
+        ast = parse.Parser(tokens).parse_program()
+    if use_cache:
+        with instrument.measure(stats, 'cache'):
+            cache.store(content, tokens, ast)
+    return tokens, ast
+
+
+def optimize_ast(ast, options, stats=None):
+    """ Runs the optimization passes when -O is on, counting what each removed. """
+    if not options.optimize:
+        return ast
+    with instrument.measure(stats, 'optimize'):
+        ast, report = optimize.optimize(ast)
+    if stats is not None:
+        for name, removed in report:
+            stats.count(f"{name}_removed", removed)
+    return ast
+
+
+def lower_ast(ast, options, stats=None):
+    """ The ast as an ir module in ssa form, through the ssa passes when -O is on. """
+    with instrument.measure(stats, 'lower'):
+        module = ssa.construct(ir.lower(ast))
+    if options.optimize:
+        with instrument.measure(stats, 'optimize'):
+            module, report = ssa.optimize(module)
+            # inlined bodies are in place before the loop passes look for invariants
+            module, calls = callgraph.optimize(module, options.inline_size, options.whole_program)
+            module, counts = loops.optimize(module, options.licm, options.strength_reduce, options.unroll)
+            # what the loop passes leave behind (old induction variables,
+            # constants of unrolled iterations) is for the ssa passes again
+            module, again = ssa.optimize(module)
+        if stats is not None:
+            for name, removed in report + again:
+                stats.count(f"{name}_removed", removed)
+            for name, count in (calls | counts).items():
+                stats.count(name, count)
+    return module
+
+
+def write_backend(ast, options, out, stats=None):
+    """ Writes the ir (--emit-ir) or the assembly (-a) of the ast to out. """
+    module = lower_ast(ast, options, stats)
+    if options.emit_ir:
+        with instrument.measure(stats, 'print'):
+            ir.write(module, out)
+        return
+    with instrument.measure(stats, 'codegen'):
+        text = codegen.generate(module)
+    with instrument.measure(stats, 'print'):
+        out.write(text)
+
+
+def run_program(ast, path, out, stats=None):
+    """ Runs main of the ast for --run, returns a diagnostic when it did not return 0. """
+    with instrument.measure(stats, 'translate'):
+        program = closures.Program(ast, out)
+    with instrument.measure(stats, 'run'):
+        code = program.run()
+    if code:
+        return f"Error: {path} exited with {code}"
+    return None
+
+
+def compile_file(path, options, out, stats=None):
+    """ Compiles one file writing what it prints to out, returns a diagnostic or None. """
+    try:
+        loaded = load_program(path, stats)
+        if loaded is not None:
+            tokens, ast = loaded
+            if options.tokens_only:
+                with instrument.measure(stats, 'print'):
+                    out.write(f"{[tok[:2] for tok in tokens if tok[0] != 'EOF']}\n")
+                return None
+            if stats is not None:
+                stats.count('tokens', len(tokens))
+                stats.count('nodes', parse.count_nodes(ast))
+            return compile_tree(path, tokens or None, ast, options, out, stats)
+        if options.stream:
+            directives = []
+
+            def tap(tokens):
+                # the parser skips directives, they are kept on the way
+                for token in tokens:
+                    if token[0] == 'DIRECTIVE':
+                        directives.append(token)
+                    yield token
+
+            with open(path, "r") as file:
+                with instrument.measure(stats, 'stream'):
+                    # the parser pulls tokens while the file is being read
+                    ast = parse.Parser(tap(stream_tokens(file))).parse_program()
+                if stats is not None:
+                    stats.count('bytes', file.tell())
+            if stats is not None:
+                stats.count('nodes', parse.count_nodes(ast))
+            return compile_tree(path, None, ast, options, out, stats, directives)
+        with instrument.measure(stats, 'read'):
+            # -t prints get_tokens, which lexes text
+            content = read_source(path, options.mmap and not options.tokens_only)
+        if options.tokens_only:
+            with instrument.measure(stats, 'lex'):
                 tokens = get_tokens(content)
+            with instrument.measure(stats, 'print'):
+                out.write(f"{tokens}\n")
+            if stats is not None:
+                stats.count('bytes', len(content))
+                stats.count('tokens', len(tokens))
+            return None
+        tokens, ast = compile_source(content, options.use_cache, stats, options.lex_jobs)
+        if stats is not None:
+            stats.count('bytes', len(content))
+            stats.count('tokens', len(tokens))
+            stats.count('nodes', parse.count_nodes(ast))
+        return compile_tree(path, tokens, ast, options, out, stats)
+    except Exception as error:
+        return describe(path, error)
+
+
+def compile_tree(path, tokens, ast, options, out, stats=None, directives=None):
+    """ What compile_file does once the file is parsed, tokens are printed
+    with the ast unless None. The libraries it uses are found among tokens,
+    or directives when there are none (--stream). Returns a diagnostic or None.
+    """
+    ast = optimize_ast(ast, options, stats)
+    if options.run or options.asm or options.emit_ir:
+        with instrument.measure(stats, 'import'):
+            imported = modules.imports(tokens if tokens is not None else directives or (),
+                                       os.path.dirname(path), options.include_dirs)
+        if stats is not None:
+            stats.count('imported', len(imported))
+        ast = modules.link(ast, imported)
+    if options.run:
+        return run_program(ast, path, out, stats)
+    if options.asm or options.emit_ir:
+        if options.output is None:
+            write_backend(ast, options, out, stats)
+        else:
+            with open(options.output, "w") as file:
+                write_backend(ast, options, file, stats)
+        return None
+    if options.output is not None:
+        with instrument.measure(stats, 'print'):
+            serialize.dump(ast, options.output, tokens or ())
+        return None
+    with instrument.measure(stats, 'print'):
+        if tokens is not None:
             # Debug:
-            # Add this to verify EOF works: print(tokens[-1])
-            tokens.append(('EOF', 'EOF'))
-            print(tokens)
-            print("\n")
-            parse.main(tokens)
-        except FileNotFoundError as error:
-            try:
-                args()
-            except:
-                print(f"Error: file not found {sys.argv[1]}")
-                sys.exit(1)
-        except OSError as error:
-            print(f"Error reading file: {error}")
-            sys.exit(1)
-
-        except SyntaxError as error:
-            print(f"Syntax error: {error}")
-            sys.exit(1)
-        except Exception as error:
-            print(f"Lexing error: {error}")
-            sys.exit(1)
+            # Add this to verify EOF works: print(tokens[len(tokens) - 1])
+            out.write(f"{[tok[:2] for tok in tokens]}\n\n\n")
+        parse.write_pretty(ast, out)
+        out.write("\n")
+    return None
+
+
+def load_program(path, stats=None):
+    """ Tokens and ast of a file -o wrote, None when path is anything else. """
+    with open(path, "rb") as file:
+        if not serialize.is_binary(file.read(len(serialize.MAGIC))):
+            return None
+    with instrument.measure(stats, 'read'):
+        with serialize.load(path) as reader:
+            return reader.tokens(), reader.program()
+
+
+def describe(path, error):
+    """ The diagnostic printed for an error compiling path. """
+    match error:
+        case FileNotFoundError():
+            return f"Error: file not found {path}"
+        case OSError():
+            return f"Error reading file: {error}"
+        case serialize.FormatError():
+            return f"Error: {path}: {error}"
+        case SyntaxError():
+            return f"Syntax error: {error}"
+        case structure.ResolveError():
+            return f"Name error: {error}"
+        case ir.LoweringError():
+            return f"Codegen error: {error}"
+        case closures.RunError():
+            return f"Runtime error: {error}"
+    # the lexer raises nothing of its own, whatever else fails (a ValueError
+    # in codegen or while running) is not put down to a phase
+    return f"Error: {type(error).__name__}: {error}"
+
+
+def run_file(path, options, out):
+    """ compile_file with the stats the options ask for, returns (diagnostic, stats dict or None). """
+    stats = None
+    if options.stats or options.stats_json or options.profile:
+        stats = instrument.Stats(profile=options.profile)
+    if stats is None:
+        return compile_file(path, options, out), None
+    try:
+        error = compile_file(path, options, out, stats)
+    finally:
+        stats.close()
+    if stats.profiler is not None:
+        stats.profiler.dump_stats(f"{os.path.basename(path)}.{options.profile}.prof")
+    return error, stats.to_dict()
+
+
+def compile_captured(path, options):
+    """ run_file for a worker process, the output comes back as a string. """
+    out = io.StringIO()
+    error, stats = run_file(path, options, out)
+    return out.getvalue(), error, stats
+
+
+def compile_all(options, out):
+    """ Compiles every file to out in command line order, returns how many failed. """
+    files = options.files
+    header = len(files) > 1
+    failed = 0
+    entries = []
+
+    def finish(path, error, stats):
+        nonlocal failed
+        if error is not None:
+            out.write(error + "\n")
+            failed += 1
+        if stats is not None:
+            if options.stats:
+                out.flush()
+                instrument.report(stats, path, sys.stderr)
+            entries.append({'file': path, **stats})
+
+    if options.jobs > 1 and len(files) > 1:
+        with ProcessPoolExecutor(min(options.jobs, len(files))) as pool:
+            # map hands results back in submission order whatever finishes first
+            for path, (output, error, stats) in zip(files, pool.map(compile_captured, files, repeat(options))):
+                if header:
+                    out.write(f"==> {path} <==\n")
+                out.write(output)
+                finish(path, error, stats)
     else:
+        for path in files:
+            if header:
+                out.write(f"==> {path} <==\n")
+            error, stats = run_file(path, options, out)
+            finish(path, error, stats)
+
+    if options.stats_json:
+        instrument.write_json(entries, options.stats_json)
+    return failed
+
+
+def recompile(path, options, documents, out):
+    """ Compiles path again for --watch from its Document, returns a diagnostic or None. """
+    try:
+        with open(path, "r") as file:
+            content = file.read()
+        document = documents.get(path)
+        if document is None:
+            document = documents[path] = incremental.Document(content)
+        else:
+            document.update(content)
+        if options.tokens_only:
+            out.write(f"{[tok[:2] for tok in document.tokens][:-1]}\n")
+            return None
+        ast = document.program
+        if options.optimize or options.run or options.asm or options.emit_ir:
+            # the passes change the tree in place, the document keeps its own
+            ast = pickle.loads(pickle.dumps(ast, pickle.HIGHEST_PROTOCOL))
+        return compile_tree(path, document.tokens, ast, options, out)
+    except Exception as error:
+        return describe(path, error)
+
+
+def watch(options, out):
+    """ Compiles every file, then each one again when it changes, until ctrl-c. """
+    documents = {}
+    stamps = {}
+    try:
+        while True:
+            for path in options.files:
+                try:
+                    stamp = os.stat(path).st_mtime_ns
+                except OSError:
+                    stamp = None
+                if path in stamps and stamps[path] == stamp:
+                    continue
+                stamps[path] = stamp
+                start = time.perf_counter()
+                out.write(f"==> {path} <==\n")
+                error = recompile(path, options, documents, out)
+                if error is not None:
+                    out.write(error + "\n")
+                out.flush()
+                document = documents.get(path)
+                if document is not None:
+                    print(f"{path}: {document.lexed} tokens lexed, {document.parsed} declarations parsed, "
+                          f"{(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        return 0
+
+
+def run(argv, out):
+    """ One command line, argv without the program name, returns the exit status. """
+    options = args(argv)
+    if not options.files:
         error_msg = f"Usage: main.py [option...] [file..]"
         print(error_msg)
-        sys.exit(1)
+        return 1
+
+    if options.output is not None and len(options.files) > 1:
+        print("Error: -o takes one input file")
+        return 1
+    if options.watch:
+        return watch(options, out)
+    failed = compile_all(options, out)
+    return 1 if failed else 0
+
+
+def main():
+    sys.exit(run(sys.argv[1:], sys.stdout))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+import glob
+import hashlib
+import os
+import re
+from typing import List
+
+import cache
+import serialize
+from lexer import tokenize
+from parser import Declaration, Function, Parser, Program
+
+# libraries a file pulls in with using <library> or #include, seen through
+# their interface: a prototype for each function and an extern declaration
+# for each global, what a C header would hold. the language has no structs
+# or named constants to carry yet.
+#
+# the interface of a library is parsed from its source once and kept as a
+# program file (serialize) in MODULE_DIR, named after the library's path and
+# the compiler version, then its mtime and size. a later compile finds it
+# with a stat and reads the declarations alone, the source is not opened; a
+# library that changed has another name and is parsed again, its older
+# module is dropped.
+
+MODULE_DIR = os.path.join(cache.CACHE_DIR, "modules")
+
+Include = re.compile(r'#\s*include\s*(?:"([^"\n]+)"|<([^>\n]+)>)')
+Using = re.compile(r'using\s*<([^>\n]+)>')
+
+
+def directives(tokens):
+    """ [kind, name, quoted] of each #include and using among tokens, read
+    from their DIRECTIVE tokens so none in a comment or a string counts.
+    """
+    found = []
+    for token in tokens:
+        if token[0] != 'DIRECTIVE':
+            continue
+        match = Include.match(token[1])
+        if match is not None:
+            quoted = match.group(1) is not None
+            found.append(['include', match.group(1) if quoted else match.group(2).strip(), quoted])
+            continue
+        match = Using.match(token[1])
+        if match is not None:
+            found.append(['using', match.group(1).strip(), False])
+    return found
+
+
+def locate(directive, here, include_dirs):
+    """ The file a directive names, None for one that is not found (stdio.h).
+
+    #include "file" is looked for in here, the directory of the including
+    file, then in include_dirs; #include <file> only in those; using
+    <library> is library.ctri in here, then in include_dirs.
+    """
+    kind, name, quoted = directive
+    if kind == 'using':
+        name += '.ctri'
+        places = [here] + include_dirs
+    else:
+        places = ([here] if quoted else []) + include_dirs
+    for place in places:
+        path = os.path.normpath(os.path.join(place, name))
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def interface(program) -> List[Declaration]:
+    """ What other files see of a program: its functions as prototypes and
+    its globals as extern declarations, each name once, main left out.
+    """
+    declarations = []
+    seen = set()
+    for decl in program.declarations:
+        if decl.name in seen or decl.name == 'main':
+            continue
+        seen.add(decl.name)
+        if isinstance(decl, Function):
+            declarations.append(Declaration(f"{decl.ret_type} (func prototype)", decl.name, None))
+        elif decl.var_type.endswith(('(func prototype)', '(extern)')):
+            declarations.append(Declaration(decl.var_type, decl.name, None))
+        else:
+            declarations.append(Declaration(f"{decl.var_type} (extern)", decl.name, None))
+    return declarations
+
+
+def module_prefix(path):
+    digest = hashlib.sha256(cache.compiler_version().encode())
+    digest.update(os.path.abspath(path).encode())
+    return os.path.join(MODULE_DIR, digest.hexdigest()[:32])
+
+
+def load(path) -> List[Declaration]:
+    """ The interface of the library at path, from its module when the
+    library did not change since it was made.
+    """
+    stat = os.stat(path)
+    prefix = module_prefix(path)
+    entry = f"{prefix}-{stat.st_mtime_ns}-{stat.st_size}.hb"
+    try:
+        with serialize.load(entry) as reader:
+            return reader.program().declarations
+    except (OSError, serialize.FormatError):
+        pass
+    with open(path, "r") as file:
+        declarations = interface(Parser(tokenize(file.read())).parse_program())
+    try:
+        os.makedirs(MODULE_DIR, exist_ok=True)
+        for old in glob.glob(f"{glob.escape(prefix)}-*.hb"):
+            os.remove(old)
+        # written under a temporary name so a reader never sees half a file
+        temp = f"{entry}.{os.getpid()}.tmp"
+        serialize.dump(Program(declarations), temp)
+        os.replace(temp, entry)
+    except OSError:
+        pass
+    return declarations
+
+
+def imports(tokens, here, include_dirs=()) -> List[Declaration]:
+    """ The interfaces of the libraries the directives among tokens name, in
+    order, each library and each name once.
+    """
+    declarations = []
+    libraries = set()
+    names = set()
+    for directive in directives(tokens):
+        path = locate(directive, here, list(include_dirs))
+        if path is None or path in libraries:
+            continue
+        libraries.add(path)
+        for decl in load(path):
+            if decl.name not in names:
+                names.add(decl.name)
+                declarations.append(decl)
+    return declarations
+
+
+def link(program, declarations) -> Program:
+    """ program with the imported declarations in front of its own. """
+    if not declarations:
+        return program
+    return Program(declarations + program.declarations)
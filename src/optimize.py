@@ -0,0 +1,216 @@
+from parser import (Compound, Declaration, If, While, For, Return, ExprStmt, Binary,
+                    Unary, Literal, Var, ArrayAccess, NodeTransformer, count_nodes)
+
+# optimization passes over the ast. a pass is a function taking the Program and
+# returning it (changed in place or rebuilt), the PassManager runs them in order
+# and counts how many nodes each one took out. the passes here are
+# NodeTransformers run with transform(), children before parents
+
+
+class PassManager:
+    def __init__(self, passes=None, size=None):
+        self.passes = list(DEFAULT_PASSES if passes is None else passes)
+        # what removed is counted in, nodes of an ast unless told otherwise
+        self.size = size or count_nodes
+
+    def add(self, name, func):
+        self.passes.append((name, func))
+        return self
+
+    def run(self, program):
+        """ Runs every pass, returns the program and a list of (pass name, nodes removed). """
+        report = []
+        before = self.size(program)
+        for name, func in self.passes:
+            program = func(program)
+            after = self.size(program)
+            report.append((name, before - after))
+            before = after
+        return program, report
+
+
+def is_constant(node):
+    return isinstance(node, Literal) and type(node.value) in (int, float)
+
+def is_pure(node):
+    """ True when evaluating node can not change anything, so it can be dropped. """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (Literal, Var)):
+            continue
+        if isinstance(node, Binary):
+            stack += [node.left, node.right]
+        elif isinstance(node, Unary) and node.op not in ('++', '--'):
+            stack.append(node.operand)
+        elif isinstance(node, ArrayAccess):
+            stack += [node.array, node.index]
+        else:
+            return False
+    return True
+
+
+# constant folding, with C rules: int division truncates toward zero and
+# comparisons give 0 or 1. division by zero is left for run time
+def _div(a, b):
+    if b == 0:
+        return None
+    if type(a) is int and type(b) is int:
+        q = abs(a) // abs(b)
+        return q if (a < 0) == (b < 0) else -q
+    return a / b
+
+def _mod(a, b):
+    if b == 0 or type(a) is not int or type(b) is not int:
+        return None
+    return a - b * _div(a, b)
+
+FOLD_BINARY = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': _div,
+    '%': _mod,
+    '<': lambda a, b: int(a < b),
+    '>': lambda a, b: int(a > b),
+    '<=': lambda a, b: int(a <= b),
+    '>=': lambda a, b: int(a >= b),
+    '==': lambda a, b: int(a == b),
+    '!=': lambda a, b: int(a != b),
+    '&&': lambda a, b: int(bool(a) and bool(b)),
+    '||': lambda a, b: int(bool(a) or bool(b)),
+    '&': lambda a, b: a & b if type(a) is int and type(b) is int else None,
+    '|': lambda a, b: a | b if type(a) is int and type(b) is int else None,
+    '^': lambda a, b: a ^ b if type(a) is int and type(b) is int else None,
+    '<<': lambda a, b: a << b if type(a) is int and type(b) is int and 0 <= b < 64 else None,
+    '>>': lambda a, b: a >> b if type(a) is int and type(b) is int and 0 <= b < 64 else None,
+}
+
+FOLD_UNARY = {
+    '-': lambda a: -a,
+    '+': lambda a: a,
+    '!': lambda a: int(not a),
+    '~': lambda a: ~a if type(a) is int else None,
+}
+
+class FoldConstants(NodeTransformer):
+    def visit_Binary(self, node):
+        fold = FOLD_BINARY.get(node.op)
+        if fold is not None and is_constant(node.left) and is_constant(node.right):
+            value = fold(node.left.value, node.right.value)
+            if value is not None:
+                return Literal(value=value)
+        # && and || skip their right side, so a constant left side decides them
+        if node.op in ('&&', '||') and is_constant(node.left):
+            if node.op == '&&' and not node.left.value:
+                return Literal(value=0)
+            if node.op == '||' and node.left.value:
+                return Literal(value=1)
+        return node
+
+    def visit_Unary(self, node):
+        if node.prefix:
+            fold = FOLD_UNARY.get(node.op)
+            if fold is not None and is_constant(node.operand):
+                value = fold(node.operand.value)
+                if value is not None:
+                    return Literal(value=value)
+        return node
+
+def fold_constants(program):
+    return FoldConstants().transform(program)
+
+
+# algebraic identities. only ones that hold for ints and for the float
+# values C programs meet, and only dropping operands that are pure
+def _is(node, value):
+    return is_constant(node) and type(node.value) is int and node.value == value
+
+class Simplify(NodeTransformer):
+    def visit_Binary(self, node):
+        left, right, op = node.left, node.right, node.op
+        if op == '+':
+            if _is(right, 0):
+                return left
+            if _is(left, 0):
+                return right
+        elif op == '-':
+            if _is(right, 0):
+                return left
+        elif op == '*':
+            if _is(right, 1):
+                return left
+            if _is(left, 1):
+                return right
+            if (_is(right, 0) and is_pure(left)) or (_is(left, 0) and is_pure(right)):
+                return Literal(value=0)
+        elif op == '/':
+            if _is(right, 1):
+                return left
+        return node
+
+    def visit_Unary(self, node):
+        if node.prefix and node.op in ('-', '~'):
+            # - - x and ~ ~ x are x
+            inner = node.operand
+            if isinstance(inner, Unary) and inner.prefix and inner.op == node.op:
+                return inner.operand
+        return node
+
+def simplify(program):
+    return Simplify().transform(program)
+
+
+# unreachable statements: whatever follows a return in the same block, branches
+# of an if whose condition is constant, loops that never run
+def _truthy(node):
+    return is_constant(node) and bool(node.value)
+
+def _falsy(node):
+    return is_constant(node) and not node.value
+
+class RemoveUnreachable(NodeTransformer):
+    def visit_Compound(self, node):
+        stmts = []
+        for stmt in node.stmts:
+            if isinstance(stmt, Compound) and not stmt.stmts:
+                continue
+            stmts.append(stmt)
+            if isinstance(stmt, Return):
+                break
+        node.stmts = stmts
+        return node
+
+    def visit_If(self, node):
+        if _truthy(node.cond):
+            return node.then_branch
+        if _falsy(node.cond):
+            return node.else_branch
+        return node
+
+    def visit_While(self, node):
+        return None if _falsy(node.cond) else node
+
+    def visit_For(self, node):
+        # the init still runs once, in a block of its own like the loop's scope
+        if node.cond is not None and _falsy(node.cond):
+            if node.init is None:
+                return None
+            init = node.init if isinstance(node.init, Declaration) else ExprStmt(expr=node.init)
+            return Compound(stmts=[init])
+        return node
+
+def remove_unreachable(program):
+    return RemoveUnreachable().transform(program)
+
+
+DEFAULT_PASSES = [
+    ('fold_constants', fold_constants),
+    ('simplify', simplify),
+    ('remove_unreachable', remove_unreachable),
+]
+
+
+def optimize(program, passes=None):
+    """ Runs the default pipeline (or passes), returns the program and the report. """
+    return PassManager(passes).run(program)
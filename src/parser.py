@@ -1,114 +1,201 @@
-from dataclasses import dataclass
-from typing import List, Optional, Any, Tuple
-from lexer import Tokens as Token
-
-# ast data classes
-@dataclass
+import io
+import sys
+from dataclasses import dataclass, field, fields
+from typing import Dict, List, Optional, Any, Tuple
+from lexer import Token, EOF
+
+# ast data classes, slotted so nodes carry no __dict__
+@dataclass(slots=True)
 class Node:
     pass
 
-@dataclass
+@dataclass(slots=True)
 class Program(Node):
     declarations: List[Node]
 
-@dataclass
+@dataclass(slots=True)
 class Function(Node):
     ret_type: str
     name: str
     params: List[Tuple[str, str]]
     body: Node
+    # params and locals in slot order, set by structure.resolve
+    frame: Any = field(default=None, compare=False, repr=False)
 
-@dataclass
+@dataclass(slots=True)
 class Declaration(Node):
     var_type: str
     name: str
     initializer: Optional[Node]
+    # the structure.Symbol declared, set by structure.resolve
+    binding: Any = field(default=None, compare=False, repr=False)
 
-@dataclass
+@dataclass(slots=True)
 class Compound(Node):
     stmts: List[Node]
 
-@dataclass
+@dataclass(slots=True)
 class If(Node):
     cond: Node
     then_branch: Node
     else_branch: Optional[Node]
 
-@dataclass
+@dataclass(slots=True)
 class While(Node):
     cond: Node
     body: Node
 
-@dataclass
+@dataclass(slots=True)
 class For(Node):
     init: Optional[Node]
     cond: Optional[Node]
     post: Optional[Node]
     body: Node
 
-@dataclass
+@dataclass(slots=True)
 class Return(Node):
     expr: Optional[Node]
 
-@dataclass
+@dataclass(slots=True)
 class ExprStmt(Node):
     expr: Optional[Node]
 
-@dataclass
+@dataclass(slots=True)
 class Binary(Node):
     op: str
     left: Node
     right: Node
 
-@dataclass
+@dataclass(slots=True)
 class Unary(Node):
     op: str
     operand: Node
     prefix: bool = True
 
-@dataclass
+@dataclass(slots=True)
 class Literal(Node):
     value: Any
 
-@dataclass
+@dataclass(slots=True)
 class Var(Node):
     name: str
+    # the structure.Symbol the name refers to, set by structure.resolve
+    binding: Any = field(default=None, compare=False, repr=False)
 
-@dataclass
+@dataclass(slots=True)
 class Assignment(Node):
     target: Node
     value: Node
 
-@dataclass
+@dataclass(slots=True)
 class Call(Node):
     callee: Node
     args: List[Node]
 
-@dataclass
+@dataclass(slots=True)
 class ArrayAccess(Node):
     array: Node
     index: Node
 
+class LeafArena:
+    """ Hands out one shared Var per name and one Literal per value. """
+    def __init__(self):
+        self.vars = {}
+        self.literals = {}
+
+    def __len__(self):
+        return len(self.vars) + len(self.literals)
+
+    def var(self, name):
+        node = self.vars.get(name)
+        if node is None:
+            node = self.vars[name] = Var(name=name)
+        return node
+
+    def literal(self, value):
+        # 1, 1.0 and True are equal keys, the type keeps them apart
+        key = (type(value), value)
+        node = self.literals.get(key)
+        if node is None:
+            node = self.literals[key] = Literal(value=value)
+        return node
+
+# binary operators by token, with their precedence (higher binds tighter)
+BINARY_OPS = {
+    'OR': (1, '||'),
+    'AND': (2, '&&'),
+    'BITOR': (3, '|'),
+    'XOR': (4, '^'),
+    'BITAND': (5, '&'),
+    'EQ': (6, '=='),
+    'NE': (6, '!='),
+    'LT': (7, '<'),
+    'GT': (7, '>'),
+    'LE': (7, '<='),
+    'GE': (7, '>='),
+    'LSHIFT': (8, '<<'),
+    'RSHIFT': (8, '>>'),
+    'PLUS': (9, '+'),
+    'MINUS': (9, '-'),
+    'MULTIPLY': (10, '*'),
+    'DIVIDE': (10, '/'),
+    'MODULO': (10, '%'),
+}
+
+PREFIX_OPS = {
+    'PLUS': '+',
+    'MINUS': '-',
+    'NOT': '!',
+    'TILDE': '~',
+    'INCREMENT': '++',
+    'DECREMENT': '--',
+}
+
 # parser
 class Parser:
-    def __init__(self, tokens, var=None):
+    def __init__(self, tokens, var=None, arena=None):
         self.var = var
-        self.tokens = tokens
+        # with a LeafArena, leaves are shared between all their uses and must
+        # not be changed in place
+        self.make_var = arena.var if arena is not None else Var
+        self.make_literal = arena.literal if arena is not None else Literal
+        # tokens can be a list or a generator (lexer.stream_tokens), they are
+        # pulled one at a time so only the lookahead token is held here
+        self.tokens = iter(tokens)
+        # a TokenArray can turn offsets into lines and columns
+        self.line_col = getattr(tokens, 'line_col', None)
+        self.current = self.pull()
         self.i = 0
 
+    def pull(self) -> Token:
+        # comments and directives are tokens too, the grammar never sees them
+        for tok in self.tokens:
+            if tok[0] not in ('COMMENT_MULTI', 'COMMENT_LINE', 'DIRECTIVE'):
+                return tok
+        return EOF
+
     def peek(self) -> Token:
-        return self.tokens[self.i]
+        return self.current
 
     def advance(self) -> Token:
-        tok = self.tokens[self.i]
+        tok = self.current
+        self.current = self.pull()
         self.i += 1
         return tok
 
+    def where(self, tok: Token) -> str:
+        if len(tok) < 3:
+            return "end of input" if tok[0] == 'EOF' else "unknown position"
+        if self.line_col is None:
+            return f"offset {tok[2]}"
+        line, col = self.line_col(tok[2])
+        return f"line {line}, column {col}"
+
     def expect(self, type_name: str) -> Token:
         tok = self.peek()
         if tok[0] == type_name:
             return self.advance()
-        raise SyntaxError(f"Expected {type_name} at pos {tok[2]}, got {tok[0]} ({tok[1]!r})")
+        raise SyntaxError(f"Expected {type_name} at {self.where(tok)}, got {tok[0]} ({tok[1]!r})")
 
     def accept(self, type_name: str) -> Optional[Token]:
         tok = self.peek()
@@ -135,7 +222,7 @@ def parse_external(self) -> Node:
                     while True:
                         ptype_tok = self.peek()
                         if ptype_tok[0] not in ('INT','CHAR','VOID','FLOAT','DOUBLE','LONG','SHORT','SIGNED','UNSIGNED','STRUCT','UNION','ENUM','BOOLEAN'):
-                            raise SyntaxError(f"Expected type in parameter list at pos {ptype_tok[2]} got {ptype_tok[0]}")
+                            raise SyntaxError(f"Expected type in parameter list at {self.where(ptype_tok)} got {ptype_tok[0]}")
                         ptype = self.advance()[1]
                         pname_tok = self.expect('IDENTIFIER')
                         pname = pname_tok[1]
@@ -159,7 +246,7 @@ def parse_external(self) -> Node:
                 self.expect('SEMICOLON')
                 return Declaration(var_type=typ, name=name, initializer=init)
         else:
-            raise SyntaxError(f"Unexpected token at top-level: {t}")
+            raise SyntaxError(f"Unexpected token at top-level at {self.where(t)}: {t[0]} ({t[1]!r})")
 
     # statements
     def parse_statement(self) -> Node:
@@ -249,143 +336,40 @@ def parse_expression(self) -> Node:
 
     def parse_assignment(self) -> Node:
         node = self.parse_conditional()
-        if self.accept('ASSIGN'):
+        if self.current[0] == 'ASSIGN':
+            self.advance()
             rhs = self.parse_assignment()
             return Assignment(target=node, value=rhs)
         return node
 
     def parse_conditional(self) -> Node:
-        node = self.parse_logical_or()
-        if self.accept('QUESTION'):
+        node = self.parse_binary(1)
+        if self.current[0] == 'QUESTION':
+            self.advance()
             true_expr = self.parse_expression()
             self.expect('COLON')
             false_expr = self.parse_conditional()  # right associative
             return Binary(op='?:', left=node, right=Binary(op='branch', left=true_expr, right=false_expr))
         return node
 
-    def parse_logical_or(self) -> Node:
-        node = self.parse_logical_and()
-        while self.accept('OR'):
-            rhs = self.parse_logical_and()
-            node = Binary(op='||', left=node, right=rhs)
-        return node
-
-    def parse_logical_and(self) -> Node:
-        node = self.parse_bitwise_or()
-        while self.accept('AND'):
-            rhs = self.parse_bitwise_or()
-            node = Binary(op='&&', left=node, right=rhs)
-        return node
-
-    def parse_bitwise_or(self) -> Node:
-        node = self.parse_bitwise_xor()
-        while self.accept('BITOR'):
-            rhs = self.parse_bitwise_xor()
-            node = Binary(op='|', left=node, right=rhs)
-        return node
-
-    def parse_bitwise_xor(self) -> Node:
-        node = self.parse_bitwise_and()
-        while self.accept('XOR'):
-            rhs = self.parse_bitwise_and()
-            node = Binary(op='^', left=node, right=rhs)
-        return node
-
-    def parse_bitwise_and(self) -> Node:
-        node = self.parse_equality()
-        while self.accept('BITAND'):
-            rhs = self.parse_equality()
-            node = Binary(op='&', left=node, right=rhs)
-        return node
-
-    def parse_equality(self) -> Node:
-        node = self.parse_relational()
-        while True:
-            if self.accept('EQ'):
-                rhs = self.parse_relational()
-                node = Binary(op='==', left=node, right=rhs)
-            elif self.accept('NE'):
-                rhs = self.parse_relational()
-                node = Binary(op='!=', left=node, right=rhs)
-            else:
-                break
-        return node
-
-
-    def parse_relational(self) -> Node:
-        node = self.parse_shifts()
-        while True:
-            if self.accept('LT'):
-                rhs = self.parse_shifts()
-                node = Binary(op='<', left=node, right=rhs)
-            elif self.accept('GT'):
-                rhs = self.parse_shifts()
-                node = Binary(op='>', left=node, right=rhs)
-            elif self.accept('LE'):
-                rhs = self.parse_shifts()
-                node = Binary(op='<=', left=node, right=rhs)
-            elif self.accept('GE'):
-                rhs = self.parse_shifts()
-                node = Binary(op='>=', left=node, right=rhs)
-            else:
-                break
-        return node
-
-    def parse_shifts(self) -> Node:
-        node = self.parse_additive()
-        while True:
-            if self.accept('LSHIFT'):
-                rhs = self.parse_additive()
-                node = Binary(op='<<', left=node, right=rhs)
-            elif self.accept('RSHIFT'):
-                rhs = self.parse_additive()
-                node = Binary(op='>>', left=node, right=rhs)
-            else:
-                break
-        return node
-
-    def parse_additive(self) -> Node:
-        node = self.parse_multiplicative()
-        while True:
-            if self.accept('PLUS'):
-                rhs = self.parse_multiplicative()
-                node = Binary(op='+', left=node, right=rhs)
-            elif self.accept('MINUS'):
-                rhs = self.parse_multiplicative()
-                node = Binary(op='-', left=node, right=rhs)
-            else:
-                break
-        return node
-
-    def parse_multiplicative(self) -> Node:
+    def parse_binary(self, min_prec: int) -> Node:
+        # precedence climbing over BINARY_OPS, every level is left associative:
+        # the right operand only takes operators that bind tighter
         node = self.parse_unary()
         while True:
-            if self.accept('MULTIPLY'):
-                rhs = self.parse_unary()
-                node = Binary(op='*', left=node, right=rhs)
-            elif self.accept('DIVIDE'):
-                rhs = self.parse_unary()
-                node = Binary(op='/', left=node, right=rhs)
-            elif self.accept('MODULO'):
-                rhs = self.parse_unary()
-                node = Binary(op='%', left=node, right=rhs)
-            else:
-                break
-        return node
+            entry = BINARY_OPS.get(self.current[0])
+            if entry is None or entry[0] < min_prec:
+                return node
+            prec, op = entry
+            self.advance()
+            rhs = self.parse_binary(prec + 1)
+            node = Binary(op=op, left=node, right=rhs)
 
     def parse_unary(self) -> Node:
-        if self.accept('PLUS'):
-            return Unary(op='+', operand=self.parse_unary(), prefix=True)
-        if self.accept('MINUS'):
-            return Unary(op='-', operand=self.parse_unary(), prefix=True)
-        if self.accept('NOT'):
-            return Unary(op='!', operand=self.parse_unary(), prefix=True)
-        if self.accept('TILDE'):
-            return Unary(op='~', operand=self.parse_unary(), prefix=True)
-        if self.accept('INCREMENT'):
-            return Unary(op='++', operand=self.parse_unary(), prefix=True)
-        if self.accept('DECREMENT'):
-            return Unary(op='--', operand=self.parse_unary(), prefix=True)
+        op = PREFIX_OPS.get(self.current[0])
+        if op is not None:
+            self.advance()
+            return Unary(op=op, operand=self.parse_unary(), prefix=True)
         return self.parse_postfix()
 
     def parse_postfix(self) -> Node:
@@ -417,104 +401,295 @@ def parse_primary(self) -> Node:
         tok = self.peek()
         if tok[0] == 'IDENTIFIER':
             self.advance()
-            return Var(name=tok[1])
+            return self.make_var(tok[1])
         if tok[0] == 'STRING_LITERAL':
             self.advance()
-            return Literal(value=tok[1])
+            return self.make_literal(tok[1])
         if tok[0] == 'CHAR_LITERAL':
             self.advance()
-            return Literal(value=tok[1])
+            return self.make_literal(tok[1])
         if tok[0] == 'FLOAT_LITERAL':
             self.advance()
             try:
                 val = float(tok[1])
             except:
                 val = tok[1]
-            return Literal(value=val)
+            return self.make_literal(val)
         if tok[0] == 'HEX_LITERAL':
             self.advance()
-            return Literal(value=int(tok[1], 16))
+            return self.make_literal(int(tok[1], 16))
         if tok[0] == 'BIN_LITERAL':
             self.advance()
-            return Literal(value=int(tok[1], 2))
+            return self.make_literal(int(tok[1], 2))
         if tok[0] == 'INT_LITERAL':
             self.advance()
-            return Literal(value=int(tok[1]))
+            return self.make_literal(int(tok[1]))
         if tok[0] == 'LPAREN':
             self.advance()
             e = self.parse_expression()
             self.expect('RPAREN')
             return e
-        raise SyntaxError(f"Unexpected token in expression at pos {tok[2]}: {tok}")
+        raise SyntaxError(f"Unexpected token in expression at {self.where(tok)}: {tok[0]} ({tok[1]!r})")
 
 # pretty printer for ast
+# each function gives the lines of one node in order, a (child, indent) tuple
+# stands for the whole dump of that child
+def _pretty_program(node, pad, indent):
+    return [pad + "Program:\n"] + [(d, indent+1) for d in node.declarations]
+
+def _pretty_function(node, pad, indent):
+    return [pad + f"Function: {node.ret_type} {node.name}({', '.join(t+' '+n for t,n in node.params)})\n", (node.body, indent+1)]
+
+def _pretty_declaration(node, pad, indent):
+    if node.initializer:
+        return [pad + f"Declaration: {node.var_type} {node.name} =\n", (node.initializer, indent+1)]
+    return [pad + f"Declaration: {node.var_type} {node.name}\n"]
+
+def _pretty_compound(node, pad, indent):
+    return [pad + "Compound:\n"] + [(st, indent+1) for st in node.stmts]
+
+def _pretty_if(node, pad, indent):
+    items = [pad + "If:\n" + pad + "  Cond:\n", (node.cond, indent+2), pad + "  Then:\n", (node.then_branch, indent+2)]
+    if node.else_branch:
+        items += [pad + "  Else:\n", (node.else_branch, indent+2)]
+    return items
+
+def _pretty_while(node, pad, indent):
+    return [pad + "While:\n" + pad + "  Cond:\n", (node.cond, indent+2), pad + "  Body:\n", (node.body, indent+2)]
+
+def _pretty_for(node, pad, indent):
+    return [
+        pad + "For:\n" + pad + "  Init:\n", (node.init, indent+2) if node.init else pad + "    <none>\n",
+        pad + "  Cond:\n", (node.cond, indent+2) if node.cond else pad + "    <none>\n",
+        pad + "  Post:\n", (node.post, indent+2) if node.post else pad + "    <none>\n",
+        pad + "  Body:\n", (node.body, indent+2),
+    ]
+
+def _pretty_return(node, pad, indent):
+    return [pad + "Return:\n", (node.expr, indent+1) if node.expr else pad + "  <none>\n"]
+
+def _pretty_exprstmt(node, pad, indent):
+    return [pad + "ExprStmt:\n", (node.expr, indent+1) if node.expr else pad + "  <none>\n"]
+
+def _pretty_binary(node, pad, indent):
+    return [pad + f"Binary({node.op}):\n", (node.left, indent+1), (node.right, indent+1)]
+
+def _pretty_unary(node, pad, indent):
+    return [pad + f"Unary({'prefix' if node.prefix else 'postfix'} {node.op}):\n", (node.operand, indent+1)]
+
+def _pretty_literal(node, pad, indent):
+    return [pad + f"Literal({node.value})\n"]
+
+def _pretty_var(node, pad, indent):
+    return [pad + f"Var({node.name})\n"]
+
+def _pretty_assignment(node, pad, indent):
+    return [pad + "Assignment:\n", (node.target, indent+1), (node.value, indent+1)]
+
+def _pretty_call(node, pad, indent):
+    return [pad + "Call:\n", (node.callee, indent+1)] + [(a, indent+1) for a in node.args]
+
+def _pretty_arrayaccess(node, pad, indent):
+    return [pad + "ArrayAccess:\n", (node.array, indent+1), (node.index, indent+1)]
+
+def _pretty_unknown(node, pad, indent):
+    return [pad + f"UnknownNode:{node}\n"]
+
+_pretty_handlers = {
+    Program: _pretty_program,
+    Function: _pretty_function,
+    Declaration: _pretty_declaration,
+    Compound: _pretty_compound,
+    If: _pretty_if,
+    While: _pretty_while,
+    For: _pretty_for,
+    Return: _pretty_return,
+    ExprStmt: _pretty_exprstmt,
+    Binary: _pretty_binary,
+    Unary: _pretty_unary,
+    Literal: _pretty_literal,
+    Var: _pretty_var,
+    Assignment: _pretty_assignment,
+    Call: _pretty_call,
+    ArrayAccess: _pretty_arrayaccess,
+}
+
+def _pretty_handler(cls):
+    # subclasses print like their closest known base, as isinstance did
+    for base in cls.__mro__:
+        if base in _pretty_handlers:
+            handler = _pretty_handlers[base]
+            break
+    else:
+        handler = _pretty_unknown
+    _pretty_handlers[cls] = handler
+    return handler
+
+def write_pretty(node: Node, out, indent: int = 0) -> None:
+    """ Writes the dump of node to a text stream as it goes, without recursion. """
+    handlers = _pretty_handlers
+    write = out.write
+    stack = [(node, indent)]
+    while stack:
+        item = stack.pop()
+        if type(item) is str:
+            write(item)
+            continue
+        node, indent = item
+        handler = handlers.get(type(node)) or _pretty_handler(type(node))
+        items = handler(node, '  ' * indent, indent)
+        if len(items) == 1 and type(items[0]) is str:
+            write(items[0])
+        else:
+            items.reverse()
+            stack += items
+
 def pretty(node: Node, indent: int = 0) -> str:
-    pad = '  ' * indent
-    if isinstance(node, Program):
-        s = pad + "Program:\n"
-        for d in node.declarations:
-            s += pretty(d, indent+1)
-        return s
-    if isinstance(node, Function):
-        s = pad + f"Function: {node.ret_type} {node.name}({', '.join(t+' '+n for t,n in node.params)})\n"
-        s += pretty(node.body, indent+1)
-        return s
-    if isinstance(node, Declaration):
-        s = pad + f"Declaration: {node.var_type} {node.name}"
-        if node.initializer:
-            s += " =\n" + pretty(node.initializer, indent+1)
+    out = io.StringIO()
+    write_pretty(node, out, indent)
+    return out.getvalue()
+
+def count_nodes(node: Node) -> int:
+    """ Number of nodes in a tree, counted without recursion. """
+    count = 0
+    stack = [node]
+    while stack:
+        count += 1
+        stack += child_nodes(stack.pop())
+    return count
+
+# visitors over the ast. the handler of a node class, visit_<Class> of the
+# visitor or of the closest base class that has one, else generic_visit, is
+# looked up once per visitor class and kept in a dict keyed by type(node).
+# leaves can be shared (LeafArena), a tree is visited as if they were not
+_node_fields: Dict[type, Tuple[str, ...]] = {}
+
+def node_fields(cls) -> Tuple[str, ...]:
+    """ The fields of a node class that can hold nodes, not the resolver's bindings. """
+    names = _node_fields.get(cls)
+    if names is None:
+        names = _node_fields[cls] = tuple(f.name for f in fields(cls) if f.compare)
+    return names
+
+def child_nodes(node: Node) -> List[Node]:
+    """ The children of node in field order, list items in place. """
+    result = []
+    for name in _node_fields.get(type(node)) or node_fields(type(node)):
+        value = getattr(node, name)
+        if isinstance(value, Node):
+            result.append(value)
+        elif type(value) is list:
+            result += [item for item in value if isinstance(item, Node)]
+    return result
+
+class NodeVisitor:
+    """ visit(node) calls the handler of node's class, generic_visit visits the
+    children. walk(node) hands every node of a tree to its handler without
+    recursion, for trees too deep for visit.
+    """
+    _handlers: Dict[type, Any] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._handlers = {}
+
+    @classmethod
+    def handler(cls, node_type):
+        for base in node_type.__mro__:
+            method = getattr(cls, f"visit_{base.__name__}", None)
+            if method is not None:
+                break
         else:
-            s += "\n"
-        return s
-    if isinstance(node, Compound):
-        s = pad + "Compound:\n"
-        for st in node.stmts:
-            s += pretty(st, indent+1)
-        return s
-    if isinstance(node, If):
-        s = pad + "If:\n"
-        s += pad + "  Cond:\n" + pretty(node.cond, indent+2)
-        s += pad + "  Then:\n" + pretty(node.then_branch, indent+2)
-        if node.else_branch:
-            s += pad + "  Else:\n" + pretty(node.else_branch, indent+2)
-        return s
-    if isinstance(node, While):
-        return pad + "While:\n" + pad + "  Cond:\n" + pretty(node.cond, indent+2) + pad + "  Body:\n" + pretty(node.body, indent+2)
-    if isinstance(node, For):
-        s = pad + "For:\n"
-        s += pad + "  Init:\n" + (pretty(node.init, indent+2) if node.init else pad + "    <none>\n")
-        s += pad + "  Cond:\n" + (pretty(node.cond, indent+2) if node.cond else pad + "    <none>\n")
-        s += pad + "  Post:\n" + (pretty(node.post, indent+2) if node.post else pad + "    <none>\n")
-        s += pad + "  Body:\n" + pretty(node.body, indent+2)
-        return s
-    if isinstance(node, Return):
-        return pad + "Return:\n" + (pretty(node.expr, indent+1) if node.expr else pad + "  <none>\n")
-    if isinstance(node, ExprStmt):
-        return pad + "ExprStmt:\n" + (pretty(node.expr, indent+1) if node.expr else pad + "  <none>\n")
-    if isinstance(node, Binary):
-        return pad + f"Binary({node.op}):\n" + pretty(node.left, indent+1) + pretty(node.right, indent+1)
-    if isinstance(node, Unary):
-        return pad + f"Unary({'prefix' if node.prefix else 'postfix'} {node.op}):\n" + pretty(node.operand, indent+1)
-    if isinstance(node, Literal):
-        return pad + f"Literal({node.value})\n"
-    if isinstance(node, Var):
-        return pad + f"Var({node.name})\n"
-    if isinstance(node, Assignment):
-        return pad + "Assignment:\n" + pretty(node.target, indent+1) + pretty(node.value, indent+1)
-    if isinstance(node, Call):
-        s = pad + "Call:\n" + pretty(node.callee, indent+1)
-        for a in node.args:
-            s += pretty(a, indent+1)
-        return s
-    if isinstance(node, ArrayAccess):
-        return pad + "ArrayAccess:\n" + pretty(node.array, indent+1) + pretty(node.index, indent+1)
-    return pad + f"UnknownNode:{node}\n"
+            method = cls.generic_visit
+        cls._handlers[node_type] = method
+        return method
+
+    def visit(self, node):
+        handler = self._handlers.get(type(node)) or self.handler(type(node))
+        return handler(self, node)
+
+    def generic_visit(self, node):
+        for child in child_nodes(node):
+            self.visit(child)
+
+    def walk(self, node):
+        """ Visits node and everything under it, parents before children.
+
+        walk visits the children itself, so handlers do not call
+        generic_visit; one that returns False keeps walk out of its node's
+        children. Nodes without a handler are only walked through.
+        """
+        handlers = self._handlers
+        generic = type(self).generic_visit
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            handler = handlers.get(type(node)) or self.handler(type(node))
+            if handler is generic or handler(self, node) is not False:
+                children = child_nodes(node)
+                children.reverse()
+                stack += children
+
+class NodeTransformer(NodeVisitor):
+    """ A NodeVisitor whose handlers return the node to use instead of the one
+    they got (possibly the same one), or None to drop a statement from a list.
+    A dropped node outside a list becomes an empty Compound.
+    """
+    def generic_visit(self, node):
+        for name in node_fields(type(node)):
+            value = getattr(node, name)
+            if isinstance(value, Node):
+                new = self.visit(value)
+                setattr(node, name, new if new is not None else Compound(stmts=[]))
+            elif type(value) is list and any(isinstance(item, Node) for item in value):
+                items = [self.visit(item) if isinstance(item, Node) else item for item in value]
+                setattr(node, name, [item for item in items if item is not None])
+        return node
+
+    def transform(self, root):
+        """ visit without recursion: every node goes to its handler after its
+        children were replaced, so handlers do not call generic_visit. Nodes
+        without a handler are kept. Returns the new root.
+        """
+        # in pre-order parents come before their children, so walking it
+        # backwards gives every node after all of its children
+        order = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack += child_nodes(node)
+
+        handlers = self._handlers
+        generic = type(self).generic_visit
+        replaced = {}
+        for node in reversed(order):
+            key = id(node)
+            if key in replaced:
+                # a shared leaf, seen already
+                continue
+            cls = type(node)
+            for name in _node_fields.get(cls) or node_fields(cls):
+                value = getattr(node, name)
+                if type(value) is list:
+                    items = [replaced.get(id(item), item) for item in value]
+                    if any(new is not old for new, old in zip(items, value)):
+                        setattr(node, name, [item for item in items if item is not None])
+                elif isinstance(value, Node):
+                    new = replaced.get(id(value), value)
+                    if new is not value:
+                        setattr(node, name, new if new is not None else Compound(stmts=[]))
+            handler = handlers.get(cls) or self.handler(cls)
+            replaced[key] = node if handler is generic else handler(self, node)
+        result = replaced[id(root)]
+        return result if result is not None else Compound(stmts=[])
 
 # example use
 def main(tokens):
     p = Parser(tokens)
     ast = p.parse_program()
-    print(pretty(ast))
+    write_pretty(ast, sys.stdout)
+    print()
 
 
 
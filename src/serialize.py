@@ -0,0 +1,458 @@
+import mmap
+import os
+import struct
+from typing import List
+
+from lexer import Lexemes
+from parser import (ArrayAccess, Assignment, Binary, Call, Compound, Declaration, ExprStmt, For, Function, If,
+                    Literal, Program, Return, Unary, Var, While)
+
+# a binary file of a program's tokens and ast, for -o, read back much faster
+# than the source is lexed and parsed again.
+#
+# the header is fixed: MAGIC, the format VERSION and the offsets of the
+# string, token and program sections. numbers are varints (7 bits a byte,
+# low bits first, the high bit set on all but the last byte). every str,
+# names, types, operators, lexemes, is an index into the string table, which
+# is a count then each string as its utf-8 length and bytes.
+#
+# tokens: a count, the kind names used (string indexes), then per token its
+# kind's index times two, plus one when a lexeme follows (a kind whose lexeme
+# is always the same, a keyword or EOF, has none), and its start as a
+# difference to the start of the one before.
+#
+# program: a count of top-level declarations, the size in bytes of each, then
+# the declarations. so any one can be read alone. a declaration is its nodes
+# in post-order, a node's children (NONE for a missing one) before its tag and
+# own fields, and is read back with a stack and no recursion however deep the
+# expressions nest.
+
+MAGIC = b'HYPB'
+VERSION = 1
+HEADER = struct.Struct('<4sHIII')
+FLOAT = struct.Struct('<d')
+
+# node tags, 0 stands for a missing child. the tag of a class is its index + 1
+NONE = 0
+CLASSES = [Var, Literal, Binary, Unary, Assignment, Call, ArrayAccess, ExprStmt, Compound, Declaration,
+           Return, If, While, For, Function, Program]
+TAGS = {cls: tag for tag, cls in enumerate(CLASSES, 1)}
+(VAR, LITERAL, BINARY, UNARY, ASSIGNMENT, CALL, ARRAY_ACCESS, EXPR_STMT, COMPOUND, DECLARATION,
+ RETURN, IF, WHILE, FOR, FUNCTION, PROGRAM) = range(1, len(CLASSES) + 1)
+# the fields holding children, in the order they are written
+CHILDREN = {
+    Var: (), Literal: (), Binary: ('left', 'right'), Unary: ('operand',), Assignment: ('target', 'value'),
+    Call: ('callee', 'args'), ArrayAccess: ('array', 'index'), ExprStmt: ('expr',), Compound: ('stmts',),
+    Declaration: ('initializer',), Return: ('expr',), If: ('cond', 'then_branch', 'else_branch'),
+    While: ('cond', 'body'), For: ('init', 'cond', 'post', 'body'), Function: ('body',),
+    Program: ('declarations',),
+}
+# literal values, after the Literal tag
+INT, NEGATIVE, REAL, TEXT = range(4)
+# what reading past the end or a bad index into the string table raises
+DAMAGED = (IndexError, ValueError, struct.error)
+
+
+class FormatError(Exception):
+    pass
+
+
+def is_binary(data):
+    """ True when data (bytes or a mapped file) starts like a file write makes. """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def read_varint(data, pos):
+    """ The varint at pos and the position after it. """
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def put_varint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+class Writer:
+    def __init__(self):
+        self.strings = {}
+
+    def string(self, text):
+        index = self.strings.get(text)
+        if index is None:
+            index = self.strings[text] = len(self.strings)
+        return index
+
+    def tokens(self, tokens):
+        out = bytearray()
+        body = bytearray()
+        kinds = {}
+        count = 0
+        previous = 0
+        for token in tokens:
+            kind, lexeme = token[0], token[1]
+            start = token[2] if len(token) > 2 else previous
+            index = kinds.get(kind)
+            if index is None:
+                index = kinds[kind] = len(kinds)
+            if Lexemes.get(kind) == lexeme:
+                put_varint(body, index * 2)
+            else:
+                put_varint(body, index * 2 + 1)
+                put_varint(body, self.string(lexeme))
+            put_varint(body, start - previous)
+            previous = start
+            count += 1
+        put_varint(out, count)
+        put_varint(out, len(kinds))
+        for kind in kinds:
+            put_varint(out, self.string(kind))
+        return out + body
+
+    def node(self, root):
+        """ The bytes of root and everything under it, in post-order. """
+        order = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if node is None:
+                continue
+            for name in CHILDREN[type(node)]:
+                value = getattr(node, name)
+                if type(value) is list:
+                    stack += value
+                else:
+                    stack.append(value)
+        out = bytearray()
+        string = self.string
+        # reversed pre-order with the children pushed left to right is
+        # post-order with them left to right
+        for node in reversed(order):
+            if node is None:
+                out.append(NONE)
+                continue
+            out.append(TAGS[type(node)])
+            match node:
+                case Var():
+                    put_varint(out, string(node.name))
+                case Literal():
+                    self.literal(out, node.value)
+                case Binary():
+                    put_varint(out, string(node.op))
+                case Unary():
+                    put_varint(out, string(node.op))
+                    out.append(1 if node.prefix else 0)
+                case Call():
+                    put_varint(out, len(node.args))
+                case Compound():
+                    put_varint(out, len(node.stmts))
+                case Declaration():
+                    put_varint(out, string(node.var_type))
+                    put_varint(out, string(node.name))
+                case Function():
+                    put_varint(out, string(node.ret_type))
+                    put_varint(out, string(node.name))
+                    put_varint(out, len(node.params))
+                    for param_type, param_name in node.params:
+                        put_varint(out, string(param_type))
+                        put_varint(out, string(param_name))
+                case Program():
+                    put_varint(out, len(node.declarations))
+        return out
+
+    def literal(self, out, value):
+        if type(value) is int:
+            if value >= 0:
+                out.append(INT)
+                put_varint(out, value)
+            else:
+                out.append(NEGATIVE)
+                put_varint(out, -value)
+        elif type(value) is float:
+            out.append(REAL)
+            out += FLOAT.pack(value)
+        elif type(value) is str:
+            out.append(TEXT)
+            put_varint(out, self.string(value))
+        else:
+            raise FormatError(f"can not write a literal of type {type(value).__name__}")
+
+
+def dumps(program, tokens=()) -> bytes:
+    """ The file of a Program, and of its tokens when given. """
+    writer = Writer()
+    token_section = writer.tokens(tokens)
+    blobs = [writer.node(decl) for decl in program.declarations]
+    program_section = bytearray()
+    put_varint(program_section, len(blobs))
+    for blob in blobs:
+        put_varint(program_section, len(blob))
+    string_section = bytearray()
+    put_varint(string_section, len(writer.strings))
+    for text in writer.strings:
+        data = text.encode()
+        put_varint(string_section, len(data))
+        string_section += data
+    strings_at = HEADER.size
+    tokens_at = strings_at + len(string_section)
+    program_at = tokens_at + len(token_section)
+    header = HEADER.pack(MAGIC, VERSION, strings_at, tokens_at, program_at)
+    return b''.join([header, string_section, token_section, program_section] + blobs)
+
+
+def dump(program, path, tokens=()):
+    with open(path, "wb") as file:
+        file.write(dumps(program, tokens))
+
+
+class Reader:
+    """ A file dumps made, in bytes or mapped, decoded only as far as asked:
+    the string table on first use, the declarations one at a time.
+    """
+    def __init__(self, data):
+        if len(data) < HEADER.size or not is_binary(data):
+            raise FormatError("not a program file")
+        _, version, self.strings_at, self.tokens_at, self.program_at = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise FormatError(f"program file version {version}, this compiler reads {VERSION}")
+        self.data = data
+        self._strings = None
+        self.offsets = None
+        self.declarations = None
+
+    @property
+    def strings(self) -> List[str]:
+        if self._strings is None:
+            data = self.data[self.strings_at:self.tokens_at]
+            count, pos = read_varint(data, 0)
+            strings = []
+            for _ in range(count):
+                size, pos = read_varint(data, pos)
+                strings.append(str(data[pos:pos + size], 'utf-8'))
+                pos += size
+            self._strings = strings
+        return self._strings
+
+    def index(self):
+        """ Reads the sizes of the declarations into their offsets. """
+        try:
+            count, pos = read_varint(self.data, self.program_at)
+            sizes = []
+            for _ in range(count):
+                size, pos = read_varint(self.data, pos)
+                sizes.append(size)
+        except DAMAGED as error:
+            raise FormatError("the program file is cut short or damaged") from error
+        self.offsets = offsets = []
+        for size in sizes:
+            offsets.append(pos)
+            pos += size
+        offsets.append(pos)
+        self.declarations = [None] * count
+
+    def __len__(self):
+        if self.offsets is None:
+            self.index()
+        return len(self.declarations)
+
+    def declaration(self, i):
+        """ Top-level declaration i, decoded the first time it is asked for. """
+        if self.offsets is None:
+            self.index()
+        node = self.declarations[i]
+        if node is None:
+            try:
+                node = self.declarations[i] = self.node(self.offsets[i], self.offsets[i + 1])
+            except DAMAGED as error:
+                raise FormatError("the program file is cut short or damaged") from error
+        return node
+
+    def program(self) -> Program:
+        return Program([self.declaration(i) for i in range(len(self))])
+
+    def tokens(self):
+        """ The tokens as (kind, lexeme, start) tuples, empty when none were written. """
+        try:
+            return self.read_tokens()
+        except DAMAGED as error:
+            raise FormatError("the program file is cut short or damaged") from error
+
+    def read_tokens(self):
+        strings = self.strings
+        varint = read_varint
+        data = self.data[self.tokens_at:self.program_at]
+        count, pos = varint(data, 0)
+        kind_count, pos = varint(data, pos)
+        kinds = []
+        for _ in range(kind_count):
+            index, pos = varint(data, pos)
+            kinds.append(strings[index])
+        lexemes = [Lexemes.get(kind) for kind in kinds]
+        tokens = []
+        start = 0
+        for _ in range(count):
+            code = data[pos]
+            pos += 1
+            if code >= 0x80:
+                code, pos = varint(data, pos - 1)
+            kind = code >> 1
+            if code & 1:
+                index, pos = varint(data, pos)
+                lexeme = strings[index]
+            else:
+                lexeme = lexemes[kind]
+            delta = data[pos]
+            pos += 1
+            if delta >= 0x80:
+                delta, pos = varint(data, pos - 1)
+            start += delta
+            tokens.append((kinds[kind], lexeme, start))
+        return tokens
+
+    def node(self, pos, end):
+        """ The node whose post-order bytes are data[pos:end]. """
+        # indexing bytes is quicker than indexing a mapped file
+        data = self.data[pos:end]
+        pos, end = 0, end - pos
+        strings = self.strings
+        varint = read_varint
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        while pos < end:
+            tag = data[pos]
+            pos += 1
+            # the small varints, nearly all of them, are read inline
+            if tag == VAR:
+                index = data[pos]
+                pos += 1
+                if index >= 0x80:
+                    # the string table seldom needs more than two bytes
+                    high = data[pos]
+                    pos += 1
+                    if high < 0x80:
+                        index = index & 0x7f | high << 7
+                    else:
+                        index, pos = varint(data, pos - 2)
+                push(Var(strings[index]))
+            elif tag == LITERAL:
+                kind = data[pos]
+                pos += 1
+                if kind == REAL:
+                    push(Literal(FLOAT.unpack_from(data, pos)[0]))
+                    pos += FLOAT.size
+                    continue
+                value = data[pos]
+                pos += 1
+                if value >= 0x80:
+                    value, pos = varint(data, pos - 1)
+                push(Literal(value if kind == INT else -value if kind == NEGATIVE else strings[value]))
+            elif tag == BINARY:
+                index = data[pos]
+                pos += 1
+                if index >= 0x80:
+                    high = data[pos]
+                    pos += 1
+                    if high < 0x80:
+                        index = index & 0x7f | high << 7
+                    else:
+                        index, pos = varint(data, pos - 2)
+                right = pop()
+                push(Binary(strings[index], pop(), right))
+            elif tag == NONE:
+                push(None)
+            elif tag == UNARY:
+                index, pos = varint(data, pos)
+                prefix = data[pos] == 1
+                pos += 1
+                push(Unary(strings[index], pop(), prefix))
+            elif tag == ASSIGNMENT:
+                value = pop()
+                push(Assignment(pop(), value))
+            elif tag == CALL:
+                count, pos = varint(data, pos)
+                args = stack[len(stack) - count:]
+                del stack[len(stack) - count:]
+                push(Call(pop(), args))
+            elif tag == ARRAY_ACCESS:
+                index = pop()
+                push(ArrayAccess(pop(), index))
+            elif tag == EXPR_STMT:
+                push(ExprStmt(pop()))
+            elif tag == COMPOUND:
+                count, pos = varint(data, pos)
+                stmts = stack[len(stack) - count:]
+                del stack[len(stack) - count:]
+                push(Compound(stmts))
+            elif tag == DECLARATION:
+                var_type, pos = varint(data, pos)
+                name, pos = varint(data, pos)
+                push(Declaration(strings[var_type], strings[name], pop()))
+            elif tag == RETURN:
+                push(Return(pop()))
+            elif tag == IF:
+                else_branch = pop()
+                then_branch = pop()
+                push(If(pop(), then_branch, else_branch))
+            elif tag == WHILE:
+                body = pop()
+                push(While(pop(), body))
+            elif tag == FOR:
+                body, post, cond = pop(), pop(), pop()
+                push(For(pop(), cond, post, body))
+            elif tag == FUNCTION:
+                ret_type, pos = varint(data, pos)
+                name, pos = varint(data, pos)
+                count, pos = varint(data, pos)
+                params = []
+                for _ in range(count):
+                    param_type, pos = varint(data, pos)
+                    param_name, pos = varint(data, pos)
+                    params.append((strings[param_type], strings[param_name]))
+                push(Function(strings[ret_type], strings[name], params, pop()))
+            elif tag == PROGRAM:
+                count, pos = varint(data, pos)
+                declarations = stack[len(stack) - count:]
+                del stack[len(stack) - count:]
+                push(Program(declarations))
+            else:
+                raise FormatError(f"unknown node tag {tag}")
+        if len(stack) != 1:
+            raise FormatError("a declaration does not decode to one node")
+        return stack[0]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def loads(data) -> Reader:
+    return Reader(data)
+
+
+def load(path) -> Reader:
+    """ A Reader over the file at path, mapped into memory. """
+    with open(path, "rb") as file:
+        if not os.fstat(file.fileno()).st_size:
+            raise FormatError("not a program file")
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return Reader(data)
+    except FormatError:
+        data.close()
+        raise
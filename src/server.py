@@ -0,0 +1,136 @@
+""" Keeps the compiler loaded and runs command lines sent by client.py.
+
+usage: python3 server.py [socket]
+
+The socket defaults to $HYPOTENUSE_SOCKET, else hypotenuse-<uid>.sock in
+$XDG_RUNTIME_DIR or /tmp. Only its owner can connect, and client.py only
+talks to a socket its user owns. Python, the compiler modules, the lexer's
+regexes and the cache's version digest are set up once here instead of once
+per file. Requests run one at a time, in the client's working directory, so
+--watch is refused. Stop the server with ctrl-c or SIGTERM.
+"""
+import contextlib
+import io
+import os
+import signal
+import socket
+import sys
+
+import cache
+import client
+import main as compiler
+
+# output is sent in frames of about this size, and when flushed
+CHUNK = 64 * 1024
+
+
+class Shutdown(BaseException):
+    """ Raised by SIGTERM. Not a SystemExit, handle() takes those for the
+    exit status of the command line it runs.
+    """
+
+
+def terminate(signum, frame):
+    raise Shutdown
+
+
+class Stream(io.TextIOBase):
+    """ A text file whose writes go to the client as frames of one tag. """
+    def __init__(self, sock, tag):
+        self.sock = sock
+        self.tag = tag
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= CHUNK:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.parts:
+            client.send_frame(self.sock, self.tag, ''.join(self.parts).encode())
+            self.parts = []
+            self.size = 0
+
+
+def handle(sock):
+    """ Runs the command line the client sent and sends back its output and status. """
+    tag, payload = client.read_frame(sock)
+    if tag != b'r':
+        return
+    cwd, *argv = payload.decode().split('\0')
+    out, err = Stream(sock, b'o'), Stream(sock, b'e')
+    if '--watch' in argv:
+        # it never returns, requests are served one at a time
+        err.write("Error: --watch does not run on the server, use python3 main.py --watch\n")
+        err.flush()
+        client.send_frame(sock, b'x', b'1')
+        return
+    here = os.getcwd()
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                status = compiler.run(argv, out)
+            except SystemExit as exit:
+                # --help and option errors exit
+                status = exit.code if isinstance(exit.code, int) else 0 if exit.code is None else 1
+            except Exception as error:
+                print(f"Error: {type(error).__name__}: {error}", file=err)
+                status = 1
+        out.flush()
+        err.flush()
+        client.send_frame(sock, b'x', str(status).encode())
+    finally:
+        os.chdir(here)
+
+
+def serve(path):
+    if os.path.lexists(path):
+        if not client.owned(path):
+            print(f"Error: {path} is not a socket of this user, not removing it", file=sys.stderr)
+            return 1
+        running = client.connect(path)
+        if running is not None:
+            running.close()
+            print(f"Error: a server is already listening on {path}", file=sys.stderr)
+            return 1
+        # left behind by one that did not stop cleanly
+        os.unlink(path)
+    cache.compiler_version()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    mask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(mask)
+    listener.listen(16)
+    # SIGTERM unwinds like ctrl-c, so the socket file is removed
+    signal.signal(signal.SIGTERM, terminate)
+    print(f"listening on {path}", file=sys.stderr)
+    try:
+        while True:
+            sock, _ = listener.accept()
+            with sock:
+                try:
+                    handle(sock)
+                except OSError:
+                    # the client went away, the next one is served anyway
+                    pass
+    except (KeyboardInterrupt, Shutdown):
+        pass
+    finally:
+        listener.close()
+        os.unlink(path)
+    return 0
+
+
+def main():
+    sys.exit(serve(sys.argv[1] if len(sys.argv) > 1 else client.socket_path()))
+
+
+if __name__ == "__main__":
+    main()
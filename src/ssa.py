@@ -0,0 +1,460 @@
+from ir import Block, Instr, SIDE_EFFECTS, liveness
+from optimize import PassManager, FOLD_BINARY, FOLD_UNARY
+
+# static single assignment form of the ir and the passes that rely on it.
+#
+# construct() gives every value one definition: variables assigned in more
+# than one place get a version per assignment (x:0, x:1...) and phi
+# instructions where control flow joins. destruct() turns the phis back into
+# copies at the end of the predecessors, the backends call it before they
+# allocate registers.
+
+# ops the passes may evaluate, merge or drop when nothing uses them
+PURE = ('const', 'copy', 'add', 'sub', 'mul', 'div', 'mod', 'and', 'or', 'xor', 'shl', 'shr',
+        'lt', 'gt', 'le', 'ge', 'eq', 'ne', 'neg', 'not', 'bnot', 'addr', 'str', 'load', 'phi')
+COMMUTATIVE = ('add', 'mul', 'and', 'or', 'xor', 'eq', 'ne')
+
+# ir op to the operator the ast folding tables know
+FOLD_OPS = {
+    'add': '+', 'sub': '-', 'mul': '*', 'div': '/', 'mod': '%', 'and': '&', 'or': '|',
+    'xor': '^', 'shl': '<<', 'shr': '>>', 'lt': '<', 'gt': '>', 'le': '<=', 'ge': '>=',
+    'eq': '==', 'ne': '!=', 'neg': '-', 'not': '!', 'bnot': '~',
+}
+
+
+def wrap(value):
+    """ value as a signed 64 bit integer, the way the machine keeps it. """
+    return (value + 2**63) % 2**64 - 2**63
+
+
+def fold(op, args):
+    """ Value of op on constant args, or None when it is left for run time. """
+    if op in ('const', 'copy'):
+        return args[0]
+    if op in ('shl', 'shr'):
+        # the machine only looks at the low 6 bits of the count
+        args = [args[0], args[1] & 63]
+    if op in ('div', 'mod') and args == [-2**63, -1]:
+        return None
+    table = FOLD_UNARY if len(args) == 1 else FOLD_BINARY
+    value = table[FOLD_OPS[op]](*args)
+    return wrap(value) if value is not None else None
+
+
+# analysis
+def reverse_postorder(fn):
+    blocks = fn.block_map()
+    order = []
+    seen = {fn.blocks[0].label}
+    stack = [(fn.blocks[0].label, iter(blocks[fn.blocks[0].label].successors()))]
+    while stack:
+        label, succs = stack[-1]
+        for succ in succs:
+            if succ not in seen:
+                seen.add(succ)
+                stack.append((succ, iter(blocks[succ].successors())))
+                break
+        else:
+            stack.pop()
+            order.append(label)
+    return order[::-1]
+
+
+def dominators(fn):
+    """ Immediate dominator of each reachable block (Cooper, Harvey and Kennedy). """
+    order = reverse_postorder(fn)
+    index = {label: i for i, label in enumerate(order)}
+    preds = fn.predecessors()
+    entry = order[0]
+    idom = {entry: entry}
+
+    def intersect(a, b):
+        while a != b:
+            while index[a] > index[b]:
+                a = idom[a]
+            while index[b] > index[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for label in order[1:]:
+            done = [pred for pred in preds[label] if pred in idom]
+            new = done[0]
+            for pred in done[1:]:
+                new = intersect(pred, new)
+            if idom.get(label) != new:
+                idom[label] = new
+                changed = True
+    return idom
+
+
+def dominator_tree(idom):
+    children = {label: [] for label in idom}
+    for label, parent in idom.items():
+        if label != parent:
+            children[parent].append(label)
+    return children
+
+
+def frontiers(fn, idom):
+    preds = fn.predecessors()
+    result = {label: set() for label in idom}
+    for label in idom:
+        joins = [pred for pred in preds[label] if pred in idom]
+        if len(joins) < 2:
+            continue
+        for pred in joins:
+            runner = pred
+            while runner != idom[label]:
+                result[runner].add(label)
+                runner = idom[runner]
+    return result
+
+
+def phis(block):
+    count = 0
+    while count < len(block.instrs) and block.instrs[count].op == 'phi':
+        count += 1
+    return block.instrs[:count]
+
+
+# construction
+def construct_function(fn):
+    blocks = fn.block_map()
+    preds = fn.predecessors()
+    idom = dominators(fn)
+    frontier = frontiers(fn, idom)
+    live_in, _ = liveness(fn)
+
+    # only names assigned more than once need versions, the rest already are ssa
+    defined = {}
+    for block in fn.blocks:
+        for instr in block.instrs:
+            if instr.dest is not None:
+                defined.setdefault(instr.dest, []).append(block.label)
+    variables = {name for name, where in defined.items() if len(where) > 1}
+
+    # phis on the iterated dominance frontier, where the variable is still live
+    for name in sorted(variables):
+        placed = set()
+        work = list(dict.fromkeys(defined[name]))
+        while work:
+            label = work.pop()
+            for join in frontier[label]:
+                if join in placed or name not in live_in[join]:
+                    continue
+                placed.add(join)
+                blocks[join].instrs.insert(0, Instr('phi', name, [name] * len(preds[join]), label=name, targets=list(preds[join])))
+                if join not in defined[name]:
+                    work.append(join)
+
+    # renaming, walking the dominator tree without recursion
+    counters = {}
+    stacks = {name: [] for name in variables}
+    children = dominator_tree(idom)
+
+    def current(value):
+        if type(value) is str and value in stacks:
+            # a path where the variable was never assigned reads an undefined value
+            return stacks[value][-1] if stacks[value] else 0
+        return value
+
+    work = [(fn.blocks[0].label, False)]
+    pushed = {}
+    while work:
+        label, leaving = work.pop()
+        if leaving:
+            for name in pushed.pop(label):
+                stacks[name].pop()
+            continue
+        names = []
+        block = blocks[label]
+        for instr in block.instrs:
+            if instr.op != 'phi':
+                instr.args = [current(arg) for arg in instr.args]
+            if instr.dest in stacks:
+                name = instr.dest
+                version = counters.get(name, 0)
+                counters[name] = version + 1
+                instr.dest = f"{name}:{version}"
+                stacks[name].append(instr.dest)
+                names.append(name)
+        for succ in block.successors():
+            for phi in phis(blocks[succ]):
+                for i, pred in enumerate(phi.targets):
+                    if pred == label:
+                        phi.args[i] = current(phi.label)
+        pushed[label] = names
+        work.append((label, True))
+        work.extend((child, False) for child in reversed(children[label]))
+    fn.params = [instr.dest for instr in fn.blocks[0].instrs if instr.op == 'param']
+    return fn
+
+
+def construct(module):
+    """ Puts every function of module in ssa form, in place. """
+    for fn in module.functions:
+        construct_function(fn)
+    return module
+
+
+# destruction
+def destruct_function(fn):
+    if not any(block.instrs and block.instrs[0].op == 'phi' for block in fn.blocks):
+        return fn
+    splits = 0
+    for block in list(fn.blocks):
+        merges = phis(block)
+        if not merges:
+            continue
+        blocks = fn.block_map()
+        for pred in dict.fromkeys(merges[0].targets):
+            # on an edge from a block that also goes elsewhere the copies
+            # need a block of their own
+            source = blocks[pred]
+            if len(set(source.successors())) > 1:
+                splits += 1
+                edge = Block(f"split{splits}.{block.label}", [Instr('jmp', targets=[block.label])])
+                terminator = source.instrs[-1]
+                terminator.targets = [edge.label if target == block.label else target for target in terminator.targets]
+                fn.blocks.insert(fn.blocks.index(block), edge)
+                source = edge
+            copies = []
+            for phi in merges:
+                value = phi.args[phi.targets.index(pred)]
+                if value != phi.dest:
+                    copies.append((phi.dest, value))
+            # the phis of a block read all their values at once, when one reads
+            # what another writes everything goes through a temporary first
+            dests = {dest for dest, _ in copies}
+            if any(value in dests for _, value in copies):
+                copies = [(f"{dest}'", value) for dest, value in copies] + [(dest, f"{dest}'") for dest, _ in copies]
+            source.instrs[-1:-1] = [Instr('copy', dest, [value]) for dest, value in copies]
+        block.instrs = block.instrs[len(merges):]
+    return fn
+
+
+def destruct(module):
+    for fn in module.functions:
+        destruct_function(fn)
+    return module
+
+
+# passes. each takes the whole module in ssa form and changes it in place
+def uses_of(fn):
+    """ value -> instructions reading it. """
+    uses = {}
+    for block in fn.blocks:
+        for instr in block.instrs:
+            for value in instr.uses():
+                uses.setdefault(value, []).append(instr)
+    return uses
+
+
+def replace_values(fn, mapping):
+    def resolve(value):
+        while type(value) is str and value in mapping:
+            value = mapping[value]
+        return value
+    for block in fn.blocks:
+        for instr in block.instrs:
+            instr.args = [resolve(arg) for arg in instr.args]
+
+
+def copy_propagation(module):
+    """ Uses of a copy read its source, phis whose inputs all agree are copies too. """
+    for fn in module.functions:
+        changed = True
+        while changed:
+            changed = False
+            mapping = {}
+            for block in fn.blocks:
+                kept = []
+                for instr in block.instrs:
+                    if instr.op in ('copy', 'const'):
+                        mapping[instr.dest] = instr.args[0]
+                        continue
+                    if instr.op == 'phi':
+                        inputs = {arg for arg in instr.args if arg != instr.dest}
+                        if len(inputs) == 1:
+                            mapping[instr.dest] = inputs.pop()
+                            continue
+                    kept.append(instr)
+                block.instrs = kept
+            if mapping:
+                replace_values(fn, mapping)
+                changed = True
+    return module
+
+
+def cse(module):
+    """ A pure instruction computing what a dominating one already did reads its result. """
+    for fn in module.functions:
+        idom = dominators(fn)
+        children = dominator_tree(idom)
+        blocks = fn.block_map()
+        mapping = {}
+        # a value is only visible in the blocks its own block dominates, so
+        # entries leave the table again once the walk is done below them
+        seen = {}
+        added = {}
+        work = [(fn.blocks[0].label, False)]
+        while work:
+            label, leaving = work.pop()
+            if leaving:
+                for key in added.pop(label):
+                    del seen[key]
+                continue
+            keys = []
+            kept = []
+            for instr in blocks[label].instrs:
+                instr.args = [mapping.get(arg, arg) for arg in instr.args]
+                if instr.op in PURE and instr.op not in ('phi', 'load', 'copy', 'const'):
+                    args = instr.args
+                    if instr.op in COMMUTATIVE:
+                        args = sorted(args, key=repr)
+                    key = (instr.op, instr.label, *args)
+                    if key in seen:
+                        mapping[instr.dest] = seen[key]
+                        continue
+                    seen[key] = instr.dest
+                    keys.append(key)
+                kept.append(instr)
+            blocks[label].instrs = kept
+            added[label] = keys
+            work.append((label, True))
+            work.extend((child, False) for child in children[label])
+        replace_values(fn, mapping)
+    return module
+
+
+BOTTOM = object()
+
+def sccp(module):
+    """ Sparse conditional constant propagation (Wegman and Zadeck).
+
+    Values proven constant are replaced by the constant, branches on them
+    become jumps and blocks no executed edge reaches are dropped.
+    """
+    for fn in module.functions:
+        blocks = fn.block_map()
+        uses = uses_of(fn)
+        where = {id(instr): block.label for block in fn.blocks for instr in block.instrs}
+        # missing from values means not known yet (top)
+        values = {}
+        edges = set()
+        reached = set()
+        flow = [(None, fn.blocks[0].label)]
+        work = []
+
+        def value_of(arg):
+            return arg if type(arg) is int else values.get(arg)
+
+        def evaluate(instr, label):
+            if instr.op == 'phi':
+                known = [value_of(arg) for arg, pred in zip(instr.args, instr.targets) if (pred, label) in edges]
+                known = [value for value in known if value is not None]
+                if not known:
+                    return None
+                if any(value is BOTTOM for value in known) or len(set(known)) > 1:
+                    return BOTTOM
+                return known[0]
+            if instr.op not in FOLD_OPS and instr.op not in ('const', 'copy'):
+                return BOTTOM
+            args = [value_of(arg) for arg in instr.args]
+            if any(arg is BOTTOM for arg in args):
+                return BOTTOM
+            if any(arg is None for arg in args):
+                return None
+            value = fold(instr.op, args)
+            return BOTTOM if value is None else value
+
+        def visit(instr, label):
+            if instr.op == 'br':
+                cond = value_of(instr.args[0])
+                if cond is None:
+                    return
+                targets = instr.targets if cond is BOTTOM else [instr.targets[0] if cond else instr.targets[1]]
+                flow.extend((label, target) for target in targets)
+            elif instr.op == 'jmp':
+                flow.append((label, instr.targets[0]))
+            elif instr.dest is not None:
+                new = evaluate(instr, label)
+                old = values.get(instr.dest)
+                if new is None or old is BOTTOM or new == old:
+                    return
+                # values only go down, from unknown to a constant to not constant
+                values[instr.dest] = new if old is None else BOTTOM
+                work.extend(uses.get(instr.dest, []))
+
+        while flow or work:
+            while flow:
+                edge = flow.pop()
+                if edge in edges:
+                    continue
+                edges.add(edge)
+                label = edge[1]
+                block = blocks[label]
+                for phi in phis(block):
+                    visit(phi, label)
+                if label not in reached:
+                    reached.add(label)
+                    for instr in block.instrs:
+                        visit(instr, label)
+            while work:
+                instr = work.pop()
+                label = where[id(instr)]
+                if label in reached:
+                    visit(instr, label)
+
+        constants = {value: known for value, known in values.items() if known is not BOTTOM}
+        replace_values(fn, constants)
+        fn.blocks = [block for block in fn.blocks if block.label in reached]
+        for block in fn.blocks:
+            last = block.instrs[-1]
+            if last.op == 'br' and type(last.args[0]) is int:
+                block.instrs[-1] = Instr('jmp', targets=[last.targets[0] if last.args[0] else last.targets[1]])
+            for phi in phis(block):
+                keep = [i for i, pred in enumerate(phi.targets) if (pred, block.label) in edges]
+                phi.args = [phi.args[i] for i in keep]
+                phi.targets = [phi.targets[i] for i in keep]
+            block.instrs = [instr for instr in block.instrs if instr.dest not in constants or instr.op not in PURE]
+    return module
+
+
+def dead_values(module):
+    """ Drops pure instructions whose value nothing with an effect ends up reading. """
+    for fn in module.functions:
+        defs = {}
+        for block in fn.blocks:
+            for instr in block.instrs:
+                if instr.dest is not None:
+                    defs[instr.dest] = instr
+        live = set()
+        work = [instr for block in fn.blocks for instr in block.instrs if instr.op in SIDE_EFFECTS]
+        while work:
+            instr = work.pop()
+            for value in instr.uses():
+                if value not in live:
+                    live.add(value)
+                    if value in defs:
+                        work.append(defs[value])
+        for block in fn.blocks:
+            block.instrs = [instr for instr in block.instrs if instr.op in SIDE_EFFECTS or instr.dest in live]
+    return module
+
+
+PASSES = [
+    ('sccp', sccp),
+    ('copy_propagation', copy_propagation),
+    ('cse', cse),
+    ('copy_propagation', copy_propagation),
+    ('dead_values', dead_values),
+]
+
+
+def optimize(module, passes=None):
+    """ Runs the ssa passes on a module in ssa form, returns it and (pass name, instructions removed). """
+    return PassManager(PASSES if passes is None else passes, size=lambda module: module.instr_count()).run(module)
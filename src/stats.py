@@ -0,0 +1,103 @@
+import cProfile
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# phases in the order they run, for reports
+PHASES = ['read', 'cache', 'lex', 'parse', 'stream', 'import', 'optimize', 'lower', 'codegen', 'translate', 'run', 'print']
+
+
+class Stats:
+    """ Wall time, tracemalloc peak and counts of each compiler phase. """
+    def __init__(self, memory=True, profile=None):
+        self.memory = memory
+        # name of the one phase to run under cProfile
+        self.profile = profile
+        self.profiler = None
+        self.phases = {}
+        self.counts = {}
+        # whether this started tracemalloc, and so stops it in close()
+        self.tracing = False
+
+    @contextmanager
+    def phase(self, name):
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        profiler = cProfile.Profile() if name == self.profile else None
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profiler = profiler
+            elapsed = time.perf_counter() - start
+            entry = self.phases.setdefault(name, {'time': 0.0, 'peak': 0})
+            entry['time'] += elapsed
+            if self.memory:
+                entry['peak'] = max(entry['peak'], tracemalloc.get_traced_memory()[1] - base)
+
+    def close(self):
+        """ Stops the tracing this started, it slows down all that runs after
+        (every later compile, in the server).
+        """
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def throughput(self):
+        """ Units per second of the phases that have something to divide by. """
+        rates = {}
+        def rate(key, phase, count):
+            seconds = self.phases.get(phase, {}).get('time')
+            if seconds and count in self.counts:
+                rates[key] = self.counts[count] / seconds
+        rate('lex_bytes_per_s', 'lex', 'bytes')
+        rate('lex_tokens_per_s', 'lex', 'tokens')
+        rate('parse_tokens_per_s', 'parse', 'tokens')
+        rate('parse_nodes_per_s', 'parse', 'nodes')
+        rate('stream_bytes_per_s', 'stream', 'bytes')
+        rate('print_nodes_per_s', 'print', 'nodes')
+        return rates
+
+    def to_dict(self):
+        return {'phases': self.phases, 'counts': self.counts, 'throughput': self.throughput()}
+
+
+def measure(stats, name):
+    """ stats.phase(name), or nothing at all when stats is None. """
+    return stats.phase(name) if stats is not None else nullcontext()
+
+
+def report(data, title, out):
+    """ Writes the to_dict() of a Stats as a small table. """
+    out.write(f"stats for {title}:\n")
+    phases = data['phases']
+    for name in sorted(phases, key=lambda name: PHASES.index(name) if name in PHASES else len(PHASES)):
+        entry = phases[name]
+        out.write(f"  {name:<28}{entry['time'] * 1000:>12.2f} ms{entry['peak'] / 1e6:>10.2f} MB peak\n")
+    for name, value in data['counts'].items():
+        out.write(f"  {name:<28}{value:>12,}\n")
+    for name, value in data['throughput'].items():
+        out.write(f"  {name:<28}{value:>12,.0f}\n")
+
+
+def write_json(entries, path):
+    """ Writes a list of {'file': ..., **to_dict()} entries for dashboards. """
+    total = {}
+    for entry in entries:
+        for name, phase in entry['phases'].items():
+            total[name] = total.get(name, 0.0) + phase['time']
+    with open(path, 'w') as file:
+        json.dump({'files': entries, 'total_time': total}, file, indent=2)
+        file.write('\n')
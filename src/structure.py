@@ -1,13 +1,105 @@
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from parser import (Node, Program, Function, Declaration, Compound, If, While, For, Return,
+                    ExprStmt, Var, Call, NodeTransformer, child_nodes)
+
+# names and what they are bound to.
+#
+# a Scope keeps the symbols declared in it in a dict, and the SymbolTable keeps
+# one stack per name of the symbols currently visible, so declare and lookup
+# are one dict access each however deep the blocks nest. names are interned,
+# their dict lookups compare by identity first.
+
+
+class ResolveError(Exception):
+    pass
+
+
+@dataclass(slots=True, eq=False)
+class Symbol:
+    name: str
+    # 'global', 'function', 'param' or 'local'
+    kind: str
+    type: str
+    node: Optional[Node] = None
+    # slot of a param or local in its function's Frame, params first, or of a
+    # global among the globals
+    index: Optional[int] = None
+    # unique within the function, a shadowing x is x.1, x.2...
+    unique: str = ''
+    # the one Var every use of this symbol shares
+    var: Optional[Var] = None
+
+
+@dataclass(slots=True, eq=False)
+class Frame:
+    """ The params and locals of one function, in slot order. """
+    params: List[Symbol] = field(default_factory=list)
+    symbols: List[Symbol] = field(default_factory=list)
+
 
-# new stuff guys!
 class Scope:
-    def __init__(self, name):
+    __slots__ = ('name', 'parent', 'symbols', 'children')
+
+    def __init__(self, name, parent=None):
         self.name = name
-        self.children = []
+        self.parent = parent
+        self.symbols = {}
+        # keyed by identity, sibling blocks share a name ('block', 'for')
+        self.children = {}
+
     def add_child(self, child):
-        self.children.append(child)
+        self.children[id(child)] = child
         return self
 
+    def has_child(self, child):
+        return self.children.get(id(child)) is child
+
+    def lookup(self, name):
+        """ The symbol name is bound to here, following the parents. """
+        scope = self
+        while scope is not None:
+            symbol = scope.symbols.get(name)
+            if symbol is not None:
+                return symbol
+            scope = scope.parent
+        return None
+
+
+class SymbolTable:
+    def __init__(self):
+        self.visible: Dict[str, List[Symbol]] = {}
+        self.scope = Scope('global')
+        self.globals = self.scope
+
+    def enter(self, name):
+        self.scope = Scope(name, self.scope)
+        self.scope.parent.add_child(self.scope)
+        return self.scope
+
+    def leave(self):
+        for name in self.scope.symbols:
+            stack = self.visible[name]
+            stack.pop()
+            if not stack:
+                del self.visible[name]
+        self.scope = self.scope.parent
+
+    def declare(self, symbol):
+        symbol.name = name = sys.intern(symbol.name)
+        if name in self.scope.symbols:
+            raise ResolveError(f"{name} is declared twice in the same scope")
+        self.scope.symbols[name] = symbol
+        self.visible.setdefault(name, []).append(symbol)
+        return symbol
+
+    def lookup(self, name):
+        stack = self.visible.get(name)
+        return stack[-1] if stack else None
+
+
 class Caller:
     def __init__(self, name, value):
         self.name = name
@@ -18,7 +110,7 @@ def start(self, scope):
         return self
     def call(self, point, scopes):
         for scope in scopes:
-            if point in scope.children:
+            if scope.has_child(point):
                 self.points.append(point)
 
 
@@ -28,4 +120,185 @@ def __init__(self, name, scope):
         self.functions = []
         scope.add_child(self)
     def add_function(self, function):
-        self.functions.append(function)
\ No newline at end of file
+        self.functions.append(function)
+
+
+class Resolver:
+    """ Binds every Var of a Program to its Symbol.
+
+    Var nodes may be shared between uses (parser.LeafArena), so they are not
+    changed: each use is replaced by the Var of its symbol, which carries the
+    symbol in binding. Declarations get their symbol in binding and Functions
+    their Frame.
+    """
+    def __init__(self):
+        self.table = SymbolTable()
+        self.frame = None
+        # declarations of each name in the current function, for Symbol.unique
+        self.seen = {}
+        self.binder = Binder(self)
+
+    def use(self, symbol):
+        if symbol.var is None:
+            symbol.var = Var(name=symbol.name, binding=symbol)
+        return symbol.var
+
+    def program(self, program):
+        table = self.table
+        count = 0
+        # globals and functions first, a function may call one defined below it
+        for decl in program.declarations:
+            if isinstance(decl, Function) or decl.var_type.endswith('(func prototype)'):
+                kind, type_name = 'function', decl.ret_type if isinstance(decl, Function) else decl.var_type
+            else:
+                kind, type_name = 'global', decl.var_type
+            old = table.globals.symbols.get(decl.name)
+            if old is not None:
+                # a prototype, or a global declared again without a second
+                # initializer; a function or a global is defined only once
+                if (old.kind != kind or isinstance(decl, Function) and isinstance(old.node, Function)
+                        or kind == 'global' and decl.initializer is not None and old.node.initializer is not None):
+                    raise ResolveError(f"{decl.name} is declared twice in the same scope")
+                if isinstance(decl, Function) or decl.initializer is not None:
+                    old.node = decl
+                symbol = old
+            else:
+                symbol = table.declare(Symbol(decl.name, kind, type_name, decl, unique=decl.name))
+                if kind == 'global':
+                    symbol.index = count
+                    count += 1
+            if isinstance(decl, Declaration):
+                decl.binding = symbol
+        for decl in program.declarations:
+            if isinstance(decl, Function):
+                self.function(decl)
+            elif decl.initializer is not None:
+                decl.initializer = self.expression(decl.initializer)
+        return program
+
+    def local(self, name, kind, type_name, node):
+        count = self.seen.get(name, 0)
+        self.seen[name] = count + 1
+        symbol = Symbol(name, kind, type_name, node, index=len(self.frame.symbols),
+                        unique=name if count == 0 else f"{name}.{count}")
+        self.table.declare(symbol)
+        self.frame.symbols.append(symbol)
+        return symbol
+
+    def function(self, fn):
+        self.frame = Frame()
+        self.seen = {}
+        # the params and the outermost block of the body are one scope
+        self.table.enter(fn.name)
+        for type_name, name in fn.params:
+            self.frame.params.append(self.local(name, 'param', type_name, fn))
+        if isinstance(fn.body, Compound):
+            for stmt in fn.body.stmts:
+                self.statement(stmt)
+        else:
+            self.statement(fn.body)
+        self.table.leave()
+        fn.frame = self.frame
+        self.frame = None
+
+    def statement(self, node):
+        match node:
+            case Compound():
+                self.table.enter('block')
+                for stmt in node.stmts:
+                    self.statement(stmt)
+                self.table.leave()
+            case Declaration():
+                # the name is in scope from its declarator on, but not in its own initializer
+                if node.initializer is not None:
+                    node.initializer = self.expression(node.initializer)
+                node.binding = self.local(node.name, 'local', node.var_type, node)
+            case ExprStmt():
+                if node.expr is not None:
+                    node.expr = self.expression(node.expr)
+            case Return():
+                if node.expr is not None:
+                    node.expr = self.expression(node.expr)
+            case If():
+                node.cond = self.expression(node.cond)
+                self.statement(node.then_branch)
+                if node.else_branch is not None:
+                    self.statement(node.else_branch)
+            case While():
+                node.cond = self.expression(node.cond)
+                self.statement(node.body)
+            case For():
+                # the init is in a scope around the loop, the body a block inside it
+                self.table.enter('for')
+                if isinstance(node.init, Declaration):
+                    self.statement(node.init)
+                elif node.init is not None:
+                    node.init = self.expression(node.init)
+                if node.cond is not None:
+                    node.cond = self.expression(node.cond)
+                if node.post is not None:
+                    node.post = self.expression(node.post)
+                self.statement(node.body)
+                self.table.leave()
+            case Function():
+                raise ResolveError(f"nested function {node.name} is not supported")
+
+    def expression(self, node):
+        """ node with its names bound, the Vars in it replaced. """
+        return self.binder.bind(node)
+
+    def implicit(self, name):
+        name = sys.intern(name)
+        symbol = Symbol(name, 'function', 'int', unique=name)
+        self.table.globals.symbols[name] = symbol
+        # below any locals, it is a global
+        self.table.visible.setdefault(name, []).insert(0, symbol)
+        return symbol
+
+
+class Binder(NodeTransformer):
+    """ Binds the names of an expression for Resolver.expression, children
+    before parents so deep expressions do not recurse.
+
+    A Var that names nothing is kept until its parent is seen: as the
+    callee of a Call it is an implicit extern, anywhere else an error.
+    """
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.unbound = []
+
+    def bind(self, node):
+        self.unbound = []
+        node = self.transform(node)
+        if self.unbound:
+            # the callees were replaced, any other use is still in the tree
+            left = set()
+            stack = [node]
+            while stack:
+                item = stack.pop()
+                left.add(id(item))
+                stack += child_nodes(item)
+            for var in self.unbound:
+                if id(var) in left:
+                    raise ResolveError(f"{var.name} is not declared")
+        return node
+
+    def visit_Var(self, node):
+        symbol = self.resolver.table.lookup(node.name)
+        if symbol is None:
+            self.unbound.append(node)
+            return node
+        return self.resolver.use(symbol)
+
+    def visit_Call(self, node):
+        callee = node.callee
+        if self.unbound and any(var is callee for var in self.unbound):
+            # a function nothing declared is an implicit extern, as in C89
+            resolver = self.resolver
+            node.callee = resolver.use(resolver.table.lookup(callee.name) or resolver.implicit(callee.name))
+        return node
+
+
+def resolve(program: Program) -> Program:
+    """ Binds the names of program in place, raises ResolveError on an undeclared one. """
+    return Resolver().program(program)